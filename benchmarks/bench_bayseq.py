@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Benchmark baySeq getPriors + getLikelihoods (as run by Differential
+translation analysis) with an increasing number of cluster workers, on
+synthetic Ribo-Seq and RNA-Seq counts. Needs rpy2 and baySeq.
+
+    python benchmarks/bench_bayseq.py --transcripts 30000 --workers 1,2,4,8
+
+"""
+import time
+import argparse
+
+# Synthetic counts - 2 replicate groups of 2 libraries, DT transcripts (10%)
+# have a changed Ribo-Seq / RNA-Seq ratio
+SYNTHETIC_DATA = """set.seed({seed})
+n <- {transcripts}
+means <- rgamma(n, shape=0.5, scale=200)
+change <- ifelse(seq_len(n) <= n / 10, 4, 1)
+riboCounts <- cbind(
+    matrix(rnbinom(2 * n, mu=means, size=10), ncol=2),
+    matrix(rnbinom(2 * n, mu=means * change, size=10), ncol=2))
+mrnaCounts <- matrix(rnbinom(4 * n, mu=means, size=10), ncol=4)
+replicates <- c("WT", "WT", "M", "M")
+annotation <- data.frame(name=paste0("tx", seq_len(n)))"""
+
+COUNT_DATA = """pD <- new("countData", replicates=replicates,
+    data=list(riboCounts, mrnaCounts),
+    groups=list(NDT=c(1, 1, 1, 1), DT=c("WT", "WT", "M", "M")),
+    annotation=annotation, densityFunction=bbDensity)
+libsizes(pD) <- getLibsizes(pD)"""
+
+
+def run(R, workers, samplesize):
+    """Return the seconds taken by getPriors and getLikelihoods."""
+    R(COUNT_DATA)
+    cluster = 'NULL'
+    if workers > 1:
+        R('cl <- parallel::makeCluster({})'.format(workers))
+        R('invisible(parallel::clusterEvalQ(cl, '
+          'suppressMessages(library(baySeq))))')
+        cluster = 'cl'
+    start = time.time()
+    try:
+        R('pD <- getPriors(pD, samplesize={}, cl={})'.format(
+            samplesize, cluster))
+        R('pD <- getLikelihoods(pD, cl={})'.format(cluster))
+    finally:
+        if workers > 1:
+            R('parallel::stopCluster(cl)')
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark baySeq with a local cluster')
+    parser.add_argument('--transcripts', type=int, default=10000,
+                        help='Number of transcripts (default: %(default)s)')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='Comma-separated numbers of cluster workers '
+                             '(default: %(default)s)')
+    parser.add_argument('--samplesize', type=int, default=10000,
+                        help='getPriors sample size (default: %(default)s)')
+    args = parser.parse_args()
+
+    import rpy2.robjects as robjects
+    R = robjects.r
+    R('suppressMessages(library(baySeq))')
+    R(SYNTHETIC_DATA.format(seed=1, transcripts=args.transcripts))
+
+    print('{:<10}{:>12}{:>12}'.format('Workers', 'Seconds', 'Speed-up'))
+    baseline = None
+    for workers in [int(value) for value in args.workers.split(',')]:
+        seconds = run(R, workers, args.samplesize)
+        baseline = baseline or seconds
+        print('{:<10}{:>12.1f}{:>11.2f}x'.format(
+            workers, seconds, baseline / seconds))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Benchmark frame counting - runtime and peak memory of the vectorized
+frame counting in frames.py and, if rpy2 and riboSeqR are installed,
+riboSeqR's frameCounting on the same synthetic data.
+
+    python benchmarks/bench_frame_counting.py --reads 10000000 --libraries 4
+
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'riboseqr'))
+
+import numpy as np
+
+import frames
+
+LENGTHS = list(range(25, 31))
+
+
+def synthetic_data(num_reads, num_libraries, num_transcripts=20000,
+                   transcript_length=2000, seed=1):
+    """Return (cds, libraries) - one CDS per transcript and reads with
+    footprint lengths 25-30, mostly starting in frame 0 of the CDS.
+
+    """
+    rand = np.random.RandomState(seed)
+    seqnames = np.arange(num_transcripts, dtype=np.int64)
+    starts = rand.randint(1, 300, num_transcripts)
+    ends = starts + 3 * rand.randint(100, 500, num_transcripts) - 1
+    libraries = []
+    for _ in range(num_libraries):
+        transcripts = rand.randint(0, num_transcripts, num_reads)
+        codons = rand.randint(0, (ends - starts + 1)[transcripts] // 3)
+        frame = rand.choice(3, num_reads, p=[0.7, 0.2, 0.1])
+        read_starts = starts[transcripts] + 3 * codons + frame
+        read_starts = np.minimum(read_starts, transcript_length)
+        widths = rand.choice(LENGTHS, num_reads)
+        libraries.append((transcripts, read_starts, widths))
+    return (seqnames, starts, ends), libraries
+
+
+def bench_numpy(cds, libraries, threads):
+    tracemalloc.start()
+    start = time.time()
+    results = frames.count_frames_parallel(
+        libraries, cds, LENGTHS, threads=threads)
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, sum(int(hits.sum()) for hits, _ in results)
+
+
+def bench_riboseqr(cds, libraries):
+    """Time frameCounting on the same data. Returns None if riboSeqR is not
+    available.
+
+    """
+    try:
+        import rpy2.robjects as robjects
+        robjects.r('suppressMessages(library(riboSeqR))')
+    except Exception:
+        return None
+    R = robjects.r
+    R('toGR <- function(seqnames, starts, ends) GRanges('
+      'seqnames=paste0("tx", seqnames), ranges=IRanges(start=starts, '
+      'end=ends), strand="+")')
+    R['assign']('fastaCDS', R['toGR'](*[robjects.IntVector(column.tolist())
+                                       for column in cds]))
+    ribo = [R['toGR'](robjects.IntVector(seqnames.tolist()),
+                      robjects.IntVector(starts.tolist()),
+                      robjects.IntVector((starts + widths - 1).tolist()))
+            for seqnames, starts, widths in libraries]
+    R['assign']('riboDat', R['new'](
+        'riboData', riboGR=R['GRangesList'](*ribo),
+        replicates=R['factor'](robjects.StrVector(
+            ['rep'] * len(libraries)))))
+    R('invisible(gc(reset=TRUE))')
+    start = time.time()
+    R('fCs <- frameCounting(riboDat, fastaCDS, lengths={}:{})'.format(
+        LENGTHS[0], LENGTHS[-1]))
+    seconds = time.time() - start
+    # "max used" (Mb) of R's memory since the reset
+    peak = sum(R('gc()')[10:12]) * 1024 ** 2
+    return seconds, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark frame counting')
+    parser.add_argument('--reads', type=int, default=1000000,
+                        help='Reads per library (default: %(default)s)')
+    parser.add_argument('--libraries', type=int, default=4,
+                        help='Number of libraries (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Processes for the vectorized frame counting '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    cds, libraries = synthetic_data(args.reads, args.libraries)
+    print('{:<25}{:>12}{:>16}'.format('Engine', 'Seconds', 'Peak memory MB'))
+    seconds, peak, counted = bench_numpy(cds, libraries, args.threads)
+    print('{:<25}{:>12.2f}{:>16.1f}'.format(
+        'numpy ({} processes)'.format(args.threads), seconds,
+        peak / 1024.0 ** 2))
+    result = bench_riboseqr(cds, libraries)
+    if result is None:
+        print('{:<25}{:>28}'.format('frameCounting', 'riboSeqR not available'))
+    else:
+        print('{:<25}{:>12.2f}{:>16.1f}'.format(
+            'frameCounting', result[0], result[1] / 1024.0 ** 2))
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""Benchmark the riboSeqR steps end to end on synthetic data sets of
+increasing size (see synthetic_data.py). Needs R, rpy2 and riboSeqR.
+
+Each step (Prepare riboSeqR input, Triplet periodicity, Metagene analysis,
+Differential translation analysis, Plot ribosome profile) is run with its
+command line, as Galaxy does. For each step the wall time, CPU time, peak
+resident memory (of the largest process of the step) and throughput (Ribo-Seq
+and RNA-Seq reads per second) are recorded, with the slowest R commands
+from the step's profile (<name>-profile.json). Results are saved as JSON so
+that runs, for example before and after a change, can be compared.
+
+    python benchmarks/bench_pipeline.py --reads 1M,10M --output before.json
+    python benchmarks/bench_pipeline.py --reads 1M,10M --output after.json \\
+        --step_args "triplet=--cds_engine numpy --frame_engine numpy"
+    python benchmarks/bench_pipeline.py --compare before.json after.json \\
+        --html_file compare.html
+
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import platform
+import subprocess
+from xml.sax.saxutils import escape
+
+import synthetic_data
+
+RIBOSEQR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'riboseqr')
+
+# (step, script, R data file loaded, R data file saved, profile name)
+STEPS = (
+    ('prepare', 'prepare.py', None, 'Prepare.rda', 'prepare'),
+    ('triplet', 'triplet.py', 'Prepare.rda', 'Periodicity.rda',
+     'periodicity'),
+    ('metagene', 'metagene.py', 'Periodicity.rda', 'Metagene.rda',
+     'metagene'),
+    ('difftrans', 'difftrans.py', 'Metagene.rda', None, 'counts'),
+    ('ribosome_profile', 'ribosome_profile.py', 'Metagene.rda', None,
+     'ribosome-profile'))
+# Footprint lengths counted by Metagene analysis and Differential
+# translation analysis
+LENGTHS = (27, 28)
+# Number of R commands listed per step
+SLOWEST = 3
+
+
+def step_arguments(step, dataset, threads):
+    """Return the command line arguments of step for dataset."""
+    frames = ','.join(str(dataset['dominant_frames'][str(length)])
+                      for length in LENGTHS)
+    lengths = ','.join(str(length) for length in LENGTHS)
+    if step == 'prepare':
+        return ['--ribo_files', ','.join(dataset['ribo_files']),
+                '--rna_files', ','.join(dataset['rna_files']),
+                '--replicate_names', ','.join(dataset['replicates']),
+                '--sam_format', '--threads', str(threads)]
+    elif step == 'triplet':
+        return ['--fasta_file', dataset['fasta_file'],
+                '--include_lengths', '25:31',
+                '--analyze_plot_lengths', '26:30', '--threads', str(threads)]
+    elif step == 'metagene':
+        return ['--selected_lengths', lengths, '--selected_frames', frames,
+                '--hit_mean', '10', '--unique_hit_mean', '1',
+                '--plot_lengths', lengths, '--threads', str(threads)]
+    elif step == 'difftrans':
+        return ['--slice_lengths', lengths, '--frames', frames,
+                '--group1', ','.join('1' for _ in dataset['replicates']),
+                '--group2', ','.join(dataset['replicates']),
+                '--threads', str(threads)]
+    elif step == 'ribosome_profile':
+        return ['--transcript_name', ','.join(dataset['top_transcripts']),
+                '--transcript_length', str(LENGTHS[-1]),
+                '--transcript_cap', '200', '--threads', str(threads)]
+    raise ValueError('Unknown step: {}'.format(step))
+
+
+def run_command(command, log_file):
+    """Run command, writing its output to log_file. Returns (return code,
+    wall seconds, CPU seconds, peak resident memory in MB).
+
+    """
+    with open(log_file, 'w') as log:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.time() - start
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kilobytes on Linux
+    return (returncode, wall, usage.ru_utime + usage.ru_stime,
+            usage.ru_maxrss / 1024.0)
+
+
+def read_profile(file_name):
+    """Return (R wall seconds, slowest R commands) from a step's profile."""
+    if not os.path.exists(file_name):
+        return None, []
+    with open(file_name) as f:
+        profile = json.load(f)
+    slowest = sorted(profile['commands'], key=lambda record:
+                     -record['wall_seconds'])[:SLOWEST]
+    return profile['total_wall_seconds'], [
+        {'command': record['command'].strip().splitlines()[0][:60],
+         'wall_seconds': record['wall_seconds']} for record in slowest]
+
+
+def run_steps(dataset, run_dir, threads=1, step_args=None):
+    """Run all steps on dataset, saving their outputs in run_dir. Stops at
+    the first step that fails. Returns a list of results, one per step.
+
+    """
+    step_args = step_args or {}
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+    reads = 2 * dataset['reads']
+    results = []
+    for step, script, rdata_load, rdata_save, profile in STEPS:
+        output_path = os.path.join(run_dir, '{}_files'.format(step))
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+        command = [sys.executable, os.path.join(RIBOSEQR, script),
+                   '--html_file', os.path.join(run_dir, step + '.html'),
+                   '--output_path', output_path] + step_arguments(
+                       step, dataset, threads)
+        if rdata_load:
+            command += ['--rdata_load', os.path.join(run_dir, rdata_load)]
+        if rdata_save:
+            command += ['--rdata_save', os.path.join(run_dir, rdata_save)]
+        command += step_args.get(step, [])
+        log_file = os.path.join(run_dir, step + '.log')
+        returncode, wall, cpu, peak = run_command(command, log_file)
+        r_seconds, slowest = read_profile(os.path.join(
+            output_path, '{}-profile.json'.format(profile)))
+        results.append({'step': step, 'returncode': returncode,
+                        'wall_seconds': round(wall, 3),
+                        'cpu_seconds': round(cpu, 3),
+                        'peak_rss_mb': round(peak, 1),
+                        'reads_per_second': round(reads / wall, 1),
+                        'r_wall_seconds': r_seconds, 'slowest': slowest})
+        print('{:<10}{:<18}{:>10.1f}{:>10.1f}{:>12.1f}{:>14.0f}{}'.format(
+            synthetic_data.format_count(dataset['reads']), step, wall, cpu,
+            peak, reads / wall,
+            '' if returncode == 0 else '  failed, see ' + log_file))
+        sys.stdout.flush()
+        if returncode:
+            break
+    return results
+
+
+def load_results(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def compare(runs):
+    """Return rows (reads, step, [(wall seconds, peak MB) of each run],
+    speed-ups of the other runs over the first) of steps in all runs.
+
+    """
+    tables = [dict(((run['reads'], step['step']), step)
+                   for run in results['runs'] for step in run['steps']
+                   if step['returncode'] == 0) for results in runs]
+    keys = sorted(set.intersection(*[set(table) for table in tables]),
+                  key=lambda key: (key[0], [step[0] for step in STEPS].index(
+                      key[1])))
+    rows = []
+    for key in keys:
+        values = [(table[key]['wall_seconds'], table[key]['peak_rss_mb'])
+                  for table in tables]
+        rows.append((key[0], key[1], values,
+                     [values[0][0] / value[0] for value in values[1:]]))
+    return rows
+
+
+def print_comparison(labels, rows):
+    print(('{:<10}{:<18}' + '{:>25}' * len(labels) + '{:>12}' *
+           (len(labels) - 1)).format(
+               'Reads', 'Step', *(labels + ['Speed-up' for _ in labels[1:]])))
+    for reads, step, values, speedups in rows:
+        print(('{:<10}{:<18}' + '{:>13.1f}s{:>9.1f}MB' * len(values) +
+               '{:>11.2f}x' * len(speedups)).format(
+                   synthetic_data.format_count(reads), step,
+                   *([number for value in values for number in value] +
+                     speedups)))
+
+
+def write_comparison(html_file, runs, labels, rows):
+    """Write an HTML report of rows (see compare)."""
+    html = ('<html><body><h2>riboSeqR benchmark comparison</h2>\n'
+            '<table border="1" cellpadding="4">\n<tr><th>Run</th>'
+            '<th>Date</th><th>Threads</th><th>Host</th></tr>\n')
+    for label, results in zip(labels, runs):
+        html += ('<tr><td>{0}</td><td>{date}</td><td>{threads}</td>'
+                 '<td>{host}</td></tr>\n'.format(escape(label), **results))
+    html += ('</table>\n<h3>Wall time and peak memory</h3>\n'
+             '<table border="1" cellpadding="4">\n<tr><th>Reads</th>'
+             '<th>Step</th>{0}{1}</tr>\n'.format(
+                 ''.join('<th>{0} (s)</th><th>{0} (MB)</th>'.format(
+                     escape(label)) for label in labels),
+                 ''.join('<th>Speed-up {}</th>'.format(escape(label))
+                         for label in labels[1:])))
+    for reads, step, values, speedups in rows:
+        html += '<tr><td>{}</td><td>{}</td>{}{}</tr>\n'.format(
+            synthetic_data.format_count(reads), step,
+            ''.join('<td>{:.1f}</td><td>{:.1f}</td>'.format(*value)
+                    for value in values),
+            ''.join('<td>{:.2f}x</td>'.format(speedup)
+                    for speedup in speedups))
+    html += '</table>\n</body></html>\n'
+    with open(html_file, 'w') as f:
+        f.write(html)
+
+
+def process_step_args(values):
+    """Return step -> extra arguments from "step=arguments" values."""
+    step_args = {}
+    names = [step[0] for step in STEPS]
+    for value in values or []:
+        step, _, arguments = value.partition('=')
+        if step not in names:
+            raise ValueError('Unknown step: {}'.format(step))
+        step_args.setdefault(step, []).extend(shlex.split(arguments))
+    return step_args
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the riboSeqR steps on synthetic data')
+    parser.add_argument('--reads', default='1M,10M,100M',
+                        help='Comma-separated data set sizes (Ribo-Seq '
+                             'reads), ex: 1M,10M (default: %(default)s)')
+    parser.add_argument('--transcripts', type=int, default=5000,
+                        help='Number of transcripts (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Threads for each step (default: %(default)s)')
+    parser.add_argument('--step_args', action='append',
+                        help='Extra arguments of a step, ex: "triplet='
+                             '--cds_engine numpy" (can be repeated)')
+    parser.add_argument('--data_dir', default='benchmark-data',
+                        help='Directory for the synthetic data sets, reused '
+                             'by later runs (default: %(default)s)')
+    parser.add_argument('--run_dir', default='benchmark-run',
+                        help='Directory for the step outputs and logs '
+                             '(default: %(default)s)')
+    parser.add_argument('--label', help='Name of the run in comparisons '
+                                        '(default: output file name)')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file to save results in '
+                             '(default: %(default)s)')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='Compare saved results instead of running, the '
+                             'first is the baseline')
+    parser.add_argument('--html_file',
+                        help='Write the comparison as an HTML report')
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = [load_results(file_name) for file_name in args.compare]
+        labels = [results['label'] for results in runs]
+        rows = compare(runs)
+        print_comparison(labels, rows)
+        if args.html_file:
+            write_comparison(args.html_file, runs, labels, rows)
+        sys.exit()
+
+    step_args = process_step_args(args.step_args)
+    results = {'label': args.label or os.path.splitext(
+                   os.path.basename(args.output))[0],
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'host': platform.node(), 'platform': platform.platform(),
+               'threads': args.threads, 'transcripts': args.transcripts,
+               'step_args': step_args, 'runs': []}
+    print('{:<10}{:<18}{:>10}{:>10}{:>12}{:>14}'.format(
+        'Reads', 'Step', 'Wall (s)', 'CPU (s)', 'Peak (MB)', 'Reads/s'))
+    for num_reads in [synthetic_data.parse_count(value)
+                      for value in args.reads.split(',')]:
+        data_dir = os.path.join(args.data_dir, 'reads-{}'.format(
+            synthetic_data.format_count(num_reads)))
+        dataset = synthetic_data.load(data_dir)
+        if dataset is None or dataset['transcripts'] != args.transcripts:
+            dataset = synthetic_data.generate(
+                data_dir, num_reads, num_transcripts=args.transcripts)
+        run_dir = os.path.join(args.run_dir, os.path.basename(data_dir))
+        steps = run_steps(dataset, run_dir, threads=args.threads,
+                          step_args=step_args)
+        results['runs'].append({'reads': num_reads, 'steps': steps})
+        # saved after each data set, larger ones take a long time
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
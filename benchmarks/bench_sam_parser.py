@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Benchmark SAM -> riboSeqR conversion (reads/second), comparing the
+original line-by-line parser with the chunked parser in alignments.py,
+without and with a read length filter (--read_lengths 26:30 in Prepare
+riboSeqR input).
+
+Exits with status 1 if the chunked parser is less than --min_speedup times
+as fast as the line-by-line parser in either case, so it can be run as a
+check for regressions in the conversion:
+
+    python benchmarks/bench_sam_parser.py --reads 1000000 --min_speedup 1.05
+
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'riboseqr'))
+
+import alignments
+
+
+# Footprint lengths kept by the filtered runs
+LENGTHS = frozenset(range(26, 31))
+
+
+def legacy_prep_riboseqr_input(sam_file, output_file, lengths=None):
+    """Original prep_riboseqr_input - one split and write per line (with a
+    length check per line if lengths is given)."""
+    with open(output_file, 'w') as f:
+        for line in open(sam_file):
+            if line.startswith('@'):
+                continue
+            line = line.split()
+            flag = line[1]
+
+            if flag != '0':
+                continue
+            start = int(line[3]) - 1
+            (name, sequence) = (line[2], line[9])
+            if lengths is not None and len(sequence) not in lengths:
+                continue
+            f.write('"+"\t"{0}"\t{1}\t"{2}"\n'.format(name, start, sequence))
+
+
+def chunked_prep_riboseqr_input(sam_file, output_file, lengths=None):
+    """Conversion as in prepare.prep_riboseqr_input."""
+    with open(sam_file) as sam, open(output_file, 'w') as output:
+        return alignments.write_riboseqr(
+            alignments.read_sam(sam, lengths=lengths), output)
+
+
+def write_synthetic_sam(sam_file, num_reads, num_transcripts=1000, seed=1):
+    """Write a SAM file with footprint sized reads, quality strings and
+    optional tags. About 10% of the reads are unaligned or reverse strand.
+
+    """
+    rand = random.Random(seed)
+    bases = 'ACGT'
+    with open(sam_file, 'w') as f:
+        f.write('@HD\tVN:1.0\tSO:unsorted\n')
+        for count in range(num_transcripts):
+            f.write('@SQ\tSN:transcript{0}\tLN:2000\n'.format(count))
+        lines = []
+        for count in range(num_reads):
+            length = rand.randint(25, 30)
+            seq = ''.join(rand.choice(bases) for _ in range(length))
+            flag = rand.choice((0,) * 9 + (16, 4))
+            lines.append(
+                'read{0}\t{1}\ttranscript{2}\t{3}\t255\t{4}M\t*\t0\t0\t'
+                '{5}\t{6}\tXA:i:0\tMD:Z:{4}\tNM:i:0\n'.format(
+                    count, flag, rand.randrange(num_transcripts),
+                    rand.randint(1, 1970), length, seq, 'I' * length))
+            if len(lines) == 100000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+
+def run(parsers, sam_file, output_file, num_reads, repeat=3):
+    """Return (name, best time, reads/second) of each (name, parser,
+    lengths) and check that the parsers write the same output.
+
+    The parsers are run in turn, repeat times, so that changes in machine
+    load affect all of them alike.
+
+    """
+    timings = [[] for _ in parsers]
+    outputs = {}
+    for _ in range(repeat):
+        for (name, parser, lengths), times in zip(parsers, timings):
+            start = time.time()
+            parser(sam_file, output_file, lengths=lengths)
+            times.append(time.time() - start)
+            with open(output_file) as f:
+                output = f.read()
+            if outputs.setdefault(lengths, output) != output:
+                raise AssertionError('{} wrote different output'.format(name))
+    return [(name, min(times), num_reads / min(times))
+            for (name, _, _), times in zip(parsers, timings)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark SAM -> riboSeqR input conversion')
+    parser.add_argument('--reads', type=int, default=1000000,
+                        help='Number of reads in the synthetic SAM file '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Best of this many runs (default: %(default)s)')
+    parser.add_argument('--min_speedup', type=float, default=0,
+                        help='Fail if the chunked parser is not this many '
+                             'times as fast (default: no check)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sam_file = os.path.join(tmp_dir, 'synthetic.sam')
+        write_synthetic_sam(sam_file, args.reads)
+        results = run(
+            (('line-by-line', legacy_prep_riboseqr_input, None),
+             ('chunked', chunked_prep_riboseqr_input, None),
+             ('line-by-line, 26:30', legacy_prep_riboseqr_input, LENGTHS),
+             ('chunked, 26:30', chunked_prep_riboseqr_input, LENGTHS)),
+            sam_file, os.path.join(tmp_dir, 'output'), args.reads,
+            repeat=args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{:<22}{:>12}{:>16}'.format('Parser', 'Seconds', 'Reads/second'))
+    for name, seconds, rate in results:
+        print('{:<22}{:>12.2f}{:>16,.0f}'.format(name, seconds, rate))
+    speedups = [results[0][1] / results[1][1], results[2][1] / results[3][1]]
+    print('Speed-up: {:.2f}x, with a length filter: {:.2f}x'.format(
+        *speedups))
+    if min(speedups) < args.min_speedup:
+        print('Slower than the minimum speed-up ({:.2f}x)'.format(
+            args.min_speedup))
+        sys.exit(1)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Synthetic transcriptome and Ribo-Seq/RNA-Seq alignments for benchmarks.
+
+Each transcript has a 5' UTR, one coding sequence (ATG, sense codons, a
+stop codon) and a 3' UTR. Transcript expression is gamma distributed.
+Ribo-Seq footprints have lengths drawn from FOOTPRINT_LENGTHS and 5' ends
+in the CDS with 3-nt periodicity - most reads of each length start in its
+DOMINANT_FRAMES frame. RNA-Seq reads are spread uniformly over the
+transcripts. There are 2 replicates of 2 conditions (WT, M); the first 10%
+of the transcripts are translated DT_CHANGE times more in M.
+
+Reads are split evenly over the libraries, so --reads 10M writes 10 million
+Ribo-Seq and 10 million RNA-Seq alignments in total.
+
+    python benchmarks/synthetic_data.py --reads 1M --output_dir data-1M
+
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+
+# Footprint length -> fraction of Ribo-Seq reads
+FOOTPRINT_LENGTHS = {25: 0.03, 26: 0.07, 27: 0.2, 28: 0.35, 29: 0.2,
+                     30: 0.1, 31: 0.05}
+# Footprint length -> frame (relative to the CDS start) of most 5' ends
+DOMINANT_FRAMES = {25: 0, 26: 2, 27: 1, 28: 0, 29: 2, 30: 1, 31: 0}
+# Fraction of reads in the dominant frame, the others share the rest
+FRAME_BIAS = 0.7
+RNA_READ_LENGTH = 50
+REPLICATES = ('WT', 'WT', 'M', 'M')
+# Change of Ribo-Seq reads of differentially translated transcripts in M
+DT_CHANGE = 4
+STOP_CODONS = ('TAA', 'TAG', 'TGA')
+# Reads generated and written at a time
+CHUNK_READS = 500000
+
+SENSE_CODONS = [a + b + c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT'
+                if a + b + c not in STOP_CODONS]
+
+
+def parse_count(value):
+    """Return an integer from a count with an optional K, M or G suffix
+    ("10M").
+
+    """
+    value = value.strip().upper()
+    multiplier = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}.get(value[-1:])
+    if multiplier:
+        return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
+def format_count(value):
+    """Return a count as written for parse_count (10000000 -> "10M")."""
+    for suffix, multiplier in (('G', 10 ** 9), ('M', 10 ** 6), ('K', 10 ** 3)):
+        if value >= multiplier and value % multiplier == 0:
+            return '{}{}'.format(value // multiplier, suffix)
+    return str(value)
+
+
+def make_transcriptome(num_transcripts, rand):
+    """Return (names, sequences, CDS starts (0-based), CDS ends (0-based,
+    exclusive, after the stop codon)).
+
+    """
+    bases = np.array(list('ACGT'))
+    codons = np.array(SENSE_CODONS)
+    names, sequences, starts, ends = [], [], [], []
+    for count in range(num_transcripts):
+        utr5 = ''.join(bases[rand.randint(0, 4, rand.randint(20, 200))])
+        cds = 'ATG' + ''.join(
+            codons[rand.randint(0, len(codons), rand.randint(100, 600))]) + \
+            STOP_CODONS[rand.randint(0, 3)]
+        utr3 = ''.join(bases[rand.randint(0, 4, rand.randint(60, 300))])
+        names.append('tx{}'.format(count + 1))
+        sequences.append(utr5 + cds + utr3)
+        starts.append(len(utr5))
+        ends.append(len(utr5) + len(cds))
+    return names, sequences, np.array(starts), np.array(ends)
+
+
+def write_fasta(fasta_file, names, sequences):
+    with open(fasta_file, 'w') as f:
+        for name, sequence in zip(names, sequences):
+            f.write('>{}\n'.format(name))
+            for start in range(0, len(sequence), 60):
+                f.write('{}\n'.format(sequence[start:start + 60]))
+
+
+def ribo_reads(num_reads, weights, starts, ends, rand):
+    """Return (transcripts, 0-based starts, lengths) of footprints."""
+    transcripts = rand.choice(len(weights), num_reads, p=weights)
+    lengths = rand.choice(sorted(FOOTPRINT_LENGTHS), num_reads, p=[
+        FOOTPRINT_LENGTHS[length] for length in sorted(FOOTPRINT_LENGTHS)])
+    dominant = np.array([DOMINANT_FRAMES[length] for length in lengths])
+    shift = rand.choice(3, num_reads, p=[
+        FRAME_BIAS, (1 - FRAME_BIAS) / 2, (1 - FRAME_BIAS) / 2])
+    frames = (dominant + shift) % 3
+    # codons before the stop codon
+    codons = (rand.random_sample(num_reads) *
+              ((ends - starts)[transcripts] // 3 - 1)).astype(np.int64)
+    return transcripts, starts[transcripts] + 3 * codons + frames, lengths
+
+
+def rna_reads(num_reads, weights, lengths, rand):
+    """Return (transcripts, 0-based starts, lengths) of RNA-Seq reads."""
+    transcripts = rand.choice(len(weights), num_reads, p=weights)
+    starts = (rand.random_sample(num_reads) *
+              (lengths[transcripts] - RNA_READ_LENGTH + 1)).astype(np.int64)
+    return (transcripts, starts,
+            np.full(num_reads, RNA_READ_LENGTH, dtype=np.int64))
+
+
+def write_sam(sam_file, names, sequences, num_reads, reads, rand):
+    """Write num_reads alignments, generated in chunks by reads(size, rand),
+    to sam_file.
+
+    """
+    qualities = {}
+    with open(sam_file, 'w') as f:
+        f.write('@HD\tVN:1.0\tSO:unsorted\n')
+        f.write(''.join('@SQ\tSN:{}\tLN:{}\n'.format(name, len(sequence))
+                        for name, sequence in zip(names, sequences)))
+        for first in range(0, num_reads, CHUNK_READS):
+            size = min(CHUNK_READS, num_reads - first)
+            lines = []
+            for count, (transcript, start, length) in enumerate(zip(
+                    *[column.tolist() for column in reads(size, rand)])):
+                quality = qualities.get(length)
+                if quality is None:
+                    quality = qualities[length] = 'I' * length
+                lines.append(
+                    'r{0}\t0\t{1}\t{2}\t255\t{3}M\t*\t0\t0\t{4}\t{5}\n'.format(
+                        first + count, names[transcript], start + 1, length,
+                        sequences[transcript][start:start + length],
+                        quality))
+            f.write(''.join(lines))
+
+
+def generate(output_dir, num_reads, num_transcripts=5000, seed=1):
+    """Write a synthetic data set to output_dir - transcripts.fa, one SAM
+    file per Ribo-Seq and RNA-Seq library and dataset.json describing them.
+    Returns the description.
+
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    rand = np.random.RandomState(seed)
+    names, sequences, starts, ends = make_transcriptome(num_transcripts, rand)
+    lengths = np.array([len(sequence) for sequence in sequences])
+    fasta_file = os.path.join(output_dir, 'transcripts.fa')
+    write_fasta(fasta_file, names, sequences)
+
+    expression = rand.gamma(0.5, 1.0, num_transcripts)
+    changed = np.arange(num_transcripts) < num_transcripts // 10
+    ribo_files, rna_files = [], []
+    for count, replicate in enumerate(REPLICATES):
+        size = num_reads // len(REPLICATES)
+        translation = expression * np.where(
+            changed & (replicate == 'M'), DT_CHANGE, 1)
+        ribo_weights = translation / translation.sum()
+        rna_weights = expression * lengths / (expression * lengths).sum()
+        ribo_files.append(os.path.join(
+            output_dir, 'ribo{}.sam'.format(count + 1)))
+        write_sam(ribo_files[-1], names, sequences, size,
+                  lambda size, rand: ribo_reads(
+                      size, ribo_weights, starts, ends, rand), rand)
+        rna_files.append(os.path.join(
+            output_dir, 'rna{}.sam'.format(count + 1)))
+        write_sam(rna_files[-1], names, sequences, size,
+                  lambda size, rand: rna_reads(
+                      size, rna_weights, lengths, rand), rand)
+
+    top = np.argsort(-expression)[:5]
+    dataset = {'reads': num_reads, 'transcripts': num_transcripts,
+               'seed': seed, 'fasta_file': fasta_file,
+               'ribo_files': ribo_files, 'rna_files': rna_files,
+               'replicates': list(REPLICATES),
+               'dominant_frames': dict(
+                   (str(length), frame)
+                   for length, frame in DOMINANT_FRAMES.items()),
+               'top_transcripts': [names[index] for index in top],
+               'dt_transcripts': int(changed.sum())}
+    with open(os.path.join(output_dir, 'dataset.json'), 'w') as f:
+        json.dump(dataset, f, indent=1)
+    return dataset
+
+
+def load(output_dir):
+    """Return the description of the data set in output_dir, or None if
+    there is none.
+
+    """
+    path = os.path.join(output_dir, 'dataset.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic Ribo-Seq/RNA-Seq data set')
+    parser.add_argument('--reads', type=parse_count, default='1M',
+                        help='Ribo-Seq (and RNA-Seq) reads in total, ex: '
+                             '1M, 10M, 100M (default: %(default)s)')
+    parser.add_argument('--transcripts', type=int, default=5000,
+                        help='Number of transcripts (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed (default: %(default)s)')
+    parser.add_argument('--output_dir', required=True,
+                        help='Directory to write the data set to')
+    args = parser.parse_args()
+    dataset = generate(args.output_dir, args.reads,
+                       num_transcripts=args.transcripts, seed=args.seed)
+    print('Wrote {reads} Ribo-Seq and RNA-Seq reads on {transcripts} '
+          'transcripts to {0}'.format(args.output_dir, **dataset))
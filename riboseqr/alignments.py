@@ -0,0 +1,234 @@
+"""Read SAM/BAM format alignments and write riboSeqR format input files.
+
+Alignments are read in large chunks and only the fields needed for riboSeqR
+(FLAG, RNAME, POS and SEQ) are split out. Each chunk is a list of
+(transcript name, 0-indexed start, sequence) records which is written to the
+output in a single call. Functions work on open file objects so that
+compressed files can be streamed (see utils.open_file).
+
+Records can be filtered on transcript name and read length while they are
+streamed, so reads that will not be analysed never reach the output. SAM
+records are filtered as they are parsed, BAM records with filter_records.
+Records can also be gathered into typed columns to be passed to R directly.
+Identical records can optionally be collapsed into one line with a
+multiplicity (count) column.
+
+"""
+import array
+import operator
+import itertools
+import collections
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# Approximate number of bytes of SAM text read per chunk
+CHUNK_SIZE = 4 * 1024 * 1024
+# Number of BAM records per chunk
+BAM_CHUNK_RECORDS = 50000
+# Number of distinct records written at a time when collapsing
+COLLAPSED_CHUNK_RECORDS = 50000
+
+# %-formatting is used as it is cheaper per record than str.format
+RECORD_FORMAT = '"+"\t"%s"\t%d\t"%s"\n'
+COLLAPSED_RECORD_FORMAT = '"+"\t"%s"\t%d\t"%s"\t%d\n'
+
+
+def read_sam(sam, chunk_size=CHUNK_SIZE, seqnames=None, lengths=None):
+    """Yield lists of (name, start, sequence) records of successful
+    alignments (FLAG=0) from an open SAM format file, keeping only records
+    whose transcript name is in seqnames and whose sequence length is in
+    lengths (a filter of None keeps everything).
+
+    Header lines (starting with @, before the alignments) are skipped and
+    alignment starts are made 0-indexed. Each chunk of lines is parsed and
+    filtered in a single list comprehension.
+
+    """
+    # only split as far as SEQ (column 10)
+    split = operator.methodcaller('split', '\t', 10)
+    if seqnames is not None:
+        seqnames = frozenset(seqnames)
+    if lengths is not None:
+        lengths = frozenset(lengths)
+    while True:
+        lines = sam.readlines(chunk_size)
+        if not lines:
+            break
+        if lines[0][0] == '@':
+            lines = [line for line in lines if line[0] != '@']
+        fields = map(split, lines)
+        if seqnames is not None and lengths is not None:
+            records = [(f[2], int(f[3]) - 1, f[9]) for f in fields
+                       if f[1] == '0' and f[2] in seqnames and
+                       len(f[9]) in lengths]
+        elif seqnames is not None:
+            records = [(f[2], int(f[3]) - 1, f[9]) for f in fields
+                       if f[1] == '0' and f[2] in seqnames]
+        elif lengths is not None:
+            records = [(f[2], int(f[3]) - 1, f[9]) for f in fields
+                       if f[1] == '0' and len(f[9]) in lengths]
+        else:
+            records = [(f[2], int(f[3]) - 1, f[9]) for f in fields
+                       if f[1] == '0']
+        yield records
+
+
+def read_bam(bam_file, threads=1, chunk_records=BAM_CHUNK_RECORDS):
+    """Yield lists of (name, start, sequence) records of successful
+    alignments (FLAG=0) from a BAM format file.
+
+    BGZF blocks are decompressed using threads. pysam alignment starts are
+    already 0-indexed.
+
+    """
+    if pysam is None:
+        raise ImportError('pysam is required to read BAM files: '
+                          '{}'.format(bam_file))
+    with pysam.AlignmentFile(bam_file, 'rb', check_sq=False,
+                             threads=threads) as bam:
+        records = []
+        append = records.append
+        for read in bam.fetch(until_eof=True):
+            if read.flag != 0:
+                continue
+            append((read.reference_name, read.reference_start,
+                    read.query_sequence))
+            if len(records) >= chunk_records:
+                yield records
+                records = []
+                append = records.append
+        if records:
+            yield records
+
+
+def filter_records(chunks, seqnames=None, lengths=None):
+    """Yield chunks keeping only records whose transcript name is in
+    seqnames and whose sequence length is in lengths. A filter of None
+    keeps everything.
+
+    """
+    if seqnames is not None:
+        seqnames = frozenset(seqnames)
+    if lengths is not None:
+        lengths = frozenset(lengths)
+    for records in chunks:
+        if seqnames is not None and lengths is not None:
+            records = [record for record in records
+                       if record[0] in seqnames and len(record[2]) in lengths]
+        elif seqnames is not None:
+            records = [record for record in records if record[0] in seqnames]
+        elif lengths is not None:
+            records = [record for record in records
+                       if len(record[2]) in lengths]
+        yield records
+
+
+def conversion_jobs(ribo_jobs, rna_jobs, lengths=None):
+    """Return (sam_file, output_file, lengths) jobs for the Ribo-Seq and then
+    the RNA-Seq (sam_file, output_file) pairs. lengths filters footprint
+    lengths, so it only applies to Ribo-Seq files - RNA-Seq reads of all
+    lengths are kept.
+
+    """
+    return ([(sam_file, output_file, lengths)
+             for sam_file, output_file in ribo_jobs] +
+            [(sam_file, output_file, None)
+             for sam_file, output_file in rna_jobs])
+
+
+def write_chunks(chunks, output):
+    """Write chunks of (name, start, sequence) records to an open output
+    file in riboSeqR input format, yielding each chunk once written.
+
+    """
+    fmt = RECORD_FORMAT
+    for records in chunks:
+        output.write(''.join([fmt % record for record in records]))
+        yield records
+
+
+def write_riboseqr(chunks, output):
+    """Write chunks of (name, start, sequence) records to an open output
+    file in riboSeqR input format. Returns the number of records written.
+
+    """
+    count = 0
+    for records in write_chunks(chunks, output):
+        count += len(records)
+    return count
+
+
+def collect_columns(chunks):
+    """Gather chunks of (name, start, sequence) records into typed columns.
+
+    Returns (seqnames, levels, starts, widths). Transcript names are stored
+    as in an R factor - seqnames are 1-based integer codes into the list of
+    levels. starts are 0-indexed and widths are the read lengths.
+
+    """
+    codes = {}
+    seqnames = array.array('i')
+    starts = array.array('i')
+    widths = array.array('i')
+    for records in chunks:
+        for name, start, sequence in records:
+            code = codes.get(name)
+            if code is None:
+                code = codes[name] = len(codes) + 1
+            seqnames.append(code)
+            starts.append(start)
+            widths.append(len(sequence))
+    levels = sorted(codes, key=codes.get)
+    return seqnames, levels, starts, widths
+
+
+def collapse(chunks):
+    """Count identical (name, start, sequence) records. Returns an ordered
+    mapping of record -> count, in order of first occurrence.
+
+    """
+    counts = collections.OrderedDict()
+    for _ in count_records(chunks, counts):
+        pass
+    return counts
+
+
+def count_records(chunks, counts):
+    """Yield chunks, adding their records to counts, a mapping of record ->
+    count (see collapse).
+
+    """
+    get = counts.get
+    for records in chunks:
+        for record in records:
+            counts[record] = get(record, 0) + 1
+        yield records
+
+
+def write_counts(counts, output, chunk_records=COLLAPSED_CHUNK_RECORDS):
+    """Write a mapping of (name, start, sequence) record -> count (see
+    collapse) to an open output file, chunk_records lines at a time.
+
+    """
+    fmt = COLLAPSED_RECORD_FORMAT
+    items = iter(counts.items())
+    while True:
+        chunk = list(itertools.islice(items, chunk_records))
+        if not chunk:
+            break
+        output.write(''.join([fmt % (name, start, sequence, count)
+                              for (name, start, sequence), count in chunk]))
+
+
+def write_collapsed(chunks, output):
+    """Write each distinct (name, start, sequence) record once to an open
+    output file, with its multiplicity as an extra column. Returns the
+    number of records read.
+
+    """
+    counts = collapse(chunks)
+    write_counts(counts, output)
+    return sum(counts.values())
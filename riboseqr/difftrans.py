@@ -3,28 +3,142 @@ import os
 import sys
 import argparse
 import logging
-import rpy2.robjects as robjects
+import tempfile
 import utils
+import store
+import export
+import rworker
+import profiling
 
-rscript = ''
-R = robjects.r
+R = rworker.connect()
+profile = profiling.Profile(R, r_memory=bool(
+    os.environ.get(profiling.R_MEMORY_ENV)) and not rworker.is_worker(R))
+run_rscript = profile.run_rscript
 
+# Default maximum size of the baySeq posteriors cache (bytes)
+POSTERIORS_CACHE_SIZE = 1024 ** 3
+# baySeq density function for the count data
+DENSITY_FUNCTION = 'bbDensity'
 
-def run_rscript(command=None):
-    """Run R command, log it, append to rscript"""
-    global rscript
-    if not command:
+# Row names, column names and columns of a count matrix or data frame
+TABLE_COLUMNS = """tableColumns <- function(x) {
+    if (is.matrix(x)) {
+        columns <- lapply(seq_len(ncol(x)), function(i) x[, i])
+    } else {
+        columns <- lapply(x, function(column) {
+            if (is.factor(column)) as.character(column) else column
+        })
+    }
+    list(as.character(rownames(x)), as.character(colnames(x)),
+         unname(columns))
+}"""
+
+
+def estimate_posteriors(threads=1):
+    """Estimate baySeq priors and likelihoods of pD. With threads > 1, a
+    local cluster of that many R processes is started for these and
+    stopped again afterwards.
+
+    """
+    cluster = 'NULL'
+    if threads > 1:
+        cluster = 'cl'
+        run_rscript('cl <- parallel::makeCluster({})'.format(threads))
+    try:
+        if threads > 1:
+            run_rscript('invisible(parallel::clusterEvalQ(cl, '
+                        'suppressMessages(library(baySeq))))')
+        run_rscript('pD <- getPriors(pD, cl={})'.format(cluster))
+        run_rscript('pD <- getLikelihoods(pD, cl={})'.format(cluster))
+    finally:
+        if threads > 1:
+            run_rscript('parallel::stopCluster(cl)')
+
+
+def fit_posteriors(group1, group2, threads=1, cache_dir=None,
+                   cache_size=POSTERIORS_CACHE_SIZE):
+    """Estimate baySeq priors and likelihoods of pD (see
+    estimate_posteriors).
+
+    If cache_dir is given, the fitted pD is saved there keyed by a hash of
+    the Ribo-Seq and RNA-Seq counts, replicates, group models and density
+    function, and reused on later runs (that only change the topCounts
+    options). Least recently used results are removed once the cache is
+    larger than cache_size bytes.
+
+    """
+    if not cache_dir:
+        estimate_posteriors(threads)
+        return
+
+    handle, key_file = tempfile.mkstemp(suffix='.rds')
+    os.close(handle)
+    try:
+        run_rscript('saveRDS(list(riboCounts, mrnaCounts, ffCs@replicates), '
+                    'file="{}", compress=FALSE)'.format(key_file))
+        key = utils.digest([key_file], group1, group2, DENSITY_FUNCTION)
+    finally:
+        os.remove(key_file)
+    # kept apart from the findCDS results, which are pruned separately
+    cache_dir = os.path.join(os.path.abspath(cache_dir), 'posteriors')
+    cache_file, hit = utils.cache_lookup(cache_dir, key)
+    if hit:
+        logging.debug('Using cached baySeq posteriors: {}'.format(cache_file))
+        command = 'pD <- readRDS("{}")'.format(cache_file)
+        logging.debug(command)
+        profile.run(R, command)
+        # the script gives the same pD without the cache
+        profile.script += (
+            '# cache hit: pD was read from {}, the result of\n'
+            'pD <- getPriors(pD, cl=NULL)\n'
+            'pD <- getLikelihoods(pD, cl=NULL)\n'.format(cache_file))
         return
-    logging.debug(command)
-    rscript += '{}\n'.format(command)
-    output = R(command)
-    return output
+
+    estimate_posteriors(threads)
+    # write to a temporary file first so that other runs never read a
+    # partially written result
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    run_rscript('saveRDS(pD, file="{}")'.format(tmp_file))
+    os.rename(tmp_file, cache_file)
+    utils.prune_cache(cache_dir, cache_size)
+
+
+def export_table(count_name, file_name, export_format='npz'):
+    """Write the count matrix or data frame count_name to file_name in
+    export_format (see export.py), directly from the R object.
+
+    """
+    import numpy as np
+    run_rscript(TABLE_COLUMNS)
+    index, names, columns = R['tableColumns'](R[count_name])
+    export.write_table(
+        file_name, list(index), list(names),
+        [np.asarray(column) for column in columns],
+        export_format=export_format)
+    profile.script += '# {} exported to {}\n'.format(count_name, file_name)
 
 
 def get_counts(rdata_load='Metagene.rda', slice_lengths='27',
                frames='', group1=None, group2=None, num_counts=10,
                normalize='FALSE', html_file='Counts.html',
-               output_path='counts'):
+               output_path='counts', threads=1, cache_dir=None,
+               cache_size=POSTERIORS_CACHE_SIZE,
+               max_rows=utils.MAX_TABLE_ROWS, export_format='none'):
+    """Ribo-Seq and RNA-Seq counts of the filtered CDSs and differential
+    translation analysis with baySeq, using threads R processes for the
+    priors and likelihoods. The fitted baySeq data is cached in cache_dir,
+    if given (see fit_posteriors).
+
+    The report shows the first max_rows rows (all if 0) of each table with
+    summary statistics, and links to the full CSV files and, with
+    export_format 'npz' or 'parquet', to the same tables in that format.
+
+    """
+    if export_format != 'none' and rworker.is_worker(R):
+        logging.debug('Count tables cannot be exported from an R worker, '
+                      'only writing CSV files')
+        export_format = 'none'
+
     options = {'slice_lengths': utils.process_args(
         slice_lengths, ret_type='int', ret_mode='charvector')}
 
@@ -35,7 +149,8 @@ def get_counts(rdata_load='Metagene.rda', slice_lengths='27',
         frames, ret_type='int', ret_mode='listvector')
 
     run_rscript('suppressMessages(library(riboSeqR))')
-    run_rscript('load("{}")'.format(rdata_load))
+    run_rscript(store.STORE_FUNCTIONS)
+    run_rscript(store.load_command(rdata_load, names=['ffCs', 'riboDat']))
 
     cmd_args = 'ffCs, lengths={slice_lengths}'.format(**options)
     if frames:
@@ -57,50 +172,49 @@ def get_counts(rdata_load='Metagene.rda', slice_lengths='27',
             ('riboCounts', 'RiboCounts.csv', 'Ribo-Seq counts'),
             ('mrnaCounts', 'RNACounts.csv', 'RNA-Seq counts'),
             ('tC', 'TopCounts.csv', 'baySeq topCounts')):
-        if count_name == 'tC' and R['riboCounts'] and R['mrnaCounts']:
+        # a logical vector with embedded R and an R worker (not printed
+        # text), so [0] is TRUE or FALSE
+        if count_name == 'tC' and R('length(riboCounts) > 0 && '
+                                    'length(mrnaCounts) > 0')[0]:
             run_rscript('suppressMessages(library(baySeq))')
             cmd = """pD <- new("countData", replicates=ffCs@replicates, \
             data=list(riboCounts, mrnaCounts), groups=list(NDT={0}, DT={1}), \
             annotation=as.data.frame(ffCs@CDS), \
-            densityFunction=bbDensity)""".format(
+            densityFunction={2})""".format(
                 utils.process_args(
                     group1, ret_type='int', ret_mode='charvector'),
                 utils.process_args(
-                    group2, ret_type='str', ret_mode='charvector'))
+                    group2, ret_type='str', ret_mode='charvector'),
+                DENSITY_FUNCTION)
             run_rscript(cmd)
 
             run_rscript('libsizes(pD) <- getLibsizes(pD)')
-            run_rscript('pD <- getPriors(pD, cl=NULL)')
-            run_rscript('pD <- getLikelihoods(pD, cl=NULL)')
+            fit_posteriors(group1, group2, threads=threads,
+                           cache_dir=cache_dir, cache_size=cache_size)
             run_rscript('tC <- topCounts(pD, "DT", normaliseData={}, '
                         'number={})'.format(normalize, num_counts))
 
-        if R[count_name]:
+        if R('length({}) > 0'.format(count_name))[0]:
             html += '<h3>{}</h3>'.format(legend)
             output_file = os.path.join(output_path, file_name)
             run_rscript('write.csv({}, file="{}")'.format(
                 count_name, output_file))
-            with open(output_file) as g:
-                html += '<table cellpadding="4" border="1">'
-                header = g.readline()
-                html += '<tr>'
-                for item in header.strip().split(","):
-                    html += '<th>{}</th>'.format(item.strip('"'))
-                html += '</tr>'
-                for line in g:
-                    html += '<tr>'
-                    data = line.strip().split(",")
-                    # html += '<td>{}</td>'.format(data[0].strip('"'))
-                    for item in data:
-                        html += ('<td align="center"><code>{}</code>'
-                                 '</td>'.format(item.strip('"')))
-                    html += '</tr>'
-                html += ('</table><p>Download: <a href="{0}">'
-                         '{0}</a></p><hr>'.format(file_name))
+            html += utils.csv_to_html(output_file, max_rows=max_rows)
+            downloads = [file_name]
+            if export_format != 'none':
+                export_name = '{}.{}'.format(
+                    os.path.splitext(file_name)[0], export_format)
+                export_table(
+                    count_name, os.path.join(output_path, export_name),
+                    export_format=export_format)
+                downloads.append(export_name)
+            html += '<p>Download: {}</p><hr>'.format(', '.join(
+                '<a href="{0}">{0}</a>'.format(name) for name in downloads))
 
     with open(os.path.join(output_path, 'counts.R'), 'w') as r:
-        r.write(rscript)
+        r.write(profile.script)
 
+    html += profile.report(output_path, 'counts')
     html += ('<h4>R script for this session</h4>'
              '<p>Download: <a href="counts.R">counts.R</a></p>')
 
@@ -130,8 +244,35 @@ if __name__ == '__main__':
         '--num_counts', help='How many results to return? (topCounts)')
     parser.add_argument('--normalize', help='Normalize data?',
                         choices=['TRUE', 'FALSE'], default='FALSE')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of R processes for baySeq getPriors and getLikelihoods '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--cache_dir', default=os.environ.get('RIBOSEQR_CACHE_DIR'),
+        help='Directory to cache baySeq posteriors in (default: '
+             '$RIBOSEQR_CACHE_DIR, no caching if not set)')
+    parser.add_argument(
+        '--cache_size', type=int, default=POSTERIORS_CACHE_SIZE // 1024 ** 2,
+        help='Maximum size of the baySeq posteriors cache in MB (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--max_rows', type=int, default=utils.MAX_TABLE_ROWS,
+        help='Number of rows of each table shown in the report, 0 for all '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--export_format', choices=export.EXPORT_FORMATS, default='none',
+        help='Also export the count tables in this binary format (npz, or '
+             'parquet if pyarrow is installed) (default: %(default)s)')
     parser.add_argument('--html_file', help='HTML file with reports')
     parser.add_argument('--output_path', help='Directory to save output files')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        default=bool(os.environ.get(profiling.R_MEMORY_ENV)),
+        help='Also measure the memory used by R objects in each command, '
+             'runs a garbage collection before and after it (default: set '
+             'if ${} is set)'.format(profiling.R_MEMORY_ENV))
     parser.add_argument(
         '--debug', help='Produce debug output', action='store_true')
 
@@ -141,10 +282,15 @@ if __name__ == '__main__':
                             level=logging.DEBUG, stream=sys.stdout)
         logging.debug('Supplied Arguments\n{}\n'.format(vars(args)))
 
+    profile.r_memory = args.profile_r_memory and not rworker.is_worker(R)
+
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
     get_counts(rdata_load=args.rdata_load, slice_lengths=args.slice_lengths,
                frames=args.frames, group1=args.group1, group2=args.group2,
                num_counts=args.num_counts, normalize=args.normalize,
-               html_file=args.html_file, output_path=args.output_path)
+               html_file=args.html_file, output_path=args.output_path,
+               threads=args.threads, cache_dir=args.cache_dir,
+               cache_size=args.cache_size * 1024 ** 2,
+               max_rows=args.max_rows, export_format=args.export_format)
@@ -0,0 +1,129 @@
+"""Typed binary export of count tables.
+
+Differential translation analysis writes the Ribo-Seq, RNA-Seq and top
+counts as CSV files. These can also be exported as NumPy .npz files or, if
+pyarrow is installed, Parquet files, so that other tools can read them
+without parsing text.
+
+An .npz file has an index (transcript names, the row names of the table),
+the column names and either values, a 2-d array of all columns if they
+have the same numeric type (count matrices), or one array per column
+(column0, column1, ...). Use read_npz to read either layout. Integer NA
+values from R are stored as the smallest 32-bit integer (R's NA_integer_),
+numeric NA values as NaN. If there are any, a boolean mask of the NA values
+is stored with the same layout (mask, or mask0, mask1, ...) and read_npz
+returns masked arrays.
+
+A Parquet file has the index as its first column (transcript). NA values
+are stored as nulls.
+
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FORMATS = ('none', 'npz', 'parquet')
+# Name of the index column in Parquet files
+INDEX_COLUMN = 'transcript'
+# R's integer (and logical) NA, the smallest 32-bit integer
+NA_INTEGER = -2 ** 31
+
+
+def na_mask(column):
+    """Return a boolean array marking the NA values of a column array from
+    R (NA_INTEGER in integer columns, NaN in numeric columns), or None if
+    there are none.
+
+    """
+    if np.issubdtype(column.dtype, np.integer):
+        mask = column == NA_INTEGER
+    elif np.issubdtype(column.dtype, np.floating):
+        mask = np.isnan(column)
+    else:
+        return None
+    return mask if mask.any() else None
+
+
+def write_npz(file_name, index, names, columns):
+    """Write a table (list of column arrays) with its index (row names) and
+    column names to the .npz file file_name.
+
+    """
+    if np is None:
+        raise ImportError('numpy is required to export .npz files')
+    columns = [np.asarray(column) for column in columns]
+    arrays = {'index': np.asarray(index, dtype=str),
+              'names': np.asarray(names, dtype=str)}
+    masks = [na_mask(column) for column in columns]
+    dtypes = set(column.dtype for column in columns)
+    if len(dtypes) == 1 and np.issubdtype(dtypes.pop(), np.number):
+        arrays['values'] = np.column_stack(columns)
+        if any(mask is not None for mask in masks):
+            arrays['mask'] = np.column_stack(
+                [np.zeros(len(column), dtype=bool) if mask is None else mask
+                 for column, mask in zip(columns, masks)])
+    else:
+        for count, (column, mask) in enumerate(zip(columns, masks)):
+            arrays['column{}'.format(count)] = column
+            if mask is not None:
+                arrays['mask{}'.format(count)] = mask
+    np.savez(file_name, **arrays)
+
+
+def read_npz(file_name):
+    """Return (index, names, columns) of a table written by write_npz.
+    Columns with NA values are masked arrays.
+
+    """
+    if np is None:
+        raise ImportError('numpy is required to read .npz files')
+    with np.load(file_name) as data:
+        index, names = data['index'], data['names']
+        if 'values' in data:
+            values = data['values']
+            if 'mask' in data:
+                values = np.ma.masked_array(values, mask=data['mask'])
+            columns = [values[:, count] for count in range(values.shape[1])]
+        else:
+            columns = []
+            for count in range(len(names)):
+                column = data['column{}'.format(count)]
+                if 'mask{}'.format(count) in data:
+                    column = np.ma.masked_array(
+                        column, mask=data['mask{}'.format(count)])
+                columns.append(column)
+    return index, names, columns
+
+
+def write_parquet(file_name, index, names, columns):
+    """Write a table to the Parquet file file_name, with the index as the
+    first column and NA values as nulls.
+
+    """
+    if pyarrow is None:
+        raise ImportError('pyarrow is required to export Parquet files')
+    if np is None:
+        raise ImportError('numpy is required to export Parquet files')
+    columns = [np.asarray(column) for column in columns]
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(list(index), type=pyarrow.string())] +
+        [pyarrow.array(column, mask=na_mask(column)) for column in columns],
+        names=[INDEX_COLUMN] + list(names))
+    pyarrow.parquet.write_table(table, file_name)
+
+
+def write_table(file_name, index, names, columns, export_format='npz'):
+    """Write a table in export_format ('npz' or 'parquet')."""
+    if export_format == 'npz':
+        write_npz(file_name, index, names, columns)
+    elif export_format == 'parquet':
+        write_parquet(file_name, index, names, columns)
+    else:
+        raise ValueError('Unknown export format: {}'.format(export_format))
@@ -0,0 +1,132 @@
+"""Vectorized frame counting.
+
+An alternative to riboSeqR's frameCounting for large libraries. For each
+library, reads are assigned to the potential coding sequences (CDSs) their
+5' end falls in, and counted per (CDS, frame, read length) with NumPy
+bincount. The frame of a read is the offset of its 5' end from the start of
+the CDS, modulo 3.
+
+CDSs in the same frame of a transcript never overlap, so reads are assigned
+with one sorted search per frame of the CDSs.
+
+FRAME_COUNT_COLUMNS gets the columns counted from fastaCDS and riboDat in
+R, and RIBO_CODING builds fCs (as frameCounting does) from the counts.
+
+"""
+import functools
+import multiprocessing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Columns of fastaCDS and of each Ribo-Seq library in riboDat, with
+# seqnames as integer codes shared by both
+FRAME_COUNT_COLUMNS = """frameCountColumns <- function() {
+    levels <- unique(c(seqlevels(fastaCDS),
+                       unlist(lapply(riboDat@riboGR, seqlevels))))
+    columns <- function(gr, ends=FALSE) {
+        list(match(seqlevels(gr), levels)[as.integer(seqnames(gr))],
+             start(gr), if (ends) end(gr) else width(gr))
+    }
+    list(columns(fastaCDS, ends=TRUE), lapply(riboDat@riboGR, columns))
+}"""
+
+# Build fCs from the read counts of the vectorized frame counting
+RIBO_CODING = """lengths <- {0}
+toArrays <- function(counts) lapply(counts, function(x) array(
+    x, dim=c(length(fastaCDS), 3, length(lengths)),
+    dimnames=list(NULL, paste0("frame", 0:2), lengths)))
+fCs <- new("riboCoding", CDS=fastaCDS, hits=toArrays(hits),
+           unqHits=toArrays(unqHits), replicates=riboDat@replicates)"""
+
+
+def _cds_keys(seqnames, starts, ends, total):
+    """Return sortable keys for CDS starts/ends (seqname * total + position)
+    and the order of the CDSs sorted on them.
+
+    """
+    start_keys = seqnames * total + starts
+    order = np.argsort(start_keys, kind='mergesort')
+    return start_keys[order], (seqnames * total + ends)[order], order
+
+
+def count_frames(reads, cds, lengths):
+    """Count reads of one library in each frame of each CDS.
+
+    reads is (seqnames, starts, widths) and cds is (seqnames, starts, ends)
+    with 1-based, inclusive coordinates and seqnames as integer codes shared
+    by both. Only reads with a width in lengths are counted.
+
+    Returns (hits, unique_hits), integer arrays of shape
+    (number of CDSs, 3, number of lengths). unique_hits counts reads with a
+    distinct start and width once.
+
+    """
+    if np is None:
+        raise ImportError('numpy is required for the vectorized frame '
+                          'counting')
+    read_seqnames, read_starts, widths = [
+        np.asarray(column, dtype=np.int64) for column in reads]
+    cds_seqnames, cds_starts, cds_ends = [
+        np.asarray(column, dtype=np.int64) for column in cds]
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shape = (len(cds_starts), 3, len(lengths))
+    hits = np.zeros(shape, dtype=np.int64)
+    unique_hits = np.zeros(shape, dtype=np.int64)
+    if not len(read_starts) or not len(cds_starts):
+        return hits, unique_hits
+
+    # index of each read's length, dropping reads of other lengths
+    length_index = np.full(max(widths.max(), lengths.max()) + 1, -1,
+                           dtype=np.int64)
+    length_index[lengths] = np.arange(len(lengths))
+    read_lengths = length_index[widths]
+    keep = read_lengths >= 0
+    read_seqnames, read_starts = read_seqnames[keep], read_starts[keep]
+    read_lengths = read_lengths[keep]
+
+    total = max(read_starts.max(), cds_ends.max()) + 1
+    read_keys = read_seqnames * total + read_starts
+    cds_frames = cds_starts % 3
+    size = shape[0] * 3 * shape[2]
+    for cds_frame in range(3):
+        selected = np.flatnonzero(cds_frames == cds_frame)
+        if not len(selected):
+            continue
+        start_keys, end_keys, order = _cds_keys(
+            cds_seqnames[selected], cds_starts[selected],
+            cds_ends[selected], total)
+        found = np.searchsorted(start_keys, read_keys, side='right') - 1
+        inside = found >= 0
+        inside[inside] = read_keys[inside] <= end_keys[found[inside]]
+        cds_index = selected[order[found[inside]]]
+        frames = (read_starts[inside] - cds_starts[cds_index]) % 3
+        bins = (cds_index * 3 + frames) * shape[2] + read_lengths[inside]
+        hits += np.bincount(bins, minlength=size).reshape(shape)
+        # one count per distinct (start, length) within each CDS
+        unique = np.unique(bins * total + read_starts[inside]) // total
+        unique_hits += np.bincount(unique, minlength=size).reshape(shape)
+    return hits, unique_hits
+
+
+def _count_frames(reads, **kwargs):
+    """count_frames for use with a process pool."""
+    return count_frames(reads, **kwargs)
+
+
+def count_frames_parallel(libraries, cds, lengths, threads=1):
+    """count_frames for each library (list of reads) in a pool of processes.
+    Returns a list of (hits, unique_hits), one per library.
+
+    """
+    worker = functools.partial(_count_frames, cds=cds, lengths=lengths)
+    if threads <= 1 or len(libraries) < 2:
+        return [worker(reads) for reads in libraries]
+    pool = multiprocessing.Pool(processes=min(threads, len(libraries)))
+    try:
+        return pool.map(worker, libraries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
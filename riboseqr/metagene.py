@@ -1,51 +1,84 @@
 #!/usr/bin/env python
 import os
 import sys
-import glob
+import csv
 import argparse
 import logging
-import rpy2.robjects as robjects
+import tempfile
 
 import utils
+import store
+import rworker
+import profiling
+
+R = rworker.connect()
+profile = profiling.Profile(R, r_memory=bool(
+    os.environ.get(profiling.R_MEMORY_ENV)) and not rworker.is_worker(R))
+run_rscript = profile.run_rscript
+
+# Filter hits with each combination of filterHits arguments (quoted) and
+# draw its plots, in a pool of forked R processes. Returns the number of
+# CDSs kept by each combination (NA if it failed) and the error messages,
+# and lists the files of each plot, numbered across combinations, in
+# manifest (see utils.RENDER_PLOTS) if given.
+SWEEP_FILTER = """sweepFilter <- function(filters, plots, cores=1,
+                        manifest=NULL) {
+    results <- parallel::mclapply(seq_along(filters), function(i) {
+        tryCatch({
+            eval(filters[[i]], envir=globalenv())
+            files <- lapply(plots[[i]], function(plot) {
+                as.character(eval(plot, envir=globalenv()))
+            })
+            list(length(get("ffCDS", envir=globalenv())), "", files)
+        }, error=function(e) list(NA_integer_, conditionMessage(e), list()))
+    }, mc.cores=cores, mc.preschedule=FALSE)
+    if (!is.null(manifest)) {
+        lines <- unlist(lapply(seq_along(results), function(i) {
+            files <- results[[i]][[3]]
+            unlist(lapply(seq_along(files), function(j) {
+                number <- (i - 1) * length(plots[[i]]) + j
+                if (length(files[[j]])) {
+                    paste(number, "file", files[[j]], sep="\\t")
+                }
+            }))
+        }))
+        writeLines(as.character(lines), manifest)
+    }
+    data.frame(
+        retained=vapply(results, function(x) as.integer(x[[1]]), integer(1)),
+        error=vapply(results, function(x) x[[2]], character(1)),
+        stringsAsFactors=FALSE)
+}"""
+
+
+def render_plots(plots, threads=1):
+    """Draw plots (render_plot commands) in threads forked R processes,
+    sharing the loaded objects. Returns (files written, error) for each.
 
-rscript = ''
-R = robjects.r
-
-
-def run_rscript(command=None):
-    """Run R command, log it, append to rscript"""
-    global rscript
-    if not command:
-        return
-    logging.debug(command)
-    rscript += '{}\n'.format(command)
-    output = R(command)
-    return output
-
-
-def do_analysis(
-        rdata_load='Periodicity.rda', selected_lengths='27',
-        selected_frames='', hit_mean='10', unique_hit_mean='1',
-        ratio_check='TRUE', min5p='-20', max5p='200', min3p='-200', max3p='20',
-        cap='', plot_title='', plot_lengths='27', rdata_save='Metagene.rda',
-        html_file='Metagene-report.html', output_path=os.getcwd()):
-    """Metagene analysis from saved periodicity R data file. """
-    run_rscript('suppressMessages(library(riboSeqR))')
-    run_rscript('load("{}")'.format(rdata_load))
-
-    logging.debug('fS\n{}\nfCs\n{}\n'.format(R['fS'], R['fCs']))
+    """
+    # read stored objects once, before forking
+    run_rscript('invisible(list(ffCDS, riboDat))')
+    handle, manifest = tempfile.mkstemp(suffix='.tsv')
+    os.close(handle)
+    try:
+        run_rscript(utils.RENDER_PLOT)
+        run_rscript(utils.RENDER_PLOTS)
+        run_rscript(utils.render_plots(plots, manifest=manifest,
+                                       cores=threads))
+        return utils.read_plot_manifest(manifest, len(plots))
+    finally:
+        os.remove(manifest)
+
+
+def filter_args(selected_lengths, selected_frames, hit_mean,
+                unique_hit_mean, ratio_check='TRUE'):
+    """Return the filterHits arguments."""
     options = {}
     for key, value, rtype, rmode in (
             ('lengths', selected_lengths, 'int', 'charvector'),
             ('frames', selected_frames, 'int', 'listvector'),
             ('hit_mean', hit_mean, 'int', None),
-            ('unique_hit_mean', unique_hit_mean, 'int', None),
-            ('ratio_check', ratio_check, 'bool', None),
-            ('min5p', min5p, 'int', None), ('max5p', max5p, 'int', None),
-            ('min3p', min3p, 'int', None), ('max3p', max3p, 'int', None),
-            ('cap', cap, 'int', None),
-            ('plot_title', plot_title, 'str', 'charvector'),
-            ('plot_lengths', plot_lengths, 'int', 'list')):
+            ('unique_hit_mean', unique_hit_mean, 'int', None)):
             options[key] = utils.process_args(
                 value, ret_type=rtype, ret_mode=rmode)
 
@@ -55,11 +88,22 @@ def do_analysis(
 
     if ratio_check == 'TRUE':
         cmd_args += ', ratioCheck = TRUE'
+    return cmd_args
 
-    run_rscript('ffCs <- filterHits({})'.format(cmd_args))
-    logging.debug("ffCs\n{}\n".format(R['ffCs']))
 
-    cds_args = ('coordinates=ffCs@CDS, riboDat=riboDat, min5p={min5p}, '
+def cds_plot_args(min5p='-20', max5p='200', min3p='-200', max3p='20', cap='',
+                  plot_title=''):
+    """Return the plotCDS arguments, except lengths."""
+    options = {}
+    for key, value, rtype, rmode in (
+            ('min5p', min5p, 'int', None), ('max5p', max5p, 'int', None),
+            ('min3p', min3p, 'int', None), ('max3p', max3p, 'int', None),
+            ('cap', cap, 'int', None),
+            ('plot_title', plot_title, 'str', 'charvector')):
+            options[key] = utils.process_args(
+                value, ret_type=rtype, ret_mode=rmode)
+
+    cds_args = ('coordinates=ffCDS, riboDat=riboDat, min5p={min5p}, '
                 'max5p={max5p}, min3p={min3p}, max3p={max3p}'.format(**options))
 
     if options['cap']:
@@ -67,6 +111,40 @@ def do_analysis(
 
     if options['plot_title']:
         cds_args += ', main={plot_title}'.format(**options)
+    return cds_args
+
+
+def do_analysis(
+        rdata_load='Periodicity.rda', selected_lengths='27',
+        selected_frames='', hit_mean='10', unique_hit_mean='1',
+        ratio_check='TRUE', min5p='-20', max5p='200', min3p='-200', max3p='20',
+        cap='', plot_title='', plot_lengths='27', rdata_save='Metagene.rda',
+        html_file='Metagene-report.html', output_path=os.getcwd(),
+        plot_formats=utils.PLOT_FORMATS, store_dir=None,
+        rdata_compress='none', threads=1):
+    """Metagene analysis from saved periodicity R data file. Each plot is
+    drawn once and saved in each of plot_formats, plots of the lengths in
+    plot_lengths are drawn in parallel by threads R processes.
+
+    R objects are saved in rdata_save, or in store_dir if given (only ffCs
+    and ffCDS, its CDSs, are written if riboDat and fastaCDS were loaded
+    from the store), with rdata_compress compression using threads.
+
+    """
+    run_rscript('suppressMessages(library(riboSeqR))')
+    run_rscript(store.STORE_FUNCTIONS)
+    run_rscript(store.load_command(rdata_load, names=[
+        'fS', 'fCs', 'riboDat', 'fastaCDS', 'readStore']))
+
+    logging.debug('fS\n{}\nfCs\n{}\n'.format(R['fS'], R['fCs']))
+    run_rscript('ffCs <- filterHits({}); ffCDS <- ffCs@CDS'.format(
+        filter_args(selected_lengths, selected_frames, hit_mean,
+                    unique_hit_mean, ratio_check)))
+    logging.debug("ffCs\n{}\n".format(R['ffCs']))
+
+    cds_args = cds_plot_args(min5p, max5p, min3p, max3p, cap, plot_title)
+    options = {'plot_lengths': utils.process_args(
+        plot_lengths, ret_type='int', ret_mode='list')}
 
     html = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2//EN">
     <html>
@@ -80,35 +158,38 @@ def do_analysis(
              '<code>{0}</code></strong><br>\nLengths of footprints '
              'selected for the plot - <strong><code>{1}</code></strong>'
              '\n</p>\n'.format(selected_lengths, plot_lengths))
-    for count, length in enumerate(options['plot_lengths']):
-        count += 1
+    plots = [utils.render_plot(
+        'plotCDS({0},{1})'.format(cds_args, 'lengths={}'.format(length)),
+        os.path.join(output_path, 'Metagene-analysis-plot{0}'.format(
+            count + 1)), plot_formats)
+        for count, length in enumerate(options['plot_lengths'])]
+    for count, (length, (files, error)) in enumerate(zip(
+            options['plot_lengths'], render_plots(plots, threads))):
         html += '<h3>Length: {0}</h3>\n'.format(length)
-        plot_file = os.path.join(output_path,
-                                 'Metagene-analysis-plot{0}'.format(count))
-        for fmat in ('pdf', 'png'):
-            if fmat == 'png':
-                cmd = 'png(file="{0}_%1d.png", type="cairo")'
-            else:
-                cmd = 'pdf(file="{0}.pdf")'
-            run_rscript(cmd.format(plot_file))
-            run_rscript('plotCDS({0},{1})'.format(
-                cds_args, 'lengths={}'.format(length)))
-            run_rscript('dev.off()')
-        for image in sorted(
-                glob.glob('{}*.png'.format(plot_file))):
-            html += '<p><img border="1" src="{0}" alt="{0}"></p>\n'.format(
-                os.path.basename(image))
-        html += '<p><a href="{0}.pdf">PDF version</a></p>\n'.format(
-            os.path.basename(plot_file))
-    run_rscript('save("ffCs", "riboDat", "fastaCDS", file="{}", '
-                'compress=FALSE)'.format(rdata_save))
+        if error:
+            html += '<p>Plot failed: {0}</p>\n'.format(error)
+        for image in files:
+            if image.endswith('.png'):
+                html += '<p><img border="1" src="{0}" alt="{0}"></p>\n'.\
+                    format(os.path.basename(image))
+        for pdf in files:
+            if pdf.endswith('.pdf'):
+                html += '<p><a href="{0}">PDF version</a></p>\n'.format(
+                    os.path.basename(pdf))
+    run_rscript(store.save_command(
+        ['ffCs', 'ffCDS', 'riboDat', 'fastaCDS', 'readStore'], rdata_save,
+        store_dir=store_dir, changed=['ffCs', 'ffCDS'],
+        compress=rdata_compress, threads=threads))
+    if store_dir:
+        store.prune_store(store_dir)
 
     logging.debug('\n{:#^80}\n{}\n{:#^80}\n'.format(
-        ' R script for this session ', rscript, ' End R script '))
+        ' R script for this session ', profile.script, ' End R script '))
 
     with open(os.path.join(output_path, 'metagene.R'), 'w') as r:
-        r.write(rscript)
+        r.write(profile.script)
 
+    html += profile.report(output_path, 'metagene')
     html += ('<h4>R script for this session</h4>\n'
              '<p><a href="metagene.R">metagene.R</a></p>\n'
              '<p>Next step: <em>Plot Ribosome profile</em></p>\n'
@@ -117,6 +198,142 @@ def do_analysis(
     with open(html_file, 'w') as f:
         f.write(html)
 
+
+def sweep_analysis(
+        rdata_load='Periodicity.rda', selected_lengths='27',
+        selected_frames='', hit_mean='10', unique_hit_mean='1',
+        ratio_check='TRUE', min5p='-20', max5p='200', min3p='-200', max3p='20',
+        cap='', plot_title='', plot_lengths='27',
+        html_file='Metagene-sweep-report.html', output_path=os.getcwd(),
+        plot_formats=utils.PLOT_FORMATS, threads=1):
+    """Metagene analysis with each combination of filterHits parameters, to
+    compare them. selected_lengths, selected_frames, hit_mean and
+    unique_hit_mean take semicolon-separated alternatives ("27;27,28").
+    Lengths and frames vary together, the other parameters are crossed (see
+    utils.process_grid).
+
+    The R data is loaded once and the combinations are run by threads
+    forked R processes. The report has a table of the number of CDSs kept
+    by each combination (also saved as Metagene-sweep.csv) and its plots.
+    No R data is saved.
+
+    """
+    combinations = utils.process_grid(
+        [('lengths', selected_lengths), ('frames', selected_frames),
+         ('hit_mean', hit_mean), ('unique_hit_mean', unique_hit_mean)],
+        paired=[('lengths', 'frames')])
+    logging.debug('{} combinations'.format(len(combinations)))
+
+    run_rscript('suppressMessages(library(riboSeqR))')
+    run_rscript(store.STORE_FUNCTIONS)
+    run_rscript(store.load_command(rdata_load, names=[
+        'fS', 'fCs', 'riboDat']))
+
+    cds_args = cds_plot_args(min5p, max5p, min3p, max3p, cap, plot_title)
+    lengths = utils.process_args(plot_lengths, ret_type='int', ret_mode='list')
+    filters, plots = [], []
+    for count, combination in enumerate(combinations):
+        filters.append('quote({{ffCs <- filterHits({}); '
+                       'ffCDS <- ffCs@CDS}})'.format(filter_args(
+                           combination['lengths'], combination['frames'],
+                           combination['hit_mean'],
+                           combination['unique_hit_mean'], ratio_check)))
+        plots.append('list({})'.format(', '.join(
+            'quote({})'.format(utils.render_plot(
+                'plotCDS({0},lengths={1})'.format(cds_args, length),
+                os.path.join(output_path, 'Metagene-sweep{0}-plot{1}'.format(
+                    count + 1, number + 1)), plot_formats))
+            for number, length in enumerate(lengths))))
+
+    results_file = os.path.join(output_path, 'Metagene-sweep.csv')
+    handle, manifest = tempfile.mkstemp(suffix='.tsv')
+    os.close(handle)
+    # read stored objects once, before forking
+    run_rscript('invisible(riboDat)')
+    run_rscript(utils.RENDER_PLOT)
+    run_rscript(SWEEP_FILTER)
+    # parameters of each combination, as given
+    columns = dict((key, 'c({})'.format(', '.join(
+        '"{}"'.format(combination[key]) for combination in combinations)))
+        for key in ('lengths', 'frames', 'hit_mean', 'unique_hit_mean'))
+    try:
+        run_rscript("""sweepResults <- cbind(data.frame(
+        lengths={lengths}, frames={frames}, hitMean={hit_mean},
+        unqhitMean={unique_hit_mean}, stringsAsFactors=FALSE),
+        sweepFilter(list({filters}), list({plots}), cores={threads},
+                    manifest="{manifest}"))
+    write.csv(sweepResults, file="{file}", row.names=FALSE)""".format(
+            filters=',\n        '.join(filters),
+            plots=',\n        '.join(plots), threads=threads,
+            manifest=manifest, file=results_file, **columns))
+        rendered = utils.read_plot_manifest(
+            manifest, len(combinations) * len(lengths))
+    finally:
+        os.remove(manifest)
+
+    with open(results_file) as f:
+        results = list(csv.DictReader(f))
+
+    html = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2//EN">
+    <html>
+    <head>
+    <title>Metagene Analysis Sweep - Report</title>
+    </head>
+    <body>
+    """
+    html += '<h2>Metagene analysis sweep - results</h2>\n<hr>\n'
+    html += ('<p>\nLengths of footprints selected for the plots - <strong>'
+             '<code>{0}</code></strong>\n</p>\n'.format(plot_lengths))
+    index = ('<table border="1" cellpadding="4">\n<tr><th>#</th>'
+             '<th>Lengths</th><th>Frames</th><th>hitMean</th>'
+             '<th>unqhitMean</th><th>Retained CDSs</th><th>Plots</th></tr>\n')
+    sections = ''
+    for count, result in enumerate(results):
+        count += 1
+        if result['error']:
+            status = 'Failed: {}'.format(result['error'])
+        else:
+            status = '<a href="#sweep{0}">View</a>'.format(count)
+        index += ('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td>'
+                  '<td>{4}</td><td>{5}</td><td>{6}</td></tr>\n'.format(
+                      count, result['lengths'], result['frames'],
+                      result['hitMean'], result['unqhitMean'],
+                      result['retained'] or '-', status))
+        if result['error']:
+            continue
+        sections += ('<h3 id="sweep{0}">Combination {0}: lengths {1}, frames '
+                     '{2}, hitMean {3}, unqhitMean {4}</h3>\n'.format(
+                         count, result['lengths'], result['frames'],
+                         result['hitMean'], result['unqhitMean']))
+        for number, length in enumerate(lengths):
+            files, _ = rendered[(count - 1) * len(lengths) + number]
+            sections += '<h4>Length: {0}</h4>\n'.format(length)
+            for image in files:
+                if image.endswith('.png'):
+                    sections += ('<p><img border="1" src="{0}" alt="{0}">'
+                                 '</p>\n'.format(os.path.basename(image)))
+            for pdf in files:
+                if pdf.endswith('.pdf'):
+                    sections += ('<p><a href="{0}">PDF version</a></p>\n'.
+                                 format(os.path.basename(pdf)))
+    html += '{0}</table>\n<p>Download: <a href="Metagene-sweep.csv">' \
+            'Metagene-sweep.csv</a></p>\n<hr>\n{1}'.format(index, sections)
+
+    logging.debug('\n{:#^80}\n{}\n{:#^80}\n'.format(
+        ' R script for this session ', profile.script, ' End R script '))
+
+    with open(os.path.join(output_path, 'metagene-sweep.R'), 'w') as r:
+        r.write(profile.script)
+
+    html += profile.report(output_path, 'metagene-sweep')
+    html += ('<h4>R script for this session</h4>\n'
+             '<p><a href="metagene-sweep.R">metagene-sweep.R</a></p>\n'
+             '</body>\n</html>\n')
+
+    with open(html_file, 'w') as f:
+        f.write(html)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Metagene analysis')
@@ -183,8 +400,38 @@ if __name__ == '__main__':
                       '(default: %(default)s)')
 
     parser.add_argument('--plot_title', help='Title of the plot', default='')
+    parser.add_argument(
+        '--plot_formats', type=utils.process_formats,
+        default=','.join(utils.PLOT_FORMATS),
+        help='Comma-separated formats to save plots in (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--store', default=os.environ.get(store.STORE_ENV),
+        help='Directory to save R objects in, shared by reference with the '
+             'next steps (default: ${}, objects are saved in the R data '
+             'file if not set)'.format(store.STORE_ENV))
+    parser.add_argument(
+        '--rdata_compress', choices=store.COMPRESSION, default='none',
+        help='Compression of the saved R data (default: %(default)s)')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of R processes drawing plots and threads compressing '
+             'the saved R data (default: %(default)s)')
+    parser.add_argument(
+        '--sweep', action='store_true',
+        help='Flag. Compare combinations of the filtering parameters - '
+             'selected_lengths, selected_frames, hit_mean and '
+             'unique_hit_mean take semicolon-separated alternatives '
+             '(ex: 27;27,28). No R data is saved')
     parser.add_argument('--html_file', help='HTML file with reports')
     parser.add_argument('--output_path', help='Directory to save output files')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        default=bool(os.environ.get(profiling.R_MEMORY_ENV)),
+        help='Also measure the memory used by R objects in each command, '
+             'runs a garbage collection before and after it (default: set '
+             'if ${} is set)'.format(profiling.R_MEMORY_ENV))
     parser.add_argument(
         '--debug', help='Produce debug output', action='store_true')
 
@@ -194,16 +441,34 @@ if __name__ == '__main__':
                             level=logging.DEBUG, stream=sys.stdout)
         logging.debug('Supplied Arguments\n{}\n'.format(vars(args)))
 
+    profile.r_memory = args.profile_r_memory and not rworker.is_worker(R)
+
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
-    do_analysis(
-        rdata_load=args.rdata_load, selected_lengths=args.selected_lengths,
-        selected_frames=args.selected_frames, hit_mean=args.hit_mean,
-        unique_hit_mean=args.unique_hit_mean, ratio_check=args.ratio_check,
-        min5p=args.min5p, max5p=args.max5p, min3p=args.min3p, max3p=args.max3p,
-        cap=args.cap, plot_title=args.plot_title,
-        plot_lengths=args.plot_lengths, rdata_save=args.rdata_save,
-        html_file=args.html_file, output_path=args.output_path)
+    if args.sweep:
+        sweep_analysis(
+            rdata_load=args.rdata_load,
+            selected_lengths=args.selected_lengths,
+            selected_frames=args.selected_frames, hit_mean=args.hit_mean,
+            unique_hit_mean=args.unique_hit_mean,
+            ratio_check=args.ratio_check, min5p=args.min5p,
+            max5p=args.max5p, min3p=args.min3p, max3p=args.max3p,
+            cap=args.cap, plot_title=args.plot_title,
+            plot_lengths=args.plot_lengths, html_file=args.html_file,
+            output_path=args.output_path, plot_formats=args.plot_formats,
+            threads=args.threads)
+    else:
+        do_analysis(
+            rdata_load=args.rdata_load, selected_lengths=args.selected_lengths,
+            selected_frames=args.selected_frames, hit_mean=args.hit_mean,
+            unique_hit_mean=args.unique_hit_mean, ratio_check=args.ratio_check,
+            min5p=args.min5p, max5p=args.max5p, min3p=args.min3p,
+            max3p=args.max3p,
+            cap=args.cap, plot_title=args.plot_title,
+            plot_lengths=args.plot_lengths, rdata_save=args.rdata_save,
+            html_file=args.html_file, output_path=args.output_path,
+            plot_formats=args.plot_formats, store_dir=args.store,
+            rdata_compress=args.rdata_compress, threads=args.threads)
 
     logging.debug('Done!')
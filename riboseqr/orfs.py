@@ -0,0 +1,154 @@
+"""Vectorized potential coding sequence (CDS) finder.
+
+An alternative to riboSeqR's findCDS for large transcriptomes. Sequences are
+encoded as byte arrays and start/stop codons are found in all three frames
+of all transcripts at once with NumPy.
+
+A CDS starts at the first start codon after the previous in-frame stop codon
+(or the start of the transcript) and ends with the last base of the stop
+codon. Coordinates are 1-based and inclusive, as in R.
+
+"""
+import functools
+import multiprocessing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Approximate number of bases searched at a time (by each process)
+GROUP_SIZE = 8 * 1024 * 1024
+
+
+def read_fasta(fasta):
+    """Return lists of names and sequences from an open FASTA file. Names
+    are the first word of the header line, sequences are upper case.
+
+    """
+    names = []
+    sequences = []
+    lines = []
+    for line in fasta:
+        line = line.strip()
+        if line.startswith('>'):
+            if names:
+                sequences.append(''.join(lines).upper())
+            names.append(line[1:].split(None, 1)[0] if len(line) > 1 else '')
+            lines = []
+        elif line:
+            lines.append(line)
+    if names:
+        sequences.append(''.join(lines).upper())
+    return names, sequences
+
+
+def _codon_codes(codons):
+    """Return codons (strings) as 24-bit integer codes."""
+    codons = [codon.upper() for codon in codons]
+    return np.array([(ord(codon[0]) << 16) | (ord(codon[1]) << 8) |
+                     ord(codon[2]) for codon in codons], dtype=np.uint32)
+
+
+def find_cds(sequences, start_codons=('ATG',),
+             stop_codons=('TAG', 'TAA', 'TGA')):
+    """Find potential coding sequences in a list of sequences.
+
+    Returns arrays (index, starts, ends, frames) - the index of the sequence
+    each CDS is on, its 1-based start and end and its frame (0, 1 or 2)
+    relative to the start of the sequence. CDSs are ordered by sequence,
+    then frame and start.
+
+    """
+    if np is None:
+        raise ImportError('numpy is required for the vectorized CDS finder')
+    lengths = np.array([len(sequence) for sequence in sequences],
+                       dtype=np.int64)
+    offsets = np.zeros(len(sequences), dtype=np.int64)
+    if len(sequences) > 1:
+        offsets[1:] = np.cumsum(lengths)[:-1]
+    data = np.frombuffer(''.join(sequences).encode('ascii'), dtype=np.uint8)
+    empty = np.array([], dtype=np.int64)
+    if len(data) < 3:
+        return empty, empty, empty, empty
+
+    # codon at every position of the concatenated sequences
+    codons = ((data[:-2].astype(np.uint32) << 16) |
+              (data[1:-1].astype(np.uint32) << 8) | data[2:])
+    # one key per (sequence, frame) - sorting on key * total + position
+    # orders codons by frame within each sequence
+    total = len(data) + 1
+
+    def codon_keys(codes):
+        hits = np.flatnonzero(np.isin(codons, codes))
+        index = np.searchsorted(offsets, hits, side='right') - 1
+        positions = hits - offsets[index]
+        # drop codons spanning two sequences
+        inside = positions + 3 <= lengths[index]
+        index, positions = index[inside], positions[inside]
+        return np.sort((index * 3 + positions % 3) * total + positions)
+
+    start_keys = codon_keys(_codon_codes(start_codons))
+    stop_keys = codon_keys(_codon_codes(stop_codons))
+    del codons
+    if not len(start_keys) or not len(stop_keys):
+        return empty, empty, empty, empty
+
+    # the next in-frame stop of each start codon
+    next_stop = np.searchsorted(stop_keys, start_keys)
+    valid = next_stop < len(stop_keys)
+    start_keys, next_stop = start_keys[valid], next_stop[valid]
+    valid = stop_keys[next_stop] // total == start_keys // total
+    start_keys, next_stop = start_keys[valid], next_stop[valid]
+
+    # the first start codon before each stop codon
+    next_stop, first = np.unique(next_stop, return_index=True)
+    start_keys = start_keys[first]
+    stop_keys = stop_keys[next_stop]
+
+    frame_keys = start_keys // total
+    starts = start_keys % total + 1
+    ends = stop_keys % total + 3
+    return frame_keys // 3, starts, ends, frame_keys % 3
+
+
+def _find_cds(sequences, **kwargs):
+    """find_cds for use with a process pool."""
+    return find_cds(sequences, **kwargs)
+
+
+def find_cds_parallel(sequences, start_codons=('ATG',),
+                      stop_codons=('TAG', 'TAA', 'TGA'), threads=1,
+                      group_size=GROUP_SIZE):
+    """find_cds on groups of sequences (of about group_size bases each) in
+    a pool of processes. Returns the same arrays as find_cds.
+
+    """
+    groups = []
+    first = 0
+    bases = 0
+    for count, sequence in enumerate(sequences):
+        bases += len(sequence)
+        if bases >= group_size:
+            groups.append((first, count + 1))
+            first = count + 1
+            bases = 0
+    if first < len(sequences) or not groups:
+        groups.append((first, len(sequences)))
+
+    worker = functools.partial(
+        _find_cds, start_codons=start_codons, stop_codons=stop_codons)
+    jobs = [sequences[first:last] for first, last in groups]
+    if threads <= 1 or len(jobs) == 1:
+        results = [worker(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes=min(threads, len(jobs)))
+        try:
+            results = pool.map(worker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    # make sequence indexes relative to the full list again
+    columns = zip(*[(result[0] + first,) + tuple(result[1:])
+                    for (first, _), result in zip(groups, results)])
+    return tuple(np.concatenate(column) for column in columns)
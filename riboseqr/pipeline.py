@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""Run the riboSeqR steps in one R session.
+
+Runs Prepare riboSeqR input, Triplet periodicity, Metagene analysis and
+then Differential translation analysis and Plot ribosome profile, as the
+Galaxy workflow does, without starting R and loading riboSeqR for each
+step. Steps are run in the order of their dependencies (STEPS). The R
+objects of a step stay in memory for the next, R data files the session
+saved itself are not read again.
+
+Differential translation analysis and Plot ribosome profile only depend on
+Metagene analysis, they are run at the same time in forked processes that
+share the session's objects.
+
+Each step writes the same report, R data file and R script as when run on
+its own, in output_dir. Step options are read from a JSON file with one
+object of keyword arguments per step, for example::
+
+    {"prepare": {"ribo_files": "ribo1.sam,ribo2.sam",
+                 "rna_files": "rna1.sam,rna2.sam",
+                 "replicate_names": "WT,WT,M,M", "sam_format": true},
+     "triplet": {"fasta_file": "transcripts.fa"},
+     "metagene": {"selected_lengths": "27,28", "selected_frames": "1,0",
+                  "plot_lengths": "27,28"},
+     "difftrans": {"slice_lengths": "27,28", "frames": "0,2",
+                   "group1": "1,1,1,1", "group2": "WT,WT,M,M"},
+     "ribosome_profile": {"transcript_name": "CUFF.37930.1",
+                          "transcript_length": "27",
+                          "transcript_cap": "200"}}
+
+Steps without options are skipped, unless a later step depends on them.
+A step can start from an existing R data file instead, by giving its
+rdata_load option, e.g. {"ribosome_profile": {"rdata_load":
+"Metagene.rda", ...}}. The steps it depends on are then not run. Steps
+that are run need at least their REQUIRED_OPTIONS, this is checked before
+R is started.
+
+The pipeline always embeds R, it does not use an R worker (see rworker.py),
+which serves one step at a time.
+
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+import multiprocessing
+
+import utils
+import rworker
+import profiling
+import transcript_list
+
+R = None
+
+# (name, steps it depends on, R data file saved, HTML report)
+STEPS = (
+    ('prepare', (), 'Prepare.rda', 'Prepare-report.html'),
+    ('triplet', ('prepare',), 'Periodicity.rda', 'Periodicity-report.html'),
+    ('metagene', ('triplet',), 'Metagene.rda', 'Metagene-report.html'),
+    ('difftrans', ('metagene',), None, 'Counts.html'),
+    ('ribosome_profile', ('metagene',), None,
+     'Plot-ribosome-profile.html'))
+
+# Options without a usable default, by step
+REQUIRED_OPTIONS = {
+    'prepare': ('ribo_files',),
+    'triplet': ('fasta_file',)}
+
+# Objects saved by the last step stay in memory, its R data file is not
+# loaded again (see store.loadObjects)
+SESSION_FUNCTIONS = """.riboseqrSession <- new.env()
+
+.riboseqrLoad <- function(file) {
+    if (identical(normalizePath(file), .riboseqrSession$file)) {
+        if (!is.null(.riboseqrSession$store)) {
+            assign("riboseqrStore", .riboseqrSession$store,
+                   envir=globalenv())
+        }
+    } else {
+        load(file, envir=globalenv())
+    }
+    invisible(ls(globalenv()))
+}
+
+.riboseqrSaved <- function(file) {
+    .riboseqrSession$file <- normalizePath(file)
+    .riboseqrSession$store <- NULL
+    if (exists("riboseqrStore", envir=globalenv())) {
+        .riboseqrSession$store <- get("riboseqrStore", envir=globalenv())
+    }
+    invisible(NULL)
+}"""
+
+
+def start_session():
+    """Start the embedded R session shared by the steps."""
+    global R
+    if R is None:
+        # all steps use embedded R, not a worker
+        os.environ.pop(rworker.SOCKET_ENV, None)
+        R = rworker.connect()
+        R(SESSION_FUNCTIONS)
+
+
+def step_files(name, output_dir):
+    """Return (R data file loaded, R data file saved, HTML report, output
+    directory) of step name in output_dir.
+
+    """
+    steps = dict((step[0], step) for step in STEPS)
+    _, depends, rdata_save, html_file = steps[name]
+    rdata_load = None
+    if depends:
+        rdata_load = os.path.join(output_dir, steps[depends[0]][2])
+    if rdata_save:
+        rdata_save = os.path.join(output_dir, rdata_save)
+    return (rdata_load, rdata_save, os.path.join(output_dir, html_file),
+            os.path.join(output_dir, '{}_files'.format(name)))
+
+
+def run_step(name, options, output_dir):
+    """Run step name with options (keyword arguments of the step's
+    function). File names are set by the pipeline.
+
+    """
+    options = dict(options)
+    rdata_load, rdata_save, html_file, output_path = step_files(
+        name, output_dir)
+    if not os.path.exists(output_path):
+        os.mkdir(output_path)
+    options.update(html_file=html_file, output_path=output_path)
+    if rdata_load and 'rdata_load' not in options:
+        options['rdata_load'] = rdata_load
+    if rdata_save:
+        options['rdata_save'] = rdata_save
+    if isinstance(options.get('plot_formats'), str):
+        options['plot_formats'] = utils.process_formats(
+            options['plot_formats'])
+    logging.debug('Running {}: {}'.format(name, options))
+
+    # imported here, after the pipeline's session is started, the steps
+    # connect to R when imported
+    if name == 'prepare':
+        import prepare
+        prepare.generate_ribodata(**options)
+    elif name == 'triplet':
+        import triplet
+        triplet.find_periodicity(**options)
+    elif name == 'metagene':
+        import metagene
+        metagene.do_analysis(**options)
+    elif name == 'difftrans':
+        import difftrans
+        difftrans.get_counts(**options)
+    elif name == 'ribosome_profile':
+        run_ribosome_profile(**options)
+
+    if rdata_save:
+        R('.riboseqrSaved("{}")'.format(rdata_save))
+
+
+def run_ribosome_profile(transcript_name='', transcript_length='27',
+                         transcript_cap='', transcript_file=None, **options):
+    """Plot ribosome profiles of transcript_name (comma-separated) and the
+    transcripts in transcript_file, as Plot ribosome profile does.
+
+    """
+    transcripts = [(name, transcript_length, transcript_cap)
+                   for name in utils.process_args(
+                       transcript_name, ret_mode='list') or []]
+    if transcript_file:
+        transcripts += transcript_list.read_transcripts(
+            transcript_file, transcript_length=transcript_length,
+            transcript_cap=transcript_cap)
+    if not transcripts:
+        raise ValueError('No transcript to plot, set transcript_name or '
+                         'transcript_file')
+    import ribosome_profile
+    if len(transcripts) > 1 or transcript_file:
+        ribosome_profile.plot_transcripts(transcripts=transcripts, **options)
+    else:
+        options.pop('threads', None)
+        ribosome_profile.plot_transcript(
+            transcript_name=transcripts[0][0],
+            transcript_length=transcript_length,
+            transcript_cap=transcript_cap, **options)
+
+
+def _run_branch(name, options, output_dir):
+    """run_step in a forked process, exits with 1 if the step fails."""
+    try:
+        run_step(name, options, output_dir)
+    except Exception:
+        logging.exception('Step {} failed'.format(name))
+        sys.exit(1)
+
+
+def run_branches(names, config, output_dir, threads=1):
+    """Run steps that no other step depends on at the same time, each in a
+    forked copy of the session, sharing threads between them.
+
+    """
+    # Python 2 has no get_context, it always forks on POSIX
+    context = multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    processes = []
+    for name in names:
+        options = dict(config[name])
+        options.setdefault('threads', max(1, threads // len(names)))
+        process = context.Process(target=_run_branch,
+                                  args=(name, options, output_dir))
+        process.start()
+        processes.append((name, process))
+    failed = []
+    for name, process in processes:
+        process.join()
+        if process.exitcode:
+            failed.append(name)
+    if failed:
+        raise RuntimeError('Steps failed: {}'.format(', '.join(failed)))
+
+
+def select_steps(config):
+    """Return the names of the steps to run for config, in order, and a
+    dict of the steps each of them waits for. Steps given an rdata_load do
+    not wait for, or add, the steps they depend on.
+
+    Raises ValueError for unknown steps and for steps missing any of their
+    REQUIRED_OPTIONS.
+
+    """
+    unknown = set(config) - set(name for name, _, _, _ in STEPS)
+    if unknown:
+        raise ValueError('Unknown steps: {}'.format(', '.join(unknown)))
+    depends = dict((name, () if 'rdata_load' in config.get(name, {})
+                    else step_depends)
+                   for name, step_depends, _, _ in STEPS)
+    selected = set(config)
+    for name, _, _, _ in reversed(STEPS):
+        if name in selected:
+            selected.update(depends[name])
+    names = [name for name, _, _, _ in STEPS if name in selected]
+    for name in names:
+        missing = [option for option in REQUIRED_OPTIONS.get(name, ())
+                   if not config.get(name, {}).get(option)]
+        if missing:
+            message = 'Step {} needs the options: {}'.format(
+                name, ', '.join(missing))
+            needed_by = [other for other in names if name in depends[other]]
+            if needed_by:
+                message += (' (it is run before {}, which can be given an '
+                            'rdata_load instead)'.format(', '.join(needed_by)))
+            raise ValueError(message)
+    return names, depends
+
+
+def run_pipeline(config, output_dir, threads=1):
+    """Run the steps in config (a dict of step name -> options) and the
+    steps they depend on (see select_steps), saving all outputs in
+    output_dir.
+
+    """
+    pending, depends = select_steps(config)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    start_session()
+    done = set()
+    while pending:
+        ready = [name for name in pending if set(depends[name]) <= done]
+        # steps others depend on must run in the session itself
+        needed = [name for name in ready
+                  if any(name in depends[other] for other in pending)]
+        if needed or len(ready) == 1:
+            batch = (needed or ready)[:1]
+            options = dict(config.get(batch[0], {}))
+            options.setdefault('threads', threads)
+            run_step(batch[0], options, output_dir)
+        else:
+            batch = ready
+            run_branches(batch, config, output_dir, threads=threads)
+        done.update(batch)
+        pending = [name for name in pending if name not in done]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the riboSeqR steps in one R session')
+    flags = parser.add_argument_group('required arguments')
+    flags.add_argument('--config', required=True,
+                       help='JSON file with the options of each step')
+    flags.add_argument('--output_dir', required=True,
+                       help='Directory to save reports and R data files in')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of threads for each step, shared by steps run at the '
+             'same time (default: %(default)s)')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        help='Also measure the memory used by R objects in each command of '
+             'the steps, runs a garbage collection before and after it')
+    parser.add_argument('--debug', help='Produce debug output',
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(format='%(module)s: %(levelname)s - %(message)s',
+                            level=logging.DEBUG, stream=sys.stdout)
+        logging.debug('Supplied Arguments: {}'.format(vars(args)))
+
+    if args.profile_r_memory:
+        # read by the steps when they are imported
+        os.environ[profiling.R_MEMORY_ENV] = '1'
+
+    with open(args.config) as f:
+        config = json.load(f)
+    run_pipeline(config, args.output_dir, threads=args.threads)
+    logging.debug('Done')
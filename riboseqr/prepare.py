@@ -3,73 +3,265 @@ import os
 import sys
 import argparse
 import logging
-import rpy2.robjects as robjects
+import functools
+import collections
+import multiprocessing
 
 import utils
+import alignments
+import store
+import rworker
+import profiling
+import readstore
+
+R = rworker.connect()
+profile = profiling.Profile(R, r_memory=bool(
+    os.environ.get(profiling.R_MEMORY_ENV)) and not rworker.is_worker(R))
+run_rscript = profile.run_rscript
+
+# Build a GRanges object of reads from typed columns passed from Python
+READS_TO_GRANGES = """readsToGRanges <- function(seqnames, levels, starts, widths) {
+    GRanges(seqnames=structure(seqnames, levels=levels, class="factor"),
+            ranges=IRanges(start=starts + 1L, width=widths), strand="+")
+}"""
+
+# Build a GRanges object of reads from a collapsed riboSeqR format file
+# (strand, seqname, start, sequence, count), each distinct read repeated
+# count times (needs readsToGRanges)
+COLLAPSED_TO_GRANGES = """collapsedToGRanges <- function(file) {
+    reads <- read.delim(file, header=FALSE, colClasses=c(
+        "character", "character", "integer", "character", "integer"))
+    seqnames <- factor(reads[[2]])
+    readsToGRanges(as.integer(seqnames), levels(seqnames), reads[[3]],
+                   nchar(reads[[4]]))[rep(seq_len(nrow(reads)), reads[[5]])]
+}"""
+
+RIBO_DATA = ('riboDat <- new("riboData", riboGR=GRangesList({0}), '
+             'rnaGR=GRangesList({1}), replicates=factor({2}))')
+
+
+def read_alignments(sam_file, threads=1, seqnames=None, lengths=None):
+    """Yield chunks of (name, start, sequence) records from a SAM, gzipped
+    SAM or BAM format file.
+
+    BAM files are read directly with pysam, using threads for BGZF
+    decompression. Gzipped SAM files are decompressed as they are read.
+    Only reads on transcripts in seqnames and with a length in lengths are
+    kept (None keeps all).
 
-rscript = ''
-R = robjects.r
+    """
+    if utils.is_bam(sam_file):
+        chunks = alignments.read_bam(sam_file, threads=threads)
+        if seqnames is not None or lengths is not None:
+            chunks = alignments.filter_records(
+                chunks, seqnames=seqnames, lengths=lengths)
+        sam = None
+    else:
+        sam = utils.open_file(sam_file)
+        chunks = alignments.read_sam(sam, seqnames=seqnames, lengths=lengths)
+    try:
+        for records in chunks:
+            yield records
+    finally:
+        if sam is not None:
+            sam.close()
 
 
-def run_rscript(command=None):
-    """Run R command, log it, append to rscript"""
-    global rscript
-    if not command:
-        return
-    logging.debug(command)
-    rscript += '{}\n'.format(command)
-    output = R(command)
-    return output
+def prep_riboseqr_input(sam_file, output_file, threads=1, collapse=False,
+                        seqnames=None, lengths=None, compress=False):
+    """Generate input file for riboSeqR from SAM (or BAM) format file.
 
+    If compress is True, output is written gzip compressed using threads.
+    If collapse is True, identical reads are written once with their count
+    as an extra column. See read_alignments for the other arguments.
 
-def prep_riboseqr_input(sam_file, output_file):
-    """Generate input file for riboSeqR from SAM format file."""
-    with open(output_file, 'w') as f:
-        for line in open(sam_file):
-            if line.startswith('@'):
-                continue
-            line = line.split()
-            flag = line[1]
+    """
+    chunks = read_alignments(
+        sam_file, threads=threads, seqnames=seqnames, lengths=lengths)
+    with utils.open_output(
+            output_file, compress=compress, threads=threads) as output:
+        if collapse:
+            count = alignments.write_collapsed(chunks, output)
+        else:
+            count = alignments.write_riboseqr(chunks, output)
+    logging.debug('Wrote {} alignments to: {}'.format(count, output_file))
 
-            if flag != '0':
-                continue
-            # make start 0-indexed, sam alignments are 1-indexed
-            start = int(line[3]) - 1
-            (name, sequence) = (line[2], line[9])
-            f.write('"+"\t"{0}"\t{1}\t"{2}"\n'.format(name, start, sequence))
 
+def read_riboseqr_columns(sam_file, output_file=None, threads=1,
+                          collapse=False, seqnames=None, lengths=None,
+                          compress=False):
+    """Read SAM (or BAM) format file into typed columns (see
+    alignments.collect_columns) to be passed to R.
 
-def batch_process(sam_files, seq_type, output_path):
-    """Batch process the conversion of SAM format files -> riboSeqR format
-    input files.
+    If output_file is given, riboSeqR format input is also written to it in
+    the same pass, collapsed if collapse is True. See read_alignments for
+    the other arguments.
 
-    Files are saved with file names corresponding to their sequence type.
+    """
+    chunks = read_alignments(
+        sam_file, threads=threads, seqnames=seqnames, lengths=lengths)
+    if output_file is None:
+        return alignments.collect_columns(chunks)
+    with utils.open_output(
+            output_file, compress=compress, threads=threads) as output:
+        if not collapse:
+            return alignments.collect_columns(
+                alignments.write_chunks(chunks, output))
+        counts = collections.OrderedDict()
+        columns = alignments.collect_columns(
+            alignments.count_records(chunks, counts))
+        alignments.write_counts(counts, output)
+    return columns
+
+
+def _prep_riboseqr_input(job, **kwargs):
+    """Unpack a (sam_file, output_file[, lengths]) job for use with a
+    process pool."""
+    sam_file, output_file = job[:2]
+    if len(job) > 2:
+        kwargs['lengths'] = job[2]
+    logging.debug('Processing: {}'.format(sam_file))
+    logging.debug('Writing output to: {}'.format(output_file))
+    prep_riboseqr_input(sam_file, output_file, **kwargs)
+    return output_file
+
+
+def _read_riboseqr_columns(job, **kwargs):
+    """Unpack a (sam_file, output_file[, lengths]) job for use with a
+    process pool."""
+    sam_file, output_file = job[:2]
+    if len(job) > 2:
+        kwargs['lengths'] = job[2]
+    logging.debug('Reading: {}'.format(sam_file))
+    return read_riboseqr_columns(sam_file, output_file, **kwargs)
+
+
+def run_jobs(worker, jobs, threads=1, **kwargs):
+    """Run worker on each (sam_file, output_file) job, using a pool of
+    processes if more than one thread is requested. Jobs may have a third
+    item, the read lengths kept for that file (see
+    alignments.conversion_jobs).
+
+    Threads left over after one process per file are used for BAM
+    decompression and output compression. Other keyword arguments are
+    passed on to the worker. Results are returned in the same order as the
+    jobs.
+
+    """
+    jobs = list(jobs)
+    processes = min(threads, len(jobs))
+    worker = functools.partial(
+        worker, threads=max(1, threads // max(1, len(jobs))), **kwargs)
+    if processes <= 1:
+        return [worker(job) for job in jobs]
+
+    logging.debug('Processing {} SAM files using {} processes'.format(
+        len(jobs), processes))
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        results = pool.map(worker, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def write_read_store(path, ribo_seq_files, rna_seq_files, columns,
+                     replicate_names=''):
+    """Write the reads of the Ribo-Seq and RNA-Seq libraries to a read store
+    (see readstore.py). columns are the reads of each library (from
+    read_riboseqr_columns) by riboSeqR format file name, libraries are
+    named after these files.
+
+    """
+    libraries = [(os.path.basename(name), seq_type, columns[name])
+                 for files, seq_type in ((ribo_seq_files, 'riboseq'),
+                                         (rna_seq_files, 'rnaseq'))
+                 for name in files]
+    readstore.write_read_store(
+        path, libraries,
+        replicates=utils.process_args(replicate_names, ret_mode='list'))
+    logging.debug('Wrote read store: {}'.format(path))
+
+
+def output_file_names(sam_files, seq_type, output_path, compress=False):
+    """Return riboSeqR format file names for the given SAM files.
+
+    Files are named corresponding to their sequence type and position in
+    the input list (with a .gz extension if compressed).
 
     """
-    outputs = []
     prefix = '{}'
     if seq_type == 'riboseq':
         prefix = 'RiboSeq file {}'
     elif seq_type == 'rnaseq':
         prefix = 'RNASeq file {}'
+    if compress:
+        prefix += '.gz'
+    return [os.path.join(output_path, prefix.format(count + 1))
+            for count in range(len(sam_files))]
+
+
+def convert_sam_files(jobs, threads=1, **kwargs):
+    """Convert (sam_file, output_file) pairs, see run_jobs and
+    prep_riboseqr_input. Outputs are returned in the same order as the jobs.
+
+    """
+    return run_jobs(_prep_riboseqr_input, jobs, threads=threads, **kwargs)
+
+
+def batch_process(sam_files, seq_type, output_path, threads=1, **kwargs):
+    """Batch process the conversion of SAM format files -> riboSeqR format
+    input files.
 
-    for count, fname in enumerate(sam_files):
-        count += 1
-        out_file = os.path.join(output_path, prefix.format(count))
-        logging.debug('Processing: {}'.format(fname))
-        logging.debug('Writing output to: {}'.format(out_file))
-        prep_riboseqr_input(fname, out_file)
-        outputs.append(out_file)
-    return outputs
+    Files are saved with file names corresponding to their sequence type.
+
+    """
+    outputs = output_file_names(sam_files, seq_type, output_path,
+                                compress=kwargs.get('compress', False))
+    if seq_type != 'riboseq':
+        # footprint lengths, RNA-Seq reads of all lengths are kept
+        kwargs.pop('lengths', None)
+    return convert_sam_files(
+        zip(sam_files, outputs), threads=threads, **kwargs)
 
 
 def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
                       seqnames='', rdata_save='Prepare.rda', sam_format=True,
-                      html_file='Prepare-report.html', output_path=os.getcwd()):
+                      html_file='Prepare-report.html', output_path=os.getcwd(),
+                      threads=1, collapse=False, read_lengths='',
+                      compress=False, in_memory=False, export_files=True,
+                      store_dir=None, rdata_compress='none', read_store=None):
     """Prepares Ribo and RNA seq data in the format required for riboSeqR. Calls
     the readRibodata function of riboSeqR and saves the result objects in an
     R data file which can be used as input for the next step.
 
+    With threads > 1, all Ribo-Seq and RNA-Seq SAM files are converted at
+    the same time in a pool of processes. With collapse, the riboSeqR format
+    files have one line per distinct read and a count column. riboDat is
+    then built from these directly, each distinct read is repeated in R
+    instead of being written out once per read.
+
+    Reads on transcripts not in seqnames, and Ribo-Seq reads with a length
+    outside read_lengths (ex: 25:30), are dropped while the SAM files are
+    converted. RNA-Seq reads of all lengths are kept.
+
+    Gzipped SAM files are read directly. With compress, the riboSeqR format
+    files are written gzip compressed, R decompresses them when reading.
+
+    With in_memory, reads are passed to R as typed vectors and riboDat is
+    built from these instead of with readRibodata. riboSeqR format files
+    (collapsed with collapse) are then only written if export_files is
+    True, collapse cannot be used without them. This needs embedded R, with
+    an R worker (see rworker.py) the files are always used.
+
+    riboDat is saved in rdata_save, or in store_dir if given (see
+    store.py), with rdata_compress compression.
+
+    With read_store, the reads are also written to a per-transcript indexed
+    read store in that directory (see readstore.py), from the reads gathered
+    while the SAM files are converted, and its path is saved as readStore.
+
     """
     input_ribo_files = utils.process_args(ribo_files, ret_mode='list')
     logging.debug('Found {} Ribo-Seq files'.format(len(input_ribo_files)))
@@ -84,13 +276,67 @@ def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
     replicates = utils.process_args(replicate_names, ret_mode='charvector')
     logging.debug('Replicates: {}\n'.format(replicates))
 
+    if collapse and in_memory and not export_files:
+        raise ValueError('Reads can only be collapsed in the riboSeqR format '
+                         'files, which are not saved')
+
+    columns = None
     if sam_format:
-        ribo_seq_files = batch_process(input_ribo_files, 'riboseq', output_path)
+        seqname_filter = None
+        if seqnames:
+            seqname_filter = utils.process_args(seqnames, ret_mode='list')
+        length_filter = utils.process_lengths(read_lengths)
+        ribo_seq_files = output_file_names(
+            input_ribo_files, 'riboseq', output_path, compress=compress)
+        rna_seq_files = output_file_names(
+            input_rna_files, 'rnaseq', output_path, compress=compress)
+        if in_memory and rworker.is_worker(R):
+            logging.debug('Reads cannot be passed to an R worker in memory, '
+                          'using riboSeqR format files')
+            in_memory = False
+        if in_memory or read_store:
+            # reads are gathered while the files are converted
+            names = ribo_seq_files + rna_seq_files
+            outputs = names
+            if in_memory and not export_files:
+                outputs = [None] * len(names)
+            jobs = alignments.conversion_jobs(
+                zip(input_ribo_files, outputs[:len(input_ribo_files)]),
+                zip(input_rna_files, outputs[len(input_ribo_files):]),
+                lengths=length_filter)
+            with profile.measure('# read SAM/BAM files (alignments.py)'):
+                columns = dict(zip(names, run_jobs(
+                    _read_riboseqr_columns, jobs, threads=threads,
+                    collapse=collapse, seqnames=seqname_filter,
+                    compress=compress)))
+        else:
+            jobs = alignments.conversion_jobs(
+                zip(input_ribo_files, ribo_seq_files),
+                zip(input_rna_files, rna_seq_files), lengths=length_filter)
+            with profile.measure('# convert SAM/BAM files (alignments.py)'):
+                convert_sam_files(jobs, threads=threads, collapse=collapse,
+                                  seqnames=seqname_filter, compress=compress)
+        if read_store:
+            with profile.measure('# write read store (readstore.py)'):
+                write_read_store(read_store, ribo_seq_files, rna_seq_files,
+                                 columns, replicate_names=replicate_names)
+            if not in_memory:
+                # R reads the riboSeqR format files
+                columns = None
     else:
         ribo_seq_files = input_ribo_files
+        rna_seq_files = input_rna_files
+        # reads are only read in Python from SAM/BAM input
+        in_memory = False
+        if read_store:
+            logging.debug('The read store is only written from SAM/BAM input')
+            read_store = None
 
     html = '<h2>Prepare riboSeqR input - results</h2><hr>'
-    if len(ribo_seq_files):
+    if in_memory and not export_files:
+        html += '<p>Reads were passed to R directly, no riboSeqR format ' \
+                'input files were saved.</p>'
+    elif len(ribo_seq_files):
         html += '<h4>Generated riboSeqR format input files ' \
                 '<em>(RiboSeq)</em></h4><p>'
         for fname in ribo_seq_files:
@@ -98,15 +344,7 @@ def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
                 os.path.basename(fname))
         html += '</p>'
 
-    rna_seq_files = []
-    if len(input_rna_files):
-        if sam_format:
-            rna_seq_files = batch_process(
-                input_rna_files, 'rnaseq', output_path)
-        else:
-            rna_seq_files = input_rna_files
-
-    if len(rna_seq_files):
+    if len(rna_seq_files) and (not in_memory or export_files):
         html += ('<h4>Generated riboSeqR format input files '
                  '<em>(RNASeq)</em></h4><p>')
         for fname in rna_seq_files:
@@ -127,27 +365,70 @@ def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
     run_rscript(cmd)
     script += '{}\n'.format(cmd)
 
-    if len(rna_seq_files):
-        cmd_args = ('riboFiles={ribo_seq_files}, '
-                    'rnaFiles={rna_seq_files}'.format(**options))
+    if in_memory:
+        import rpy2.robjects as robjects
+        cmd = READS_TO_GRANGES
+        run_rscript(cmd)
+        script += '{}\n'.format(cmd)
+        reads_to_granges = R['readsToGRanges']
+        for key, names in (('riboReads', ribo_seq_files),
+                           ('rnaReads', rna_seq_files)):
+            reads = [reads_to_granges(
+                robjects.IntVector(columns[name][0]),
+                robjects.StrVector(columns[name][1]),
+                robjects.IntVector(columns[name][2]),
+                robjects.IntVector(columns[name][3])) for name in names]
+            robjects.globalenv[key] = R['setNames'](
+                R['list'](*reads),
+                robjects.StrVector([os.path.basename(name)
+                                    for name in names]))
+            script += ('# {0} - list of readsToGRanges() of reads passed '
+                       'from Python for: {1}\n'.format(
+                           key, ', '.join(names)))
+        cmd = RIBO_DATA.format('riboReads', 'rnaReads', replicates or 'c("")')
+        run_rscript(cmd)
+        script += '{}\n'.format(cmd)
+    elif sam_format and collapse:
+        # readRibodata has no count column
+        for cmd in (READS_TO_GRANGES, COLLAPSED_TO_GRANGES, RIBO_DATA.format(
+                'lapply({}, collapsedToGRanges)'.format(
+                    options['ribo_seq_files']),
+                'lapply({}, collapsedToGRanges)'.format(
+                    options['rna_seq_files']), replicates or 'c("")')):
+            run_rscript(cmd)
+            script += '{}\n'.format(cmd)
     else:
-        cmd_args = 'riboFiles={ribo_seq_files}'.format(**options)
+        if len(rna_seq_files):
+            cmd_args = ('riboFiles={ribo_seq_files}, '
+                        'rnaFiles={rna_seq_files}'.format(**options))
+        else:
+            cmd_args = 'riboFiles={ribo_seq_files}'.format(**options)
 
-    if input_seqnames:
-        cmd_args += ', seqnames={input_seqnames}'.format(**options)
-    if replicates:
-        cmd_args += ', replicates={input_replicates}'.format(**options)
-    else:
-        cmd_args += ', replicates=c("")'
-    cmd = 'riboDat <- readRibodata({0})'.format(cmd_args)
-    run_rscript(cmd)
-    script += '{}\n'.format(cmd)
+        if input_seqnames:
+            cmd_args += ', seqnames={input_seqnames}'.format(**options)
+        if replicates:
+            cmd_args += ', replicates={input_replicates}'.format(**options)
+        else:
+            cmd_args += ', replicates=c("")'
+        cmd = 'riboDat <- readRibodata({0})'.format(cmd_args)
+        run_rscript(cmd)
+        script += '{}\n'.format(cmd)
 
     ribo_data = R['riboDat']
     logging.debug('riboDat \n{}\n'.format(ribo_data))
-    cmd = 'save("riboDat", file="{}", compress=FALSE)'.format(rdata_save)
-    run_rscript(cmd)
-    script += '{}\n'.format(cmd)
+    names = ['riboDat']
+    if read_store:
+        cmd = 'readStore <- "{}"'.format(os.path.abspath(read_store))
+        run_rscript(cmd)
+        script += '{}\n'.format(cmd)
+        names.append('readStore')
+    for cmd in (store.STORE_FUNCTIONS, store.save_command(
+            names, rdata_save, store_dir=store_dir,
+            compress=rdata_compress, threads=threads)):
+        run_rscript(cmd)
+        script += '{}\n'.format(cmd)
+    if store_dir:
+        store.prune_store(store_dir)
 
     msg = '\n{:#^80}\n{}\n{:#^80}\n'.format(
         ' R script for this session ', script, ' End R script ')
@@ -156,6 +437,7 @@ def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
     with open(os.path.join(output_path, 'prepare.R'), 'w') as r:
         r.write(script)
 
+    html += profile.report(output_path, 'prepare')
     html += ('<h4>R script for this session</h4>'
              '<p><a href="prepare.R">prepare.R</a></p>'
              '<p>Next step: <em>Triplet periodicity</em></p>')
@@ -169,7 +451,8 @@ def generate_ribodata(ribo_files='', rna_files='', replicate_names='',
 if __name__ == '__main__':
 
     description = (
-        'Prepare riboSeqR input file from SAM format RNA/Ribo-Seq alignment.')
+        'Prepare riboSeqR input file from SAM/BAM format RNA/Ribo-Seq '
+        'alignment.')
     parser = argparse.ArgumentParser(description=description)
 
     # required arguments
@@ -188,10 +471,51 @@ if __name__ == '__main__':
                         default='Prepare.rda')
     parser.add_argument(
         '--sam_format',
-        help='Flag. Input is in SAM format', action='store_true')
+        help='Flag. Input is in SAM (or BAM) format', action='store_true')
     parser.add_argument('--html_file', help='Output file for results (HTML)')
     parser.add_argument('--output_path',
                         help='Files are saved in this directory')
+    parser.add_argument(
+        '--read_lengths',
+        help='Only keep Ribo-Seq reads of these lengths, ex: 25:30 or 27,28 '
+             '(default: all lengths, RNA-Seq reads of all lengths are kept)')
+    parser.add_argument(
+        '--in_memory', action='store_true',
+        help='Flag. Pass reads to R directly instead of through riboSeqR '
+             'format files')
+    parser.add_argument(
+        '--skip_export', action='store_true',
+        help='Flag. With --in_memory, do not save riboSeqR format files')
+    parser.add_argument(
+        '--compress', action='store_true',
+        help='Flag. Write gzip compressed riboSeqR format files')
+    parser.add_argument(
+        '--collapse', action='store_true',
+        help='Flag. Write identical reads once, with a count column')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of SAM files to convert in parallel, spare threads are '
+             'used for BAM decompression and output compression '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--store', default=os.environ.get(store.STORE_ENV),
+        help='Directory to save R objects in, shared by reference with the '
+             'next steps (default: ${}, objects are saved in the R data '
+             'file if not set)'.format(store.STORE_ENV))
+    parser.add_argument(
+        '--rdata_compress', choices=store.COMPRESSION, default='none',
+        help='Compression of the saved R data (default: %(default)s)')
+    parser.add_argument(
+        '--read_store',
+        help='Directory to also write the reads to, indexed by transcript '
+             '(used by Plot ribosome profile)')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        default=bool(os.environ.get(profiling.R_MEMORY_ENV)),
+        help='Also measure the memory used by R objects in each command, '
+             'runs a garbage collection before and after it (default: set '
+             'if ${} is set)'.format(profiling.R_MEMORY_ENV))
     parser.add_argument('--debug', help='Flag. Produce debug output',
                         action='store_true')
     args = parser.parse_args()
@@ -201,6 +525,12 @@ if __name__ == '__main__':
                             level=logging.DEBUG, stream=sys.stdout)
         logging.debug('Supplied Arguments: {}'.format(vars(args)))
 
+    profile.r_memory = args.profile_r_memory and not rworker.is_worker(R)
+
+    if args.collapse and args.in_memory and args.skip_export:
+        parser.error('--collapse only applies to the riboSeqR format files, '
+                     'which are not saved with --skip_export')
+
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
@@ -209,6 +539,10 @@ if __name__ == '__main__':
         replicate_names=args.replicate_names, seqnames=args.seqnames,
         rdata_save=args.rdata_save,
         sam_format=args.sam_format, html_file=args.html_file,
-        output_path=args.output_path
+        output_path=args.output_path, threads=args.threads,
+        collapse=args.collapse, read_lengths=args.read_lengths,
+        compress=args.compress, in_memory=args.in_memory,
+        export_files=not args.skip_export, store_dir=args.store,
+        rdata_compress=args.rdata_compress, read_store=args.read_store
     )
     logging.debug('Done')
@@ -0,0 +1,197 @@
+"""Timing and memory of the R commands run by a step.
+
+Each step runs its R commands through a Profile, which records for each
+command the wall time, the CPU time of this process and its child
+processes (embedded R, forked R processes and cluster workers once they
+exit), the highest resident memory of this process so far (max_rss_mb, a
+cumulative high-water mark) and, with embedded R, the maximum memory used by
+R objects while the command ran (from gc).
+
+On Linux the peak resident memory of this process is also reset before each
+command (see _reset_peak_rss), so the peak while the command ran is
+recorded too (peak_rss_mb). Forked R processes are not included in either.
+
+The profile is saved as JSON next to the step's R script and summarised in
+its HTML report. Measuring R memory runs a full garbage collection before
+and after each command, so it is only done if asked for (--profile_r_memory
+or R_MEMORY_ENV). With an R worker (see rworker.py) the commands run in the
+worker process, so only wall time is meaningful and R memory is not
+measured.
+
+The steps run their R commands with Profile.run_rscript, which also keeps
+the R script of the session.
+
+"""
+import os
+import json
+import time
+import logging
+import resource
+import contextlib
+from xml.sax.saxutils import escape
+
+# Number of characters of a command shown in the report
+LABEL_LENGTH = 60
+# Environment variable, if set the memory used by R objects is measured
+R_MEMORY_ENV = 'RIBOSEQR_PROFILE_R_MEMORY'
+# Writing 5 to this file resets the peak resident memory (VmHWM) of this
+# process to its current resident memory (Linux 4.0+)
+CLEAR_REFS = '/proc/self/clear_refs'
+STATUS = '/proc/self/status'
+
+
+def _cpu_time():
+    """Return the user + system CPU time of this process and its children."""
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _max_rss():
+    """Return the highest resident memory of this process in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _reset_peak_rss():
+    """Reset the peak resident memory of this process (VmHWM) to its
+    current resident memory. Returns False if this is not supported.
+
+    """
+    try:
+        with open(CLEAR_REFS, 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _peak_rss():
+    """Return the peak resident memory of this process (VmHWM) in MB,
+    since it was last reset.
+
+    """
+    with open(STATUS) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                # in kB
+                return int(line.split()[1]) / 1024.0
+
+
+def label(command):
+    """Return a short label for command - its first non-empty line."""
+    lines = [line.strip() for line in command.strip().splitlines()]
+    text = lines[0] if lines else ''
+    if len(text) > LABEL_LENGTH or len(lines) > 1:
+        text = text[:LABEL_LENGTH - 3].rstrip() + '...'
+    return text
+
+
+class Profile(object):
+    """Records of the R commands (and other work) of a step, and its R
+    script."""
+
+    def __init__(self, R=None, r_memory=False):
+        self.R = R
+        # measure the memory used by R objects (embedded R only)
+        self.r_memory = r_memory
+        self.records = []
+        self.script = ''
+        # ru_maxrss may drop once the peak is reset, keep the highest
+        self.max_rss = 0
+
+    @contextlib.contextmanager
+    def measure(self, name, r_memory=None):
+        """Record the time taken by the enclosed block as name. If
+        r_memory is embedded R, the maximum memory used by R objects is
+        recorded too (R's gc statistics are reset first).
+
+        """
+        if r_memory is not None:
+            r_memory('invisible(gc(reset=TRUE))')
+        self.max_rss = max(self.max_rss, _max_rss())
+        reset = _reset_peak_rss()
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield
+        finally:
+            record = {'command': name,
+                      'wall_seconds': round(time.time() - wall, 6),
+                      'cpu_seconds': round(_cpu_time() - cpu, 6)}
+            if reset:
+                peak = _peak_rss()
+                record['peak_rss_mb'] = round(peak, 1)
+                self.max_rss = max(self.max_rss, peak)
+            self.max_rss = max(self.max_rss, _max_rss())
+            record['max_rss_mb'] = round(self.max_rss, 1)
+            if r_memory is not None:
+                # "max used" (Mb) of Ncells and Vcells
+                record['r_max_used_mb'] = round(
+                    sum(r_memory('gc()')[10:12]), 1)
+            logging.debug('{wall_seconds:.3f}s wall, {cpu_seconds:.3f}s CPU'
+                          ''.format(**record))
+            self.records.append(record)
+
+    def run(self, R, command):
+        """Run command with R, recording it. Returns the output."""
+        with self.measure(command, R if self.r_memory else None):
+            return R(command)
+
+    def run_rscript(self, command=None):
+        """Run R command, log it, append to script, record its time and
+        memory"""
+        if not command:
+            return
+        logging.debug(command)
+        self.script += '{}\n'.format(command)
+        return self.run(self.R, command)
+
+    def total(self, key):
+        """Return the sum of key over the records."""
+        return sum(record.get(key, 0) for record in self.records)
+
+    def write(self, file_name):
+        """Save the records as JSON in file_name."""
+        with open(file_name, 'w') as f:
+            json.dump({'commands': self.records,
+                       'total_wall_seconds': round(
+                           self.total('wall_seconds'), 6),
+                       'total_cpu_seconds': round(
+                           self.total('cpu_seconds'), 6)}, f, indent=1)
+
+    def html_table(self):
+        """Return an HTML table of the records."""
+        optional = [(key, header) for key, header in (
+            ('peak_rss_mb', 'Peak memory of the command (MB)'),
+            ('r_max_used_mb', 'R max used (MB)'))
+            if any(key in record for record in self.records)]
+        html = ('<table border="1" cellpadding="4">\n<tr><th>Command</th>'
+                '<th>Wall time (s)</th><th>CPU time (s)</th>{}'
+                '<th>Max memory so far (MB)</th></tr>\n'.format(
+                    ''.join('<th>{}</th>'.format(header)
+                            for _, header in optional)))
+        for record in self.records:
+            html += ('<tr><td><code>{0}</code></td><td>{1:.2f}</td>'
+                     '<td>{2:.2f}</td>{3}<td>{4:.1f}</td></tr>\n'.format(
+                         escape(label(record['command'])),
+                         record['wall_seconds'], record['cpu_seconds'],
+                         ''.join('<td>{:.1f}</td>'.format(record[key])
+                                 if key in record else '<td></td>'
+                                 for key, _ in optional),
+                         record['max_rss_mb']))
+        html += ('<tr><th>Total</th><th>{0:.2f}</th><th>{1:.2f}</th>'
+                 '{2}<th></th></tr>\n</table>\n'.format(
+                     self.total('wall_seconds'), self.total('cpu_seconds'),
+                     '<th></th>' * len(optional)))
+        return html
+
+    def report(self, output_path, name):
+        """Save the records as name-profile.json in output_path and return
+        the HTML report section for them.
+
+        """
+        file_name = '{}-profile.json'.format(name)
+        self.write(os.path.join(output_path, file_name))
+        return ('<h4>Time and memory of the R commands</h4>\n{0}'
+                '<p>Download: <a href="{1}">{1}</a></p>\n'.format(
+                    self.html_table(), file_name))
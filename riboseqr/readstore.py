@@ -0,0 +1,131 @@
+"""Per-transcript indexed read store.
+
+Written by Prepare riboSeqR input, so later steps can read the reads of a
+few transcripts without loading riboDat. The store is a directory with an
+index (index.json - transcript names, libraries and replicates) and, for
+each library, fixed-width NumPy arrays of read starts (0-based) and widths
+sorted by transcript and start, and the offset of each transcript's first
+read. The arrays are memory-mapped, so a query only reads the pages holding
+that transcript's reads.
+
+"""
+import os
+import json
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INDEX_FILE = 'index.json'
+
+# Build a GRanges object of selected transcripts' reads passed from Python
+TRANSCRIPT_READS = """transcriptReads <- function(seqnames, levels, starts, widths) {
+    GRanges(seqnames=structure(seqnames, levels=levels, class="factor"),
+            ranges=IRanges(start=starts + 1L, width=widths), strand="+")
+}"""
+
+
+def _array_file(path, library, name):
+    return os.path.join(path, '{}.{}.npy'.format(library, name))
+
+
+def write_read_store(path, libraries, replicates=None):
+    """Write a read store to the directory path.
+
+    libraries is a list of (name, seq_type, columns) with seq_type 'riboseq'
+    or 'rnaseq' and columns as returned by alignments.collect_columns.
+
+    """
+    if np is None:
+        raise ImportError('numpy is required for the read store')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    seqnames = sorted(set(level for _, _, columns in libraries
+                          for level in columns[1]))
+    codes = dict((name, count) for count, name in enumerate(seqnames))
+    for count, (_, _, columns) in enumerate(libraries):
+        library_codes, levels, starts, widths = columns
+        # 1-based codes into levels -> index into seqnames
+        mapping = np.array([-1] + [codes[level] for level in levels],
+                           dtype=np.int64)
+        index = mapping[np.asarray(library_codes, dtype=np.int64)]
+        starts = np.asarray(starts, dtype=np.int32)
+        order = np.lexsort((starts, index))
+        offsets = np.zeros(len(seqnames) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(index, minlength=len(seqnames)))
+        np.save(_array_file(path, count, 'starts'), starts[order])
+        np.save(_array_file(path, count, 'widths'),
+                np.asarray(widths, dtype=np.uint16)[order])
+        np.save(_array_file(path, count, 'offsets'), offsets)
+    # the index is written last, a store without one is incomplete
+    with open(os.path.join(path, INDEX_FILE), 'w') as f:
+        json.dump({'seqnames': seqnames,
+                   'libraries': [{'name': name, 'seq_type': seq_type}
+                                 for name, seq_type, _ in libraries],
+                   'replicates': list(replicates or [])}, f)
+
+
+def is_read_store(path):
+    """Return True if path is a complete read store."""
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class ReadStore(object):
+    """Query a read store written by write_read_store."""
+
+    def __init__(self, path):
+        if np is None:
+            raise ImportError('numpy is required for the read store')
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.seqnames = index['seqnames']
+        self.libraries = index['libraries']
+        self.replicates = index['replicates']
+        self._codes = dict(
+            (name, count) for count, name in enumerate(self.seqnames))
+        self._arrays = [
+            [np.load(_array_file(path, count, name), mmap_mode='r')
+             for name in ('starts', 'widths', 'offsets')]
+            for count in range(len(self.libraries))]
+
+    def reads(self, library, seqname):
+        """Return (starts, widths) of the reads of library (index) on
+        seqname, sorted by start. Starts are 0-based.
+
+        """
+        starts, widths, offsets = self._arrays[library]
+        code = self._codes.get(seqname)
+        if code is None:
+            return starts[:0], widths[:0]
+        first, last = offsets[code], offsets[code + 1]
+        return starts[first:last], widths[first:last]
+
+    def select(self, seqnames, seq_type='riboseq'):
+        """Return a list of (library name, codes, starts, widths) of the
+        reads on any of seqnames in each library of seq_type. codes are
+        1-based indexes into seqnames, as in an R factor.
+
+        """
+        selected = []
+        for count, library in enumerate(self.libraries):
+            if library['seq_type'] != seq_type:
+                continue
+            columns = [self.reads(count, seqname) for seqname in seqnames]
+            codes = np.repeat(np.arange(1, len(seqnames) + 1),
+                              [len(starts) for starts, _ in columns])
+            selected.append((
+                library['name'], codes,
+                np.concatenate([starts for starts, _ in columns] or [[]]),
+                np.concatenate([widths for _, widths in columns] or [[]])))
+        return selected
+
+    def transcript(self, seqname, seq_type='riboseq'):
+        """Return a list of (library name, starts, widths) of the reads on
+        seqname in each library of seq_type.
+
+        """
+        return [(library['name'],) + self.reads(count, seqname)
+                for count, library in enumerate(self.libraries)
+                if library['seq_type'] == seq_type]
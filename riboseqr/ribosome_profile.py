@@ -1,40 +1,144 @@
 #!/usr/bin/env python
 import os
 import sys
-import glob
 import argparse
 import logging
-import rpy2.robjects as robjects
+import tempfile
 import utils
+import store
+import rworker
+import profiling
+import readstore
+import transcript_list
 
-rscript = ''
-R = robjects.r
+R = rworker.connect()
+profile = profiling.Profile(R, r_memory=bool(
+    os.environ.get(profiling.R_MEMORY_ENV)) and not rworker.is_worker(R))
+run_rscript = profile.run_rscript
 
 
-def run_rscript(command=None):
-    """Run R command, log it, append to rscript"""
-    global rscript
-    if not command:
-        return
-    logging.debug(command)
-    rscript += '{}\n'.format(command)
-    msg = R(command)
+def load_transcript_reads(transcript_names):
+    """Replace riboDat with a riboData object of only the reads on
+    transcript_names, read from the read store saved by Prepare riboSeqR
+    input (readStore), if there is one. Returns True if it did.
 
+    This needs embedded R, with an R worker riboDat is always used.
 
-def plot_transcript(rdata_load='Metagene.rda', transcript_name='',
-                    transcript_length='27', transcript_cap='',
-                    html_file='Plot-ribosome-profile.html',
-                    output_path=os.getcwd()):
-    """Plot ribosome profile for a given transcript. """
+    """
+    if rworker.is_worker(R) or not R('exists("readStore")')[0]:
+        return False
+    path = R['readStore'][0]
+    if readstore.np is None or not readstore.is_read_store(path):
+        logging.debug('Read store not available: {}'.format(path))
+        return False
+
+    import rpy2.robjects as robjects
+    reads = readstore.ReadStore(path)
+    run_rscript(readstore.TRANSCRIPT_READS)
+    transcript_reads = R['transcriptReads']
+    levels = robjects.StrVector(transcript_names)
+    for key, seq_type in (('riboReads', 'riboseq'), ('rnaReads', 'rnaseq')):
+        libraries = reads.select(transcript_names, seq_type)
+        robjects.globalenv[key] = R['setNames'](
+            R['list'](*[transcript_reads(
+                robjects.IntVector(codes.tolist()), levels,
+                robjects.IntVector(starts.tolist()),
+                robjects.IntVector(widths.tolist()))
+                for _, codes, starts, widths in libraries]),
+            robjects.StrVector([name for name, _, _, _ in libraries]))
+    profile.script += (
+        '# riboReads, rnaReads - transcriptReads() of the reads on {0} in '
+        'each library of the read store: {1}\n'.format(
+            ', '.join(transcript_names), path))
+    replicates = utils.process_args(
+        ','.join(reads.replicates), ret_mode='charvector')
+    run_rscript('riboDat <- new("riboData", riboGR=GRangesList(riboReads), '
+                'rnaGR=GRangesList(rnaReads), replicates=factor({0}))'.format(
+                    replicates or 'c("")'))
+    return True
+
+
+def plot_args(transcript, transcript_length, transcript_cap=''):
+    """Return the arguments of plotTranscript for a transcript - an R
+    expression of its name (ex: transcriptNames[[1]], see
+    transcript_list.r_strings).
+
+    """
     options = {}
     for key, value, rtype, rmode in (
-            ('transcript_name', transcript_name, 'str', None),
             ('transcript_length', transcript_length, 'int', 'charvector'),
             ('transcript_cap', transcript_cap, 'int', None)):
         options[key] = utils.process_args(value, ret_type=rtype, ret_mode=rmode)
+    cmd_args = (
+        '{0}, main={0}, coordinates=ffCDS, riboData=riboDat, '
+        'length={transcript_length}'.format(transcript, **options))
+    if transcript_cap:
+        cmd_args += ', cap={transcript_cap}'.format(**options)
+    return cmd_args
+
 
+def load_data(rdata_load):
+    """Load the objects plotTranscript needs from the Metagene R data."""
     run_rscript('suppressMessages(library(riboSeqR))')
-    run_rscript('load("{}")'.format(rdata_load))
+    run_rscript(store.STORE_FUNCTIONS)
+    # ffCDS (ffCs@CDS) is saved by Metagene analysis, ffCs is only read
+    # from the store for older R data files without it
+    run_rscript(store.load_command(
+        rdata_load, names=['ffCDS', 'ffCs', 'riboDat', 'readStore']))
+    run_rscript('if (!exists("ffCDS")) ffCDS <- ffCs@CDS')
+
+
+def write_report(html, html_file, output_path):
+    """Save the R script and profile of this session and the HTML
+    report.
+
+    """
+    logging.debug('\n{:#^80}\n{}\n{:#^80}\n'.format(
+        ' R script for this session ', profile.script, ' End R script '))
+
+    with open(os.path.join(output_path, 'ribosome-profile.R'), 'w') as r:
+        r.write(profile.script)
+
+    html += profile.report(output_path, 'ribosome-profile')
+    html += ('<h4>R script for this session</h4>\n'
+             '<p><a href="ribosome-profile.R">ribosome-profile.R</a></p>\n'
+             '</body>\n</html>\n')
+
+    with open(html_file, 'w') as f:
+        f.write(html)
+
+
+def render_plots(plots, threads=1):
+    """Draw plots (utils.render_plot commands) with threads forked R
+    processes. Returns the (files, error) of each plot, the files it wrote
+    (see utils.read_plot_manifest).
+
+    """
+    handle, manifest = tempfile.mkstemp(suffix='.tsv')
+    os.close(handle)
+    try:
+        run_rscript(utils.RENDER_PLOT)
+        run_rscript(utils.RENDER_PLOTS)
+        run_rscript(utils.render_plots(plots, manifest=manifest,
+                                       cores=threads))
+        return utils.read_plot_manifest(manifest, len(plots))
+    finally:
+        os.remove(manifest)
+
+
+def plot_transcript(rdata_load='Metagene.rda', transcript_name='',
+                    transcript_length='27', transcript_cap='',
+                    html_file='Plot-ribosome-profile.html',
+                    output_path=os.getcwd(), plot_formats=utils.PLOT_FORMATS):
+    """Plot ribosome profile for a given transcript. The plot is drawn once
+    and saved in each of plot_formats.
+
+    If Prepare riboSeqR input wrote a read store, only the reads on the
+    transcript are read from it (riboDat is not read if it is in the
+    object store, see store.py).
+
+    """
+    load_data(rdata_load)
 
     html = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2//EN">
     <html>
@@ -45,47 +149,81 @@ def plot_transcript(rdata_load='Metagene.rda', transcript_name='',
     """
     html += '<h2>Plot ribosome profile - results</h2>\n<hr>\n'
     if len(transcript_name):
-        cmd_args = (
-            '"{transcript_name}", main="{transcript_name}",'
-            'coordinates=ffCs@CDS, riboData=riboDat,'
-            'length={transcript_length}'.format(**options))
-        if transcript_cap:
-            cmd_args += ', cap={transcript_cap}'.format(**options)
+        transcript_list.check_transcript(
+            transcript_name, transcript_length, transcript_cap)
+        if load_transcript_reads([transcript_name]):
+            logging.debug('Using reads from the read store')
+        run_rscript('transcriptNames <- {}'.format(
+            transcript_list.r_strings([transcript_name])))
+        cmd_args = plot_args(
+            'transcriptNames[[1]]', transcript_length, transcript_cap)
         plot_file = os.path.join(output_path, 'Ribosome-profile-plot')
-        for fmat in ('pdf', 'png'):
-            if fmat == 'png':
-                cmd = 'png(file="{}_%1d.png", type="cairo")'.format(plot_file)
-            else:
-                cmd = 'pdf(file="{}.pdf")'.format(plot_file)
-            run_rscript(cmd)
-            cmd = 'plotTranscript({})'.format(cmd_args)
-            run_rscript(cmd)
-            run_rscript('dev.off()')
+        [(files, error)] = render_plots([utils.render_plot(
+            'plotTranscript({})'.format(cmd_args), plot_file, plot_formats)])
+        if error:
+            raise RuntimeError('Plot of {} failed: {}'.format(
+                transcript_name, error))
 
         html += ('<p>Selected ribosome footprint length: '
                  '<strong>{0}</strong>\n'.format(transcript_length))
 
-        for image in sorted(glob.glob('{}_*.png'.format(plot_file))):
+        # only the files written now, not those left by an earlier run
+        for image in [image for image in files if image.endswith('.png')]:
             html += '<p><img border="1" src="{0}" alt="{0}"></p>\n'.format(
                 os.path.basename(image))
-        html += '<p><a href="Ribosome-profile-plot.pdf">PDF version</a></p>\n'
+        for pdf in [pdf for pdf in files if pdf.endswith('.pdf')]:
+            html += '<p><a href="{0}">PDF version</a></p>\n'.format(
+                os.path.basename(pdf))
     else:
         msg = 'No transcript name was provided. Did not generate plot.'
         html += '<p>{}</p>'.format(msg)
         logging.debug(msg)
 
-    logging.debug('\n{:#^80}\n{}\n{:#^80}\n'.format(
-        ' R script for this session ', rscript, ' End R script '))
+    write_report(html, html_file, output_path)
 
-    with open(os.path.join(output_path, 'ribosome-profile.R'), 'w') as r:
-        r.write(rscript)
 
-    html += ('<h4>R script for this session</h4>\n'
-             '<p><a href="ribosome-profile.R">ribosome-profile.R</a></p>\n'
-             '</body>\n</html>\n')
+def plot_transcripts(rdata_load='Metagene.rda', transcripts=(),
+                     html_file='Plot-ribosome-profile.html',
+                     output_path=os.getcwd(), plot_formats=utils.PLOT_FORMATS,
+                     threads=1):
+    """Plot ribosome profiles of many transcripts - a list of (name, length,
+    cap) - loading the data once. Plots are drawn by threads forked R
+    processes and listed in one HTML report with an index.
 
-    with open(html_file, 'w') as f:
-        f.write(html)
+    """
+    for transcript in transcripts:
+        transcript_list.check_transcript(*transcript)
+    load_data(rdata_load)
+    if load_transcript_reads(sorted(set(name for name, _, _ in transcripts))):
+        logging.debug('Using reads from the read store')
+
+    run_rscript('transcriptNames <- {}'.format(
+        transcript_list.r_strings([name for name, _, _ in transcripts])))
+    plots = []
+    for count, (_, length, cap) in enumerate(transcripts):
+        plots.append(utils.render_plot(
+            'plotTranscript({})'.format(plot_args(
+                'transcriptNames[[{}]]'.format(count + 1), length, cap)),
+            os.path.join(output_path, 'Ribosome-profile-plot{}'.format(
+                count + 1)), plot_formats))
+    # read stored objects once, before forking
+    run_rscript('invisible(list(ffCDS, riboDat))')
+    rendered = render_plots(plots, threads=threads)
+    for (name, _, _), (_, error) in zip(transcripts, rendered):
+        if error:
+            logging.debug('{}: {}'.format(name, error))
+
+    html = """<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2//EN">
+    <html>
+    <head>
+    <title>Ribosome Profile Plot - Report</title>
+    </head>
+    <body>
+    """
+    html += '<h2>Plot ribosome profile - results</h2>\n<hr>\n'
+    html += transcript_list.batch_report(transcripts, rendered)
+
+    write_report(html, html_file, output_path)
 
 
 if __name__ == '__main__':
@@ -95,8 +233,6 @@ if __name__ == '__main__':
     flags = parser.add_argument_group('required arguments')
     flags.add_argument('--rdata_load', required=True,
                        help='Saved riboSeqR data from Step 2')
-    flags.add_argument('--transcript_name', required=True,
-                       help='Name of the transcript to be plotted')
     flags.add_argument(
         '--transcript_length', required=True,
         help='Size class of ribosome footprint data to be plotted',
@@ -105,8 +241,32 @@ if __name__ == '__main__':
         '--transcript_cap', required=True,
         help=('Cap on the largest value that will be plotted as an abundance '
               'of the ribosome footprint data'))
+    parser.add_argument(
+        '--transcript_name',
+        help='Name of the transcript to be plotted. Multiple names should be '
+             'comma-separated')
+    parser.add_argument(
+        '--transcript_file',
+        help='File of transcripts to be plotted, one name per line with an '
+             'optional length and cap')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of R processes plotting transcripts in parallel '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--plot_formats', type=utils.process_formats,
+        default=','.join(utils.PLOT_FORMATS),
+        help='Comma-separated formats to save plots in (default: '
+             '%(default)s)')
     parser.add_argument('--html_file', help='HTML file with reports')
     parser.add_argument('--output_path', help='Directory to save output files')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        default=bool(os.environ.get(profiling.R_MEMORY_ENV)),
+        help='Also measure the memory used by R objects in each command, '
+             'runs a garbage collection before and after it (default: set '
+             'if ${} is set)'.format(profiling.R_MEMORY_ENV))
     parser.add_argument('--debug', help='Produce debug output',
                         action='store_true')
 
@@ -116,12 +276,38 @@ if __name__ == '__main__':
                             level=logging.DEBUG, stream=sys.stdout)
         logging.debug('Supplied Arguments\n{}\n'.format(vars(args)))
 
+    profile.r_memory = args.profile_r_memory and not rworker.is_worker(R)
+
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
-    plot_transcript(rdata_load=args.rdata_load,
-                    transcript_name=args.transcript_name,
-                    transcript_length=args.transcript_length,
-                    transcript_cap=args.transcript_cap,
-                    html_file=args.html_file, output_path=args.output_path)
+    transcripts = [(name, args.transcript_length, args.transcript_cap)
+                   for name in utils.process_args(
+                       args.transcript_name, ret_mode='list') or []]
+    try:
+        for transcript in transcripts:
+            transcript_list.check_transcript(*transcript)
+        if args.transcript_file:
+            transcripts += transcript_list.read_transcripts(
+                args.transcript_file,
+                transcript_length=args.transcript_length,
+                transcript_cap=args.transcript_cap)
+    except ValueError as e:
+        parser.error(str(e))
+    if not transcripts:
+        parser.error('--transcript_name or --transcript_file is required')
+
+    if len(transcripts) > 1 or args.transcript_file:
+        plot_transcripts(rdata_load=args.rdata_load, transcripts=transcripts,
+                         html_file=args.html_file,
+                         output_path=args.output_path,
+                         plot_formats=args.plot_formats, threads=args.threads)
+    else:
+        plot_transcript(rdata_load=args.rdata_load,
+                        transcript_name=args.transcript_name or '',
+                        transcript_length=args.transcript_length,
+                        transcript_cap=args.transcript_cap,
+                        html_file=args.html_file,
+                        output_path=args.output_path,
+                        plot_formats=args.plot_formats)
     logging.debug('Done!')
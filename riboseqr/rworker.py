@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""Persistent R worker shared across the riboSeqR steps.
+
+A worker process embeds R (through rpy2) and evaluates R commands sent to
+it over a Unix socket. Attached libraries stay loaded between steps and R
+data files are loaded once and then reused (until the file changes).
+
+Start a worker with::
+
+    python riboseqr/rworker.py --socket /tmp/riboseqr.sock
+
+and set ``RIBOSEQR_R_WORKER=/tmp/riboseqr.sock`` for the steps to use it.
+If the variable is not set, the worker is not running or it is busy with
+another step (it serves one step at a time), the steps embed R as before.
+
+The worker evaluates any R code sent to it, so only its owner can use it:
+the socket is only readable and writable by the owner, connections from
+other users are refused and steps do not use a socket owned by another
+user.
+
+"""
+import os
+import sys
+import json
+import stat
+import struct
+import socket
+import argparse
+import logging
+
+# Environment variable with the path of the worker socket
+SOCKET_ENV = 'RIBOSEQR_R_WORKER'
+# Maximum number of loaded R data files kept by the worker
+MAX_CACHED_FILES = 4
+# Seconds a step waits for the worker before using embedded R
+CONNECT_TIMEOUT = 5
+
+WORKER_FUNCTIONS = """
+.riboseqrWorker <- new.env()
+.riboseqrWorker$cache <- list()
+
+.riboseqrReset <- function(path) {
+    rm(list=ls(envir=globalenv()), envir=globalenv())
+    graphics.off()
+    setwd(path)
+    invisible(NULL)
+}
+
+# used by loadObjects (see store.py)
+.riboseqrLoad <- function(file) {
+    info <- file.info(file)
+    key <- paste(normalizePath(file), info$size, as.numeric(info$mtime))
+    cached <- .riboseqrWorker$cache[[key]]
+    if (is.null(cached)) {
+        cached <- new.env()
+        load(file, envir=cached)
+    }
+    # most recently used last, the first ones are dropped
+    .riboseqrWorker$cache[[key]] <- NULL
+    .riboseqrWorker$cache[[key]] <- cached
+    .riboseqrWorker$cache <- tail(.riboseqrWorker$cache, %d)
+    for (name in ls(cached)) {
+        assign(name, get(name, envir=cached), envir=globalenv())
+    }
+    invisible(ls(cached))
+}
+
+# logical, integer, double and character vectors are sent as their type,
+# a string of NA flags and their elements, other values as printed text
+.riboseqrValue <- function(value) {
+    if (is.null(dim(value)) && (is.logical(value) || is.numeric(value) ||
+                                is.character(value))) {
+        na <- is.na(value)
+        if (is.double(value)) {
+            text <- sprintf("%%.17g", value)
+        } else {
+            text <- as.character(value)
+        }
+        text[na] <- ""
+        return(c(typeof(value), paste(as.integer(na), collapse=""), text))
+    }
+    c("text", "", paste(capture.output(print(value)), collapse="\\n"))
+}
+
+.riboseqrEval <- function(command) {
+    tryCatch({
+        result <- withVisible(eval(parse(text=command), envir=globalenv()))
+        if (result$visible) {
+            c("ok", .riboseqrValue(result$value))
+        } else {
+            c("ok", "text", "", "")
+        }
+    }, error=function(e) c("error", conditionMessage(e)))
+}
+
+.riboseqrGet <- function(name) {
+    if (!exists(name, envir=globalenv())) {
+        return(c("missing", ""))
+    }
+    c("ok", .riboseqrValue(get(name, envir=globalenv())))
+}
+""" % MAX_CACHED_FILES
+
+
+# Conversion of the elements of vectors sent by the worker, by R type
+VALUE_TYPES = {
+    'logical': lambda text: text == 'TRUE',
+    'integer': int,
+    'double': float,
+    'character': lambda text: text}
+
+
+class RWorkerError(Exception):
+    """Error evaluating an R command in the worker."""
+
+
+def decode_value(value):
+    """Return a value sent by the worker (see .riboseqrValue): a list for
+    logical, integer, double and character vectors (None for NA), so that
+    value[0] works as with rpy2's vectors, or the printed text of other
+    values.
+
+    """
+    kind, na, elements = value[0], value[1], value[2:]
+    if kind == 'text':
+        return elements[0]
+    convert = VALUE_TYPES[kind]
+    return [None if flag == '1' else convert(element)
+            for flag, element in zip(na, elements)]
+
+
+def check_socket(socket_path):
+    """Raise RWorkerError if socket_path is not a socket owned by this
+    user.
+
+    """
+    info = os.stat(socket_path)
+    if not stat.S_ISSOCK(info.st_mode):
+        raise RWorkerError('Not a socket: {}'.format(socket_path))
+    if info.st_uid != os.getuid():
+        raise RWorkerError(
+            'R worker socket is owned by another user: {}'.format(
+                socket_path))
+
+
+def peer_uid(connection):
+    """Return the user id of the process connected to a Unix socket, or
+    None if it is not known (SO_PEERCRED is Linux only).
+
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', credentials)
+    return uid
+
+
+class RWorkerClient(object):
+    """Evaluate R commands in a running worker.
+
+    Used like rpy2's robjects.r - calling it with a command evaluates the
+    command and indexing it with a name looks up an R object. Logical,
+    numeric and character vectors are returned as lists, other values as
+    their printed (text) representation (see decode_value).
+
+    """
+
+    def __init__(self, socket_path, timeout=CONNECT_TIMEOUT):
+        check_socket(socket_path)
+        self.socket_path = socket_path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the worker only answers once it is done with other steps
+            self._socket.settimeout(timeout)
+            self._socket.connect(socket_path)
+            self._stream = self._socket.makefile('rw')
+            self._request({'reset': os.getcwd()})
+        except socket.timeout:
+            self._socket.close()
+            raise RWorkerError('R worker is busy: {}'.format(socket_path))
+        except Exception:
+            self._socket.close()
+            raise
+        # R commands can take any time
+        self._socket.settimeout(None)
+
+    def _request(self, request):
+        self._stream.write(json.dumps(request) + '\n')
+        self._stream.flush()
+        line = self._stream.readline()
+        if not line:
+            raise RWorkerError(
+                'R worker closed the connection: {}'.format(self.socket_path))
+        response = json.loads(line)
+        return response[0], response[1:]
+
+    def __call__(self, command):
+        status, value = self._request({'command': command})
+        if status == 'error':
+            raise RWorkerError(value[0])
+        return decode_value(value)
+
+    def __getitem__(self, name):
+        status, value = self._request({'get': name})
+        if status == 'missing':
+            raise LookupError("'{}' not found".format(name))
+        return decode_value(value)
+
+    def close(self):
+        self._stream.close()
+        self._socket.close()
+
+
+def connect(socket_path=None):
+    """Return a client for the R worker at socket_path (default: from the
+    RIBOSEQR_R_WORKER environment variable), or rpy2's embedded R if no
+    worker is running.
+
+    """
+    socket_path = socket_path or os.environ.get(SOCKET_ENV)
+    if socket_path:
+        try:
+            client = RWorkerClient(socket_path)
+            logging.debug('Using R worker: {}'.format(socket_path))
+            return client
+        except (IOError, OSError, RWorkerError) as e:
+            logging.debug('R worker not available ({}), using embedded '
+                          'R'.format(e))
+    import rpy2.robjects as robjects
+    return robjects.r
+
+
+def is_worker(r):
+    """Return True if r is a client of an R worker (not embedded R)."""
+    return isinstance(r, RWorkerClient)
+
+
+def handle(connection, R):
+    """Answer requests from one client until it disconnects. Returns False
+    if the worker was asked to stop.
+
+    """
+    uid = peer_uid(connection)
+    if uid is not None and uid != os.getuid():
+        logging.warning('Refused connection from user {}'.format(uid))
+        return True
+    # separate streams, writing to a text 'rw' stream drops buffered input
+    reader, stream = connection.makefile('r'), connection.makefile('w')
+    try:
+        for line in reader:
+            request = json.loads(line)
+            if 'stop' in request:
+                stream.write(json.dumps(['ok', '']) + '\n')
+                stream.flush()
+                return False
+            try:
+                if 'reset' in request:
+                    R['.riboseqrReset'](request['reset'])
+                    response = ['ok', '']
+                elif 'get' in request:
+                    response = list(R['.riboseqrGet'](request['get']))
+                else:
+                    logging.debug(request['command'])
+                    response = list(R['.riboseqrEval'](request['command']))
+            except Exception as e:
+                response = ['error', str(e)]
+            stream.write(json.dumps(response) + '\n')
+            stream.flush()
+    except (IOError, OSError) as e:
+        # a step that gave up waiting for the worker has gone
+        logging.debug('Client disconnected: {}'.format(e))
+    return True
+
+
+def bind(socket_path):
+    """Return a server socket bound to socket_path, only accessible by this
+    user. A stale socket left by a worker that is no longer running is
+    replaced, any other file is not.
+
+    """
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise RWorkerError('Not a socket: {}'.format(socket_path))
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except (IOError, OSError):
+            os.remove(socket_path)
+        else:
+            raise RWorkerError(
+                'R worker already running: {}'.format(socket_path))
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+    return server
+
+
+def serve(socket_path):
+    """Run a worker on socket_path, one client at a time, until stopped."""
+    import rpy2.robjects as robjects
+    R = robjects.r
+    R(WORKER_FUNCTIONS)
+
+    server = bind(socket_path)
+    server.listen(1)
+    logging.debug('R worker listening on: {}'.format(socket_path))
+    try:
+        running = True
+        while running:
+            connection, _ = server.accept()
+            try:
+                running = handle(connection, R)
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def stop(socket_path):
+    """Stop the worker running on socket_path."""
+    check_socket(socket_path)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    stream = client.makefile('rw')
+    stream.write(json.dumps({'stop': True}) + '\n')
+    stream.flush()
+    stream.readline()
+    client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Persistent R worker for the riboSeqR steps')
+    parser.add_argument(
+        '--socket', default=os.environ.get(SOCKET_ENV),
+        help='Path of the Unix socket (default: ${})'.format(SOCKET_ENV))
+    parser.add_argument('--stop', action='store_true',
+                        help='Flag. Stop a running worker')
+    parser.add_argument('--debug', help='Produce debug output',
+                        action='store_true')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('--socket is required')
+
+    if args.debug:
+        logging.basicConfig(format='%(module)s: %(levelname)s - %(message)s',
+                            level=logging.DEBUG, stream=sys.stdout)
+
+    if args.stop:
+        stop(args.socket)
+    else:
+        serve(args.socket)
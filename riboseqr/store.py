@@ -0,0 +1,265 @@
+"""Intermediate R data passed between the riboSeqR steps.
+
+By default each step saves its R objects in one R data file, as before.
+With a store directory, each object a step changed is saved once as an RDS
+file in the store and the R data file only holds the objects that were not
+stored and riboseqrStore, a named character vector of the RDS files of the
+others. Objects a step loaded and did not change (riboDat, fastaCDS) are
+not written again, the new R data file refers to the same RDS file.
+
+R data and RDS files can be compressed (gzip, bzip2 or xz). gzip
+compression uses pigz with more than one thread if it is available, and
+stored objects are decompressed with pigz in a separate process.
+
+riboseqrStore is the index of the objects in a store - steps only load the
+objects they use, and stored objects are only read when first used.
+
+Stored objects are shared by reference, the store must be kept for as long
+as the R data files referring to it are used. Loading an R data file whose
+stored objects are gone stops with an error naming the missing files.
+
+Each save also writes a .refs file to the store, with the path of the R data
+file and the RDS files it refers to. prune_store removes the objects that no
+R data file refers to any more - R data files that were deleted or saved
+again - so R data files must stay where the step wrote them.
+
+"""
+import os
+import time
+import uuid
+
+import utils
+
+# Environment variable with the path of the store directory
+STORE_ENV = 'RIBOSEQR_STORE'
+# Compression of R data and RDS files
+COMPRESSION = ('none', 'gzip', 'bzip2', 'xz')
+# Suffix of the files listing the stored objects an R data file refers to
+REFS_SUFFIX = '.refs'
+# Files written less than this many seconds ago are never pruned (a step
+# may still be saving them)
+PRUNE_GRACE = 3600
+
+STORE_FUNCTIONS = """isGzip <- function(file) {
+    identical(readBin(file, "raw", 2L), as.raw(c(0x1f, 0x8b)))
+}
+
+readObject <- function(file, decompress=NULL) {
+    if (!file.exists(file)) {
+        stop("Stored object not found: ", file, " (the store directory ",
+             "was removed or moved)")
+    }
+    if (is.null(decompress) || !isGzip(file)) {
+        return(readRDS(file))
+    }
+    con <- pipe(paste(decompress, shQuote(file)), "rb")
+    on.exit(close(con))
+    readRDS(con)
+}
+
+writeObject <- function(object, file, compress=FALSE, command=NULL) {
+    tmp <- paste0(file, ".", Sys.getpid(), ".tmp")
+    if (is.null(command)) {
+        saveRDS(object, file=tmp, compress=compress)
+    } else {
+        con <- pipe(paste(command, ">", shQuote(tmp)), "wb")
+        saveRDS(object, file=con)
+        close(con)
+    }
+    file.rename(tmp, file)
+}
+
+loadObjects <- function(file, names=NULL, decompress=NULL) {
+    if (exists("riboseqrStore", envir=globalenv())) {
+        rm("riboseqrStore", envir=globalenv())
+    }
+    objects <- new.env()
+    if (exists(".riboseqrLoad", mode="function")) {
+        .riboseqrLoad(file)
+        for (name in ls(globalenv())) {
+            assign(name, get(name, envir=globalenv()), envir=objects)
+        }
+    } else {
+        load(file, envir=objects)
+    }
+    stored <- character(0)
+    if (exists("riboseqrStore", envir=objects)) {
+        stored <- get("riboseqrStore", envir=objects)
+        assign("riboseqrStore", stored, envir=globalenv())
+    }
+    if (is.null(names)) {
+        names <- union(setdiff(ls(objects), "riboseqrStore"), names(stored))
+    }
+    missing <- setdiff(intersect(names, names(stored)), ls(objects))
+    missing <- missing[!file.exists(stored[missing])]
+    if (length(missing) > 0) {
+        stop(file, " refers to objects in a store directory that was ",
+             "removed or moved, keep the store while its R data files are ",
+             "used. Missing: ", paste(stored[missing], collapse=", "))
+    }
+    for (name in names) {
+        if (exists(name, envir=objects, inherits=FALSE)) {
+            # loaded, or still in memory in a pipeline session
+            assign(name, get(name, envir=objects), envir=globalenv())
+        } else if (name %in% names(stored)) {
+            # read only when first used
+            local({
+                path <- stored[[name]]
+                delayedAssign(name, readObject(path, decompress),
+                              assign.env=globalenv())
+            })
+        }
+    }
+    invisible(names)
+}
+
+saveObjects <- function(names, file, store=NULL, changed=names, prefix="",
+                        compress=FALSE, command=NULL) {
+    names <- names[vapply(names, exists, logical(1), envir=globalenv())]
+    objects <- new.env()
+    stored <- character(0)
+    if (!is.null(store)) {
+        dir.create(store, showWarnings=FALSE, recursive=TRUE)
+        previous <- character(0)
+        if (exists("riboseqrStore", envir=globalenv())) {
+            previous <- get("riboseqrStore", envir=globalenv())
+        }
+        for (name in names) {
+            if (!(name %in% changed) && name %in% names(previous) &&
+                    file.exists(previous[[name]])) {
+                stored[[name]] <- previous[[name]]
+            } else {
+                stored[[name]] <- file.path(
+                    store, paste0(prefix, name, ".rds"))
+                writeObject(get(name, envir=globalenv()), stored[[name]],
+                            compress, command)
+            }
+        }
+        assign("riboseqrStore", stored, envir=objects)
+        # references of this R data file, see prune_store (store.py)
+        writeLines(c(file.path(normalizePath(dirname(file)), basename(file)),
+                     stored), file.path(store, paste0(prefix, "objects.refs")))
+        # later saves in the same session refer to the same files
+        assign("riboseqrStore", stored, envir=globalenv())
+        names <- setdiff(names, names(stored))
+    }
+    for (name in names) {
+        assign(name, get(name, envir=globalenv()), envir=objects)
+    }
+    if (is.null(command)) {
+        save(list=ls(objects), envir=objects, file=file, compress=compress)
+    } else {
+        con <- pipe(paste(command, ">", shQuote(file)), "wb")
+        save(list=ls(objects), envir=objects, file=con)
+        close(con)
+    }
+    invisible(names(stored))
+}"""
+
+
+def _r_string(value):
+    return 'NULL' if value is None else '"{}"'.format(value)
+
+
+def _r_strings(values):
+    return 'c({})'.format(', '.join('"{}"'.format(value) for value in values))
+
+
+def compress_command(compress='none', threads=1):
+    """Return the shell command used to gzip compress with threads (pigz),
+    or None if R should compress itself.
+
+    """
+    if compress == 'gzip' and threads > 1 and utils.find_executable('pigz'):
+        return 'pigz -p {} -c'.format(threads)
+    return None
+
+
+def decompress_command():
+    """Return the shell command used to decompress gzipped objects (pigz),
+    or None if R should decompress them itself.
+
+    """
+    if utils.find_executable('pigz'):
+        return 'pigz -dc'
+    return None
+
+
+def load_command(file_name, names=None):
+    """Return the R command that loads the objects saved in file_name
+    (STORE_FUNCTIONS must be run first).
+
+    Only the objects in names (default: all) are loaded, names not in the
+    file are skipped. Stored objects are read from the store when they are
+    first used.
+
+    """
+    args = ['"{}"'.format(file_name)]
+    if names:
+        args.append('names={}'.format(_r_strings(names)))
+    args.append('decompress={}'.format(_r_string(decompress_command())))
+    return 'loadObjects({})'.format(', '.join(args))
+
+
+def save_command(names, file_name, store_dir=None, changed=None,
+                 compress='none', threads=1):
+    """Return the R command that saves the objects in names to file_name
+    (STORE_FUNCTIONS must be run first). Names of objects that do not exist
+    are skipped.
+
+    With store_dir, objects are saved in the store. Only objects in changed
+    (default: all) are written, the others keep referring to the RDS file
+    they were loaded from. Run prune_store after saving to remove the
+    objects no longer used.
+
+    """
+    if compress not in COMPRESSION:
+        raise ValueError('Unknown compression: {}'.format(compress))
+    args = [_r_strings(names), 'file="{}"'.format(file_name)]
+    if store_dir:
+        args.append('store="{}"'.format(os.path.abspath(store_dir)))
+        args.append('changed={}'.format(
+            _r_strings(names if changed is None else changed)))
+        args.append('prefix="{}-"'.format(uuid.uuid4().hex[:16]))
+    args.append('compress={}'.format(
+        'FALSE' if compress == 'none' else '"{}"'.format(compress)))
+    command = compress_command(compress, threads)
+    if command:
+        args.append('command="{}"'.format(command))
+    return 'saveObjects({})'.format(', '.join(args))
+
+
+def prune_store(store_dir, grace=PRUNE_GRACE):
+    """Remove the objects in store_dir that no R data file refers to.
+
+    An R data file refers to the objects listed in the newest .refs file
+    written for it, if it still exists. Older .refs files of the same R data
+    file and those of deleted R data files are removed. Files modified in
+    the last grace seconds are kept.
+
+    """
+    now = time.time()
+    refs = {}
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if name.endswith(REFS_SUFFIX):
+            with open(path) as f:
+                lines = f.read().splitlines()
+            if lines:
+                refs.setdefault(lines[0], []).append(
+                    (os.stat(path).st_mtime, path, lines[1:]))
+    used = set()
+    for rdata_file, entries in refs.items():
+        entries.sort()
+        exists = os.path.exists(rdata_file)
+        for count, (mtime, path, objects) in enumerate(entries):
+            if now - mtime < grace or (exists and count == len(entries) - 1):
+                used.update(os.path.abspath(obj) for obj in objects)
+            else:
+                os.remove(path)
+    for name in os.listdir(store_dir):
+        path = os.path.abspath(os.path.join(store_dir, name))
+        # objects, and objects left by interrupted saves
+        if (name.endswith('.rds') or name.endswith('.tmp')) and \
+                path not in used and now - os.stat(path).st_mtime >= grace:
+            os.remove(path)
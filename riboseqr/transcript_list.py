@@ -0,0 +1,128 @@
+"""Lists of transcripts plotted by Plot ribosome profile.
+
+A list has one transcript per line - its name, optionally followed by (tab
+or space separated) the footprint length and the cap to plot it with.
+Lines starting with # are skipped.
+
+Names come from user data, they are checked to be printable, passed to R
+as escaped string literals (see r_strings) and escaped in reports.
+
+"""
+import os
+import unicodedata
+from xml.sax.saxutils import escape
+
+
+def r_string(value):
+    """Return value as a double-quoted R string literal."""
+    for char, escaped in (('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'),
+                          ('\r', '\\r'), ('\t', '\\t')):
+        value = value.replace(char, escaped)
+    return '"{}"'.format(value)
+
+
+def r_strings(values):
+    """Return an R character vector of values."""
+    return 'c({})'.format(', '.join(r_string(value) for value in values))
+
+
+def is_printable(name):
+    """Return True if name has no control or separator characters other
+    than space (as str.isprintable, which Python 2 does not have).
+
+    """
+    if not isinstance(name, type(u'')):
+        name = name.decode('utf-8', 'replace')
+    return all(char == ' ' or unicodedata.category(char)[0] not in 'CZ'
+               for char in name)
+
+
+def check_transcript(name, length, cap=''):
+    """Raise ValueError unless name is a printable transcript name, length
+    one or more comma-separated integers and cap empty or an integer.
+
+    """
+    if not name or not is_printable(name):
+        raise ValueError('Invalid transcript name: {!r}'.format(name))
+    for value in str(length).split(','):
+        try:
+            int(value)
+        except ValueError:
+            raise ValueError('Footprint length of {} must be an integer: '
+                             '{!r}'.format(name, length))
+    if cap:
+        try:
+            int(cap)
+        except ValueError:
+            raise ValueError('Cap of {} must be an integer: {!r}'.format(
+                name, cap))
+
+
+def read_transcripts(transcript_file, transcript_length='27',
+                     transcript_cap=''):
+    """Read a list of transcripts to plot from transcript_file.
+
+    Returns a list of (name, length, cap), using transcript_length and
+    transcript_cap if a line has no length or cap. Raises ValueError for a
+    line with an invalid name, length or cap, or if there are no
+    transcripts.
+
+    """
+    transcripts = []
+    with open(transcript_file) as f:
+        for count, line in enumerate(f):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 3:
+                raise ValueError('Line {} of {}: expected a transcript name, '
+                                 'length and cap, got: {!r}'.format(
+                                     count + 1, transcript_file, line))
+            fields += [''] * (3 - len(fields))
+            transcript = (fields[0], fields[1] or transcript_length,
+                          fields[2] or transcript_cap)
+            try:
+                check_transcript(*transcript)
+            except ValueError as e:
+                raise ValueError('Line {} of {}: {}'.format(
+                    count + 1, transcript_file, e))
+            transcripts.append(transcript)
+    if not transcripts:
+        raise ValueError('No transcripts in: {}'.format(transcript_file))
+    return transcripts
+
+
+def batch_report(transcripts, rendered):
+    """Return the HTML index and sections of the plots of transcripts (a
+    list of (name, length, cap)) - rendered is the (files, error) of each
+    plot (see utils.read_plot_manifest).
+
+    """
+    index = ('<table border="1" cellpadding="4">\n<tr><th>Transcript</th>'
+             '<th>Footprint length</th><th>Cap</th><th>Plot</th></tr>\n')
+    sections = ''
+    for count, ((name, length, cap), (files, _)) in enumerate(
+            zip(transcripts, rendered)):
+        count += 1
+        name, length, cap = [escape(str(value))
+                             for value in (name, length, cap)]
+        images = [image for image in files if image.endswith('.png')]
+        pdf = [pdf for pdf in files if pdf.endswith('.pdf')]
+        if images or pdf:
+            status = '<a href="#plot{0}">View</a>'.format(count)
+        else:
+            status = 'Not plotted'
+        index += ('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td>'
+                  '</tr>\n'.format(name, length, cap, status))
+        if not (images or pdf):
+            continue
+        sections += '<h3 id="plot{0}">{1}</h3>\n'.format(count, name)
+        sections += ('<p>Selected ribosome footprint length: '
+                     '<strong>{0}</strong></p>\n'.format(length))
+        for image in images:
+            sections += ('<p><img border="1" src="{0}" alt="{0}"></p>\n'.
+                         format(os.path.basename(image)))
+        if pdf:
+            sections += '<p><a href="{0}">PDF version</a></p>\n'.format(
+                os.path.basename(pdf[0]))
+    return '{0}</table>\n<hr>\n{1}'.format(index, sections)
@@ -3,54 +3,196 @@ import os
 import sys
 import argparse
 import logging
-import rpy2.robjects as robjects
 
+import orfs
+import frames
 import utils
+import store
+import rworker
+import profiling
 
-rscript = ''
-R = robjects.r
+R = rworker.connect()
+profile = profiling.Profile(R, r_memory=bool(
+    os.environ.get(profiling.R_MEMORY_ENV)) and not rworker.is_worker(R))
+run_rscript = profile.run_rscript
 
+# Default maximum size of the findCDS cache (bytes)
+CDS_CACHE_SIZE = 2 * 1024 ** 3
 
-def run_rscript(command=None):
-    """Run R command, log it, append to rscript"""
-    global rscript
-    if not command:
+# Build fastaCDS from potential coding sequences passed from Python
+CDS_TO_GRANGES = """cdsToGRanges <- function(seqnames, levels, starts, ends,
+                         frames) {
+    fastaCDS <<- GRanges(
+        seqnames=structure(seqnames, levels=levels, class="factor"),
+        ranges=IRanges(start=starts, end=ends), strand="+", frame=frames)
+    invisible(fastaCDS)
+}"""
+
+
+def run_orf_finder(fasta_file, start_codons, stop_codons, threads=1):
+    """Find potential coding sequences with the vectorized CDS finder
+    (orfs.py) and pass them to R as fastaCDS.
+
+    """
+    import rpy2.robjects as robjects
+    with utils.open_file(fasta_file) as fasta:
+        names, sequences = orfs.read_fasta(fasta)
+    with profile.measure('# vectorized CDS finder (orfs.py)'):
+        index, starts, ends, frames = orfs.find_cds_parallel(
+            sequences, start_codons=start_codons, stop_codons=stop_codons,
+            threads=threads)
+    logging.debug('Found {} potential coding sequences in {} '
+                  'transcripts'.format(len(starts), len(names)))
+
+    run_rscript(CDS_TO_GRANGES)
+    R['cdsToGRanges'](
+        robjects.IntVector((index + 1).tolist()), robjects.StrVector(names),
+        robjects.IntVector(starts.tolist()), robjects.IntVector(ends.tolist()),
+        robjects.IntVector(frames.tolist()))
+    profile.script += (
+        '# fastaCDS <- cdsToGRanges(...) - potential coding sequences in {0} '
+        'found with the vectorized CDS finder, startCodon={1}, '
+        'stopCodon={2}\n'.format(fasta_file, start_codons, stop_codons))
+
+
+def run_frame_counting(lengths, threads=1):
+    """Count reads in each frame of each potential coding sequence with the
+    vectorized frame counting (frames.py) and pass the result to R as fCs.
+
+    """
+    import numpy as np
+    import rpy2.robjects as robjects
+    lengths = sorted(utils.process_lengths(lengths))
+
+    run_rscript(frames.FRAME_COUNT_COLUMNS)
+    columns = R['frameCountColumns']()
+    cds = [np.asarray(column) for column in columns[0]]
+    libraries = [[np.asarray(column) for column in library]
+                 for library in columns[1]]
+    with profile.measure('# vectorized frame counting (frames.py)'):
+        results = frames.count_frames_parallel(
+            libraries, cds, lengths, threads=threads)
+
+    for key, position in (('hits', 0), ('unqHits', 1)):
+        # arrays are passed in R (column-major) order
+        robjects.globalenv[key] = R['list'](*[robjects.IntVector(
+            result[position].ravel(order='F').tolist()) for result in results])
+    run_rscript(frames.RIBO_CODING.format(
+        'c({})'.format(', '.join(str(length) for length in lengths))))
+    profile.script += ('# hits, unqHits - read counts per (CDS, frame, '
+                       'length) of each library from the vectorized frame '
+                       'counting\n')
+
+
+def find_cds(fasta_file, start_codons='ATG', stop_codons='TAG,TAA,TGA',
+             cache_dir=None, cache_size=CDS_CACHE_SIZE, engine='findCDS',
+             threads=1):
+    """Find potential coding sequences (fastaCDS) with findCDS or, if engine
+    is 'numpy', the vectorized CDS finder using threads.
+
+    If cache_dir is given, the result is saved there keyed by a hash of the
+    FASTA file contents, the start/stop codons and engine, and reused on
+    later runs. Least recently used results are removed once the cache is
+    larger than cache_size bytes.
+
+    """
+    starts, stops = (utils.process_args(start_codons, ret_mode='charvector'),
+                     utils.process_args(stop_codons, ret_mode='charvector'))
+    if engine == 'numpy' and rworker.is_worker(R):
+        logging.debug('Coding sequences cannot be passed to an R worker, '
+                      'using findCDS')
+        engine = 'findCDS'
+
+    find_command = ('fastaCDS <- findCDS(fastaFile={0!r}, startCodon={1}, '
+                    'stopCodon={2})'.format(fasta_file, starts, stops))
+
+    def run():
+        if engine == 'numpy':
+            run_orf_finder(
+                fasta_file,
+                utils.process_args(start_codons, ret_mode='list'),
+                utils.process_args(stop_codons, ret_mode='list'),
+                threads=threads)
+        else:
+            run_rscript(find_command)
+
+    if not cache_dir:
+        run()
+        return
+
+    key = utils.digest([fasta_file], engine, starts, stops)
+    cache_file, hit = utils.cache_lookup(os.path.abspath(cache_dir), key)
+    if hit:
+        logging.debug('Using cached findCDS result: {}'.format(cache_file))
+        command = 'fastaCDS <- readRDS("{}")'.format(cache_file)
+        logging.debug(command)
+        profile.run(R, command)
+        # the script gives the same fastaCDS without the cache
+        profile.script += ('# cache hit: fastaCDS was read from {}, the '
+                           'result of\n{}\n'.format(cache_file, find_command))
         return
-    logging.debug(command)
-    rscript += '{}\n'.format(command)
-    output = R(command)
-    return output
+
+    run()
+    # write to a temporary file first so that other runs never read a
+    # partially written result
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    run_rscript('saveRDS(fastaCDS, file="{}")'.format(tmp_file))
+    os.rename(tmp_file, cache_file)
+    utils.prune_cache(os.path.abspath(cache_dir), cache_size)
 
 
 def find_periodicity(
         rdata_load='Prepare.rda', start_codons='ATG', stop_codons='TAG,TAA,TGA',
         fasta_file=None, include_lengths='25:30', analyze_plot_lengths='26:30',
         text_legend='Frame 0, Frame 1, Frame 2', rdata_save='Periodicity.rda',
-        html_file='Periodicity-report.html', output_path=os.getcwd()):
-    """Plot triplet periodicity from prepared R data file. """
+        html_file='Periodicity-report.html', output_path=os.getcwd(),
+        cds_cache=None, cds_cache_size=CDS_CACHE_SIZE, cds_engine='findCDS',
+        frame_engine='frameCounting', threads=1,
+        plot_formats=utils.PLOT_FORMATS, store_dir=None,
+        rdata_compress='none'):
+    """Plot triplet periodicity from prepared R data file.
+
+    findCDS results are cached in the cds_cache directory, if given. With
+    cds_engine 'numpy', potential coding sequences are found with the
+    vectorized CDS finder using threads (see find_cds). With frame_engine
+    'numpy', reads are counted in each frame with the vectorized frame
+    counting instead of frameCounting. The plot is drawn once and saved in
+    each of plot_formats.
+
+    R objects are saved in rdata_save, or in store_dir if given (riboDat is
+    not written again if it was loaded from the store), with rdata_compress
+    compression.
+
+    """
     logging.debug('{}'.format(R('sessionInfo()')))
     cmd = 'suppressMessages(library(riboSeqR))'
     run_rscript(cmd)
 
     logging.debug('Loading saved R data file')
-    cmd = 'load("{}")'.format(rdata_load)
-    run_rscript(cmd)
+    run_rscript(store.STORE_FUNCTIONS)
+    run_rscript(store.load_command(rdata_load))
 
     # R("""options(showTailLines=Inf)""")
-    starts, stops = (utils.process_args(start_codons, ret_mode='charvector'),
-                     utils.process_args(stop_codons, ret_mode='charvector'))
-
-    cmd = ('fastaCDS <- findCDS(fastaFile={0!r}, startCodon={1}, '
-           'stopCodon={2})'.format(fasta_file, starts, stops))
-    run_rscript(cmd)
+    find_cds(fasta_file, start_codons=start_codons, stop_codons=stop_codons,
+             cache_dir=cds_cache, cache_size=cds_cache_size, engine=cds_engine,
+             threads=threads)
 
     logging.debug('Potential coding sequences using start codon (ATG) and '
                   'stop codons TAG, TAA, TGA')
     logging.debug('{}\n'.format(R['fastaCDS']))
 
-    cmd = """fCs <- frameCounting(riboDat, fastaCDS, lengths={0})
+    if frame_engine == 'numpy' and rworker.is_worker(R):
+        logging.debug('Frame counts cannot be passed to an R worker, using '
+                      'frameCounting')
+        frame_engine = 'frameCounting'
+    if frame_engine == 'numpy':
+        run_frame_counting(include_lengths, threads=threads)
+        cmd = 'fS <- readingFrame(rC=fCs, lengths={0}); fS'.format(
+            analyze_plot_lengths)
+    else:
+        cmd = """fCs <- frameCounting(riboDat, fastaCDS, lengths={0})
     fS <- readingFrame(rC=fCs, lengths={1}); fS""".\
-        format(include_lengths, analyze_plot_lengths)
+            format(include_lengths, analyze_plot_lengths)
     run_rscript(cmd)
 
     logging.debug('riboDat \n{}\n'.format(R['riboDat']))
@@ -59,18 +201,18 @@ def find_periodicity(
 
     legend = utils.process_args(text_legend, ret_mode='charvector')
 
-    for fmat in ('pdf', 'png'):
-        if fmat == 'png':
-            cmd = '{0}(file="{1}", type="cairo")'
-        else:
-            cmd = '{0}(file="{1}")'
-        run_rscript(cmd.format(fmat, os.path.join(
-            output_path, '{0}.{1}'.format('Periodicity-plot', fmat))))
-        run_rscript('plotFS(fS, legend.text = {0})'.format(legend))
-        run_rscript('dev.off()')
+    run_rscript(utils.RENDER_PLOT)
+    run_rscript(utils.render_plot(
+        'plotFS(fS, legend.text = {0})'.format(legend),
+        os.path.join(output_path, 'Periodicity-plot'), plot_formats,
+        pages=False))
 
-    run_rscript('save("fCs", "fS", "riboDat", "fastaCDS", '
-                'file="{}", compress=FALSE)'.format(rdata_save))
+    run_rscript(store.save_command(
+        ['fCs', 'fS', 'riboDat', 'fastaCDS', 'readStore'], rdata_save,
+        store_dir=store_dir, changed=['fCs', 'fS', 'fastaCDS'],
+        compress=rdata_compress, threads=threads))
+    if store_dir:
+        store.prune_store(store_dir)
 
     html = '<h2>Triplet periodicity - results</h2><hr>'
     html += ('<h4>Results of reading frame analysis</h4>'
@@ -78,16 +220,21 @@ def find_periodicity(
     html += ('<p>Lengths used for reading frame analysis - <code>{0}</code>'
              '<br>Lengths selected for the plot - <code>{1}</code>'
              '</p>'.format(include_lengths, analyze_plot_lengths))
-    html += ('<p><img src="Periodicity-plot.png" border="1" '
-             'alt="Triplet periodicity plot" />'
-             '<br><a href="Periodicity-plot.pdf">PDF version</a></p>')
+    html += '<p>'
+    if 'png' in plot_formats:
+        html += ('<img src="Periodicity-plot.png" border="1" '
+                 'alt="Triplet periodicity plot" /><br>')
+    if 'pdf' in plot_formats:
+        html += '<a href="Periodicity-plot.pdf">PDF version</a>'
+    html += '</p>'
 
     logging.debug('\n{:#^80}\n{}\n{:#^80}\n'.format(
-        ' R script for this session ', rscript, ' End R script '))
+        ' R script for this session ', profile.script, ' End R script '))
 
     with open(os.path.join(output_path, 'periodicity.R'), 'w') as r:
-        r.write(rscript)
+        r.write(profile.script)
 
+    html += profile.report(output_path, 'periodicity')
     html += ('<h4>R script for this session</h4>'
              '<p><a href="periodicity.R">periodicity.R</a></p>'
              '<p>Next step: <em>Metagene analysis</em></p>')
@@ -132,9 +279,49 @@ if __name__ == '__main__':
     parser.add_argument(
         '--rdata_save', help='File to write RData to (default: %(default)s)',
         default='Periodicity.rda')
+    parser.add_argument(
+        '--cds_cache', default=os.environ.get('RIBOSEQR_CACHE_DIR'),
+        help='Directory to cache findCDS results in (default: '
+             '$RIBOSEQR_CACHE_DIR, no caching if not set)')
+    parser.add_argument(
+        '--cds_cache_size', type=int, default=CDS_CACHE_SIZE // 1024 ** 2,
+        help='Maximum size of the findCDS cache in MB (default: %(default)s)')
+    parser.add_argument(
+        '--cds_engine', choices=['findCDS', 'numpy'], default='findCDS',
+        help='Find potential coding sequences with riboSeqR findCDS or the '
+             'vectorized NumPy CDS finder (default: %(default)s)')
+    parser.add_argument(
+        '--frame_engine', choices=['frameCounting', 'numpy'],
+        default='frameCounting',
+        help='Count reads in each frame with riboSeqR frameCounting or the '
+             'vectorized NumPy frame counting (default: %(default)s)')
+    parser.add_argument(
+        '--threads', type=int,
+        default=int(os.environ.get('GALAXY_SLOTS', 1)),
+        help='Number of processes for the NumPy CDS finder and frame '
+             'counting (default: %(default)s)')
+    parser.add_argument(
+        '--plot_formats', type=utils.process_formats,
+        default=','.join(utils.PLOT_FORMATS),
+        help='Comma-separated formats to save plots in (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--store', default=os.environ.get(store.STORE_ENV),
+        help='Directory to save R objects in, shared by reference with the '
+             'next steps (default: ${}, objects are saved in the R data '
+             'file if not set)'.format(store.STORE_ENV))
+    parser.add_argument(
+        '--rdata_compress', choices=store.COMPRESSION, default='none',
+        help='Compression of the saved R data (default: %(default)s)')
     parser.add_argument('--html_file', help='Output file for results (HTML)')
     parser.add_argument('--output_path',
                         help='Files are saved in this directory')
+    parser.add_argument(
+        '--profile_r_memory', action='store_true',
+        default=bool(os.environ.get(profiling.R_MEMORY_ENV)),
+        help='Also measure the memory used by R objects in each command, '
+             'runs a garbage collection before and after it (default: set '
+             'if ${} is set)'.format(profiling.R_MEMORY_ENV))
     parser.add_argument(
         '--debug', help='Produce debug output', action='store_true')
     
@@ -144,6 +331,8 @@ if __name__ == '__main__':
                             level=logging.DEBUG, stream=sys.stdout)
         logging.debug('Supplied Arguments\n{}\n'.format(vars(args)))
 
+    profile.r_memory = args.profile_r_memory and not rworker.is_worker(R)
+
     if not os.path.exists(args.output_path):
         os.mkdir(args.output_path)
 
@@ -154,5 +343,9 @@ if __name__ == '__main__':
         analyze_plot_lengths=args.analyze_plot_lengths,
         text_legend=args.text_legend,
         rdata_save=args.rdata_save, html_file=args.html_file,
-        output_path=args.output_path)
+        output_path=args.output_path, cds_cache=args.cds_cache,
+        cds_cache_size=args.cds_cache_size * 1024 ** 2,
+        cds_engine=args.cds_engine, frame_engine=args.frame_engine,
+        threads=args.threads, plot_formats=args.plot_formats,
+        store_dir=args.store, rdata_compress=args.rdata_compress)
 logging.debug("Done!")
@@ -1,4 +1,395 @@
 """Common functions"""
+import os
+import csv
+import gzip
+import hashlib
+import itertools
+import subprocess
+from xml.sax.saxutils import escape
+
+# BAM files are BGZF (gzip) compressed and start with this magic string
+BAM_MAGIC = b'BAM\x01'
+GZIP_MAGIC = b'\x1f\x8b'
+# gzip.open modes for text, Python 2 has no text modes (str is bytes there)
+TEXT_READ, TEXT_WRITE = ('rb', 'wb') if str is bytes else ('rt', 'wt')
+
+# Default number of rows of a data file shown in HTML reports
+MAX_TABLE_ROWS = 100
+
+# Formats plots can be saved in
+PLOT_FORMATS = ('pdf', 'png')
+
+# Draw a plot once on a null device, recording each page, then replay the
+# pages on a device for each requested format
+RENDER_PLOT = """renderPlot <- function(plot, pdfFile=NULL, pngFile=NULL) {
+    pages <- list()
+    pdf(NULL)
+    dev.control(displaylist="enable")
+    device <- dev.cur()
+    record <- function() {
+        if (dev.cur() == device && par("page") &&
+                length(recordPlot()[[1]])) {
+            pages[[length(pages) + 1]] <<- recordPlot()
+        }
+    }
+    hooks <- getHook("before.plot.new")
+    setHook("before.plot.new", record)
+    tryCatch({
+        eval(plot, envir=globalenv())
+        pages[[length(pages) + 1]] <- recordPlot()
+    }, finally={
+        setHook("before.plot.new", hooks, "replace")
+        dev.off(device)
+    })
+    for (file in c(pdfFile, pngFile)) {
+        if (identical(file, pdfFile)) {
+            pdf(file=file)
+        } else {
+            png(file=file, type="cairo")
+        }
+        for (page in pages) {
+            replayPlot(page)
+        }
+        dev.off()
+    }
+    if (!is.null(pngFile) && grepl("%", pngFile, fixed=TRUE)) {
+        pngFile <- sprintf(pngFile, seq_along(pages))
+    }
+    invisible(c(pdfFile, pngFile))
+}"""
+
+# Draw plots (renderPlot calls) in a pool of forked R processes. Returns the
+# files written for each plot, or an error attribute, and lists them in
+# manifest ("plot number<TAB>file|error<TAB>value" lines) if given.
+RENDER_PLOTS = """renderPlots <- function(plots, cores=1, manifest=NULL) {
+    results <- parallel::mclapply(plots, function(plot) {
+        tryCatch(as.character(eval(plot, envir=globalenv())),
+                 error=function(e) structure(character(0),
+                                             error=conditionMessage(e)))
+    }, mc.cores=cores, mc.preschedule=FALSE)
+    if (!is.null(manifest)) {
+        lines <- unlist(lapply(seq_along(results), function(i) {
+            result <- results[[i]]
+            if (inherits(result, "try-error")) {
+                result <- structure(character(0), error=as.character(result))
+            }
+            c(if (length(result)) paste(i, "file", result, sep="\\t"),
+              if (!is.null(attr(result, "error"))) {
+                  paste(i, "error", gsub("[\\t\\n]", " ",
+                                         attr(result, "error")), sep="\\t")
+              })
+        }))
+        writeLines(as.character(lines), manifest)
+    }
+    invisible(results)
+}"""
+
+
+def find_executable(name):
+    """Return the path of executable name if it is on the PATH, or None
+    (as shutil.which, which Python 2 does not have).
+
+    """
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def is_gzip(file_name):
+    """Return True if file_name is gzip (or bgzip) compressed."""
+    with open(file_name, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def is_bam(file_name):
+    """Return True if file_name is a BAM format file (checks magic bytes,
+    not the file extension).
+
+    """
+    if not is_gzip(file_name):
+        return False
+    with gzip.open(file_name, 'rb') as f:
+        try:
+            return f.read(4) == BAM_MAGIC
+        except (IOError, OSError, EOFError):
+            return False
+
+
+def open_file(file_name):
+    """Open a text file for reading, decompressing gzip/bgzip files as they
+    are read.
+
+    """
+    if is_gzip(file_name):
+        return gzip.open(file_name, TEXT_READ)
+    return open(file_name)
+
+
+class CompressedOutput(object):
+    """Text file-like object which compresses everything written to it
+    with an external (multi-threaded) compressor such as bgzip or pigz.
+
+    """
+
+    def __init__(self, command, file_name):
+        self.file_name = file_name
+        self._output = open(file_name, 'wb')
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=self._output,
+            universal_newlines=True)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._output.close()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_output(file_name, compress=False, threads=1):
+    """Open a text file for writing. If compress is True, output is written
+    gzip compressed using bgzip or pigz with threads if either is available,
+    or the gzip module if not.
+
+    """
+    if not compress:
+        return open(file_name, 'w')
+    for command in (['bgzip', '-@', str(threads), '-c'],
+                    ['pigz', '-p', str(threads), '-c']):
+        if find_executable(command[0]):
+            return CompressedOutput(command, file_name)
+    return gzip.open(file_name, TEXT_WRITE, compresslevel=6)
+
+
+def digest(file_names=(), *values):
+    """Return a SHA-256 hex digest of the contents of file_names and any
+    other values, to be used as a cache key.
+
+    """
+    sha = hashlib.sha256()
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+    for value in values:
+        sha.update(repr(value).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def cache_lookup(cache_dir, key, extension='.rds'):
+    """Return (path, hit) for key in cache_dir. A hit is marked as recently
+    used for prune_cache.
+
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, key + extension)
+    hit = os.path.exists(path)
+    if hit:
+        os.utime(path, None)
+    return path, hit
+
+
+def prune_cache(cache_dir, max_size):
+    """Remove least recently used files from cache_dir until its total size
+    is at most max_size bytes.
+
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # skip results still being written
+        if os.path.isfile(path) and not name.endswith('.tmp'):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+
+
+def process_lengths(lengths):
+    """Return a set of read lengths from an R style range ("25:30") and/or
+    comma-separated values ("27,28"). Returns None if lengths is empty.
+
+    """
+    if not lengths or not lengths.strip():
+        return None
+    values = set()
+    for item in lengths.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            start, end = [int(value) for value in item.split(':', 1)]
+            values.update(range(min(start, end), max(start, end) + 1))
+        else:
+            values.add(int(item))
+    return values
+
+
+def csv_to_html(csv_file, max_rows=MAX_TABLE_ROWS):
+    """Return an HTML table of the first max_rows rows (all rows if 0) of a
+    CSV file with a header (as written by R's write.csv), and a table of
+    the number of values, minimum, mean and maximum of each numeric column.
+
+    The file is read once, row by row, and the HTML is joined at the end so
+    this takes time linear in the size of the file.
+
+    """
+    parts = ['<table cellpadding="4" border="1">']
+    with open(csv_file) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        parts.append('<tr>{}</tr>'.format(''.join(
+            '<th>{}</th>'.format(escape(item)) for item in header)))
+        # count, minimum, total and maximum of each column
+        stats = [[0, None, 0.0, None] for _ in header]
+        rows = 0
+        for row in reader:
+            rows += 1
+            if not max_rows or rows <= max_rows:
+                parts.append('<tr>{}</tr>'.format(''.join(
+                    '<td align="center"><code>{}</code></td>'.format(
+                        escape(item)) for item in row)))
+            for item, column in zip(row, stats):
+                try:
+                    value = float(item)
+                except ValueError:
+                    continue
+                column[0] += 1
+                column[2] += value
+                if column[1] is None or value < column[1]:
+                    column[1] = value
+                if column[3] is None or value > column[3]:
+                    column[3] = value
+    parts.append('</table>')
+    if max_rows and rows > max_rows:
+        parts.append('<p>Showing the first {} of {} rows.</p>'.format(
+            max_rows, rows))
+
+    summary = [(name, column) for name, column in zip(header, stats)
+               if column[0]]
+    if summary:
+        parts.append('<p>Summary ({} rows)</p><table cellpadding="4" '
+                     'border="1"><tr><th>Column</th><th>Values</th>'
+                     '<th>Min</th><th>Mean</th><th>Max</th></tr>'.format(rows))
+        for name, (count, minimum, total, maximum) in summary:
+            parts.append(
+                '<tr><td>{0}</td><td align="center">{1}</td>'
+                '<td align="center">{2:g}</td><td align="center">{3:g}</td>'
+                '<td align="center">{4:g}</td></tr>'.format(
+                    escape(name), count, minimum, total / count, maximum))
+        parts.append('</table>')
+    return ''.join(parts)
+
+
+def process_formats(formats):
+    """Return a tuple of plot formats from comma-separated values
+    ("pdf,png"). Raises ValueError for unknown formats.
+
+    """
+    values = []
+    for item in formats.split(','):
+        item = item.strip().lower()
+        if not item or item in values:
+            continue
+        if item not in PLOT_FORMATS:
+            raise ValueError('Unknown plot format: {}'.format(item))
+        values.append(item)
+    if not values:
+        raise ValueError('No plot format given')
+    return tuple(values)
+
+
+def process_grid(options, paired=()):
+    """Return every combination of options, a list of (name, value) with
+    semicolon-separated alternative values ("27;27,28"), as a list of dicts.
+
+    The options in each group of names in paired vary together, taking
+    their alternatives in order (an option with a single value keeps it).
+    Raises ValueError if they have different numbers of alternatives. All
+    other options are crossed.
+
+    """
+    values = dict((name, [item.strip() for item in str(
+        '' if value is None else value).split(';')])
+        for name, value in options)
+    grouped = set(name for group in paired for name in group)
+    groups = [tuple(group) for group in paired] + [
+        (name,) for name, _ in options if name not in grouped]
+    choices = []
+    for group in groups:
+        size = max(len(values[name]) for name in group)
+        for name in group:
+            if len(values[name]) not in (1, size):
+                raise ValueError('{} has {} values, expected {}'.format(
+                    name, len(values[name]), size))
+        choices.append([
+            [(name, values[name][count if len(values[name]) > 1 else 0])
+             for name in group] for count in range(size)])
+    return [dict(itertools.chain(*combination))
+            for combination in itertools.product(*choices)]
+
+
+def read_plot_manifest(manifest, count):
+    """Return a list of (files, error) for each of count plots drawn by
+    renderPlots (RENDER_PLOTS) from its manifest. error is '' if the plot
+    was drawn.
+
+    """
+    plots = [([], '') for _ in range(count)]
+    with open(manifest) as f:
+        for line in f:
+            number, kind, value = line.rstrip('\n').split('\t', 2)
+            files, error = plots[int(number) - 1]
+            if kind == 'file':
+                files.append(value)
+            else:
+                plots[int(number) - 1] = (files, value)
+    return plots
+
+
+def render_plot(plot, file_name, formats=PLOT_FORMATS, pages=True):
+    """Return an R command that draws plot (an R expression) once and saves
+    it as file_name.pdf and/or file_name_1.png, file_name_2.png... for each
+    page (file_name.png if pages is False). RENDER_PLOT must be run first,
+    the command returns the names of the files written.
+
+    """
+    args = ['quote({})'.format(plot)]
+    if 'pdf' in formats:
+        args.append('pdfFile="{}.pdf"'.format(file_name))
+    if 'png' in formats:
+        args.append('pngFile="{}{}.png"'.format(
+            file_name, '_%1d' if pages else ''))
+    return 'renderPlot({})'.format(', '.join(args))
+
+
+def render_plots(plots, manifest=None, cores=1):
+    """Return an R command that draws plots (render_plot commands) with
+    cores forked R processes, listing the files written in manifest (see
+    read_plot_manifest). RENDER_PLOT and RENDER_PLOTS must be run first.
+
+    """
+    args = ['list({})'.format(', '.join(
+        'quote({})'.format(plot) for plot in plots)), 'cores={}'.format(cores)]
+    if manifest:
+        args.append('manifest="{}"'.format(manifest))
+    return 'renderPlots({})'.format(', '.join(args))
 
 
 def process_args(args, ret_type='str', ret_mode=None):
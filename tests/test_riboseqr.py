@@ -1,6 +1,38 @@
 """riboSeqR Galaxy unit tests"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
-from riboseqr import utils
+import multiprocessing
+from unittest import mock
+
+# store and pipeline import the other modules from riboseqr/, as when run as
+# a script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'riboseqr'))
+from riboseqr import utils, alignments, rworker, orfs, frames, store, \
+    readstore, export, profiling, transcript_list  # noqa: E402
+import pipeline  # noqa: E402
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'test-data')
+FASTA_FILE = os.path.join(TEST_DATA, 'rsem_chlamy236_deNovo.transcripts.fa')
+
+
+def riboseqr_available():
+    """Return True if rpy2 and the riboSeqR R package can be loaded."""
+    try:
+        import rpy2.robjects as robjects
+        robjects.r('suppressMessages(library(riboSeqR))')
+    except Exception:
+        return False
+    return True
 
 
 class PrepareTestCase(unittest.TestCase):
@@ -56,3 +88,1033 @@ class PrepareTestCase(unittest.TestCase):
         rs = utils.process_args('chlamy17.idx, chlamy3.idx', ret_mode='list')
         self.assertEqual(rs, ['chlamy17.idx', 'chlamy3.idx'],
                          'Return files as a list.')
+
+    def test_process_lengths(self):
+        """Test processing read lengths. """
+        self.assertEqual(utils.process_lengths('25:30'), set(range(25, 31)),
+                         'Return R style range as a set.')
+        self.assertEqual(utils.process_lengths('27, 28'), set([27, 28]),
+                         'Return comma-separated lengths as a set.')
+        self.assertIsNone(utils.process_lengths(''),
+                          'Return empty string as None.')
+
+    def test_process_formats(self):
+        """Test processing plot formats. """
+        self.assertEqual(utils.process_formats('pdf, PNG'), ('pdf', 'png'),
+                         'Return formats as a tuple.')
+        self.assertEqual(utils.process_formats('png,png'), ('png',),
+                         'Return each format once.')
+        self.assertRaises(ValueError, utils.process_formats, 'gif')
+        self.assertRaises(ValueError, utils.process_formats, '')
+
+    def test_process_grid(self):
+        """Test expanding semicolon-separated alternatives. """
+        grid = utils.process_grid(
+            [('lengths', '27;27,28'), ('frames', '1;1,0'),
+             ('hit_mean', '10; 50'), ('unique_hit_mean', '1')],
+            paired=[('lengths', 'frames')])
+        self.assertEqual(
+            [(combination['lengths'], combination['frames'],
+              combination['hit_mean']) for combination in grid],
+            [('27', '1', '10'), ('27', '1', '50'), ('27,28', '1,0', '10'),
+             ('27,28', '1,0', '50')],
+            'Vary paired options together, cross the others.')
+        self.assertEqual(set(combination['unique_hit_mean']
+                             for combination in grid), set(['1']))
+        self.assertEqual(len(utils.process_grid(
+            [('lengths', '27;28'), ('frames', '1')],
+            paired=[('lengths', 'frames')])), 2,
+            'Use a single paired value with each alternative.')
+        self.assertRaises(ValueError, utils.process_grid,
+                          [('lengths', '27;28;29'), ('frames', '1;0')],
+                          paired=[('lengths', 'frames')])
+
+    def test_render_plot(self):
+        """Test the R command for drawing a plot once. """
+        self.assertEqual(
+            utils.render_plot('plotFS(fS)', 'out/plot', ('png',)),
+            'renderPlot(quote(plotFS(fS)), pngFile="out/plot_%1d.png")',
+            'Write only the requested formats.')
+        self.assertEqual(
+            utils.render_plot('plotFS(fS)', 'plot', pages=False),
+            'renderPlot(quote(plotFS(fS)), pdfFile="plot.pdf", '
+            'pngFile="plot.png")', 'Write a single page PNG.')
+
+    def test_render_plots(self):
+        """Test drawing plots in parallel and reading the files written. """
+        self.assertEqual(
+            utils.render_plots(['renderPlot(quote(plotFS(fS)))'],
+                               manifest='plots.tsv', cores=2),
+            'renderPlots(list(quote(renderPlot(quote(plotFS(fS))))), '
+            'cores=2, manifest="plots.tsv")')
+        handle, manifest = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as f:
+            f.write('1\tfile\tplot1.pdf\n1\tfile\tplot1_1.png\n'
+                    '3\terror\tno hits\n')
+        try:
+            self.assertEqual(
+                utils.read_plot_manifest(manifest, 3),
+                [(['plot1.pdf', 'plot1_1.png'], ''), ([], ''),
+                 ([], 'no hits')],
+                'Return the files written or the error for each plot.')
+        finally:
+            os.remove(manifest)
+
+
+class ReportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.tmp_dir, 'counts.csv')
+        with open(self.csv_file, 'w') as f:
+            f.write('"","WT1","M1"\n')
+            for count in range(1, 6):
+                f.write('"tx{0}",{0},{1}\n'.format(count, count * 10))
+            f.write('"tx<6>",NA,60\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_csv_to_html(self):
+        """Test bounded HTML tables with summary statistics. """
+        html = utils.csv_to_html(self.csv_file, max_rows=2)
+        self.assertEqual(html.count('<code>tx'), 2, 'Show the first rows.')
+        self.assertIn('Showing the first 2 of 6 rows.', html)
+        self.assertIn('<td>WT1</td><td align="center">5</td>'
+                      '<td align="center">1</td><td align="center">3</td>'
+                      '<td align="center">5</td>', html,
+                      'Summarize numeric columns over all rows.')
+        html = utils.csv_to_html(self.csv_file, max_rows=0)
+        self.assertEqual(html.count('<code>tx'), 6, 'Show all rows.')
+        self.assertIn('tx&lt;6&gt;', html, 'Escape values.')
+
+
+class InputFormatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_is_bam(self):
+        """Test BAM detection from file contents. """
+        bam_file = os.path.join(self.tmp_dir, 'reads.sam')
+        with gzip.open(bam_file, 'wb') as f:
+            f.write(utils.BAM_MAGIC + b'\x00' * 8)
+        self.assertTrue(utils.is_bam(bam_file), 'Detect BAM by magic bytes.')
+
+        sam_file = os.path.join(self.tmp_dir, 'reads.bam')
+        with open(sam_file, 'w') as f:
+            f.write('@HD\tVN:1.0\n')
+        self.assertFalse(utils.is_bam(sam_file), 'SAM file is not BAM.')
+
+        gz_file = os.path.join(self.tmp_dir, 'reads.sam.gz')
+        with gzip.open(gz_file, 'wb') as f:
+            f.write(b'@HD\tVN:1.0\n')
+        self.assertFalse(utils.is_bam(gz_file), 'Gzipped SAM is not BAM.')
+
+    def test_compressed_round_trip(self):
+        """Test writing and reading gzip compressed text. """
+        file_name = os.path.join(self.tmp_dir, 'RiboSeq file 1.gz')
+        with utils.open_output(file_name, compress=True, threads=2) as f:
+            f.write('"+"\t"tx1"\t9\t"ACGT"\n')
+        self.assertTrue(utils.is_gzip(file_name), 'Write gzipped output.')
+        with utils.open_file(file_name) as f:
+            self.assertEqual(f.read(), '"+"\t"tx1"\t9\t"ACGT"\n',
+                             'Read gzipped input as text.')
+
+    def test_compressed_without_tools(self):
+        """Test gzip compression without bgzip or pigz. """
+        file_name = os.path.join(self.tmp_dir, 'RiboSeq file 1.gz')
+        with mock.patch.dict(os.environ, {'PATH': self.tmp_dir}):
+            with utils.open_output(file_name, compress=True, threads=2) as f:
+                self.assertNotIsInstance(f, utils.CompressedOutput)
+                f.write('"+"\t"tx1"\t9\t"ACGT"\n')
+        with utils.open_file(file_name) as f:
+            self.assertEqual(f.read(), '"+"\t"tx1"\t9\t"ACGT"\n')
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def test_save_command(self):
+        """Test the R command for saving objects. """
+        self.assertEqual(
+            store.save_command(['riboDat'], 'Prepare.rda'),
+            'saveObjects(c("riboDat"), file="Prepare.rda", compress=FALSE)',
+            'Save objects in the R data file without a store.')
+        cmd = store.save_command(
+            ['fCs', 'riboDat'], 'Periodicity.rda', store_dir='/tmp/store',
+            changed=['fCs'], compress='xz', threads=4)
+        self.assertIn('store="/tmp/store"', cmd)
+        self.assertIn('changed=c("fCs")', cmd, 'Only write changed objects.')
+        self.assertIn('compress="xz"', cmd)
+        self.assertNotIn('command=', cmd, 'Only gzip is piped through pigz.')
+        self.assertRaises(ValueError, store.save_command, ['riboDat'],
+                          'Prepare.rda', compress='zip')
+
+    def test_find_executable(self):
+        """Test finding executables on the PATH. """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for name, mode in (('pigz', 0o755), ('bgzip', 0o644)):
+                with open(os.path.join(tmp_dir, name), 'w') as f:
+                    f.write('#!/bin/sh\n')
+                os.chmod(os.path.join(tmp_dir, name), mode)
+            with mock.patch.dict(os.environ, {'PATH': tmp_dir}):
+                self.assertEqual(utils.find_executable('pigz'),
+                                 os.path.join(tmp_dir, 'pigz'))
+                self.assertIsNone(utils.find_executable('bgzip'),
+                                  'Skip files that are not executable.')
+                self.assertIsNone(utils.find_executable('xz'))
+                self.assertEqual(store.decompress_command(), 'pigz -dc')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_load_command(self):
+        """Test the R command for loading objects. """
+        self.assertTrue(store.load_command('Prepare.rda').startswith(
+            'loadObjects("Prepare.rda", decompress='))
+        self.assertTrue(store.load_command(
+            'Metagene.rda', names=['ffCs', 'riboDat']).startswith(
+            'loadObjects("Metagene.rda", names=c("ffCs", "riboDat"), '),
+            'Load only the selected objects.')
+
+    def test_prune_store(self):
+        """Test removing stored objects no R data file refers to. """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store_dir = os.path.join(tmp_dir, 'store')
+            os.mkdir(store_dir)
+            paths = {}
+            for name in ('a-riboDat', 'a-fCs', 'b-fCs', 'c-ffCs', 'd-new',
+                         'e-fCs.rds.12'):
+                paths[name] = os.path.join(
+                    store_dir, name + ('.tmp' if name.startswith('e') else
+                                       '.rds'))
+                open(paths[name], 'w').close()
+            refs = [('a', 'Periodicity.rda', ['a-riboDat', 'a-fCs']),
+                    ('b', 'Periodicity.rda', ['a-riboDat', 'b-fCs']),
+                    ('c', 'Metagene.rda', ['c-ffCs'])]
+            for prefix, rdata_file, objects in refs:
+                paths[prefix] = os.path.join(
+                    store_dir, prefix + '-objects' + store.REFS_SUFFIX)
+                with open(paths[prefix], 'w') as f:
+                    f.write('\n'.join([os.path.join(tmp_dir, rdata_file)] +
+                                      [paths[obj] for obj in objects]))
+            open(os.path.join(tmp_dir, 'Periodicity.rda'), 'w').close()
+            for count, name in enumerate(sorted(paths)):
+                if name != 'd-new':
+                    os.utime(paths[name], (1000 + count, 1000 + count))
+            store.prune_store(store_dir)
+            self.assertEqual(
+                sorted(os.listdir(store_dir)),
+                ['a-riboDat.rds', 'b-fCs.rds', 'b-objects.refs',
+                 'd-new.rds'],
+                'Keep the objects of the last save of existing R data files '
+                'and recent files.')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_digest(self):
+        """Test cache keys from file contents and parameters. """
+        fasta_file = os.path.join(self.tmp_dir, 'transcripts.fa')
+        with open(fasta_file, 'w') as f:
+            f.write('>tx1\nATGAAATAG\n')
+        key = utils.digest([fasta_file], 'c("ATG")')
+        self.assertEqual(key, utils.digest([fasta_file], 'c("ATG")'),
+                         'Same inputs give the same key.')
+        self.assertNotEqual(key, utils.digest([fasta_file], 'c("CTG")'),
+                            'Different parameters give a different key.')
+
+    def test_prune_cache(self):
+        """Test removing least recently used cache entries. """
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        for count, key in enumerate(('old', 'new')):
+            path, hit = utils.cache_lookup(cache_dir, key)
+            self.assertFalse(hit, 'New key is not cached.')
+            with open(path, 'w') as f:
+                f.write('x' * 10)
+            os.utime(path, (count, count))
+        self.assertTrue(utils.cache_lookup(cache_dir, 'new')[1],
+                        'Cached key is found.')
+        utils.prune_cache(cache_dir, 15)
+        self.assertEqual(os.listdir(cache_dir), ['new.rds'],
+                         'Remove least recently used entries.')
+
+
+class AlignmentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sam_file = os.path.join(self.tmp_dir, 'reads.sam')
+        with open(self.sam_file, 'w') as f:
+            f.write('@HD\tVN:1.0\n'
+                    'r1\t0\ttx1\t10\t255\t4M\t*\t0\t0\tACGT\tIIII\n'
+                    'r2\t16\ttx1\t10\t255\t4M\t*\t0\t0\tACGT\tIIII\n'
+                    'r3\t0\ttx1\t10\t255\t4M\t*\t0\t0\tACGT\tIIII\n'
+                    'r4\t0\ttx2\t1\t255\t5M\t*\t0\t0\tACGTA\tIIIII'
+                    '\tNM:i:0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_sam(self):
+        """Test reading successful alignments from SAM. """
+        with open(self.sam_file) as sam:
+            records = [record for chunk in alignments.read_sam(sam)
+                       for record in chunk]
+        self.assertEqual(
+            records, [('tx1', 9, 'ACGT'), ('tx1', 9, 'ACGT'),
+                      ('tx2', 0, 'ACGTA')],
+            'Return FLAG=0 alignments with 0-indexed starts.')
+
+    def test_filter_records(self):
+        """Test filtering on transcript name and read length. """
+        with open(self.sam_file) as sam:
+            chunks = alignments.read_sam(sam)
+            records = [record for chunk in alignments.filter_records(
+                chunks, seqnames=['tx2', 'tx3'], lengths=range(5, 10))
+                for record in chunk]
+        self.assertEqual(records, [('tx2', 0, 'ACGTA')],
+                         'Keep reads on selected transcripts and lengths.')
+        for seqnames, lengths in ((['tx2', 'tx3'], range(5, 10)),
+                                  (['tx1'], None), (None, [4])):
+            with open(self.sam_file) as sam:
+                expected = [record for chunk in alignments.filter_records(
+                    alignments.read_sam(sam), seqnames=seqnames,
+                    lengths=lengths) for record in chunk]
+            with open(self.sam_file) as sam:
+                records = [record for chunk in alignments.read_sam(
+                    sam, seqnames=seqnames, lengths=lengths)
+                    for record in chunk]
+            self.assertEqual(records, expected,
+                             'Filter SAM records while they are parsed.')
+
+    def test_conversion_jobs(self):
+        """Test that the read length filter only applies to Ribo-Seq. """
+        jobs = alignments.conversion_jobs(
+            [(self.sam_file, 'RiboSeq file 1')],
+            [(self.sam_file, 'RNASeq file 1')], lengths=range(5, 10))
+        self.assertEqual([(output, lengths) for _, output, lengths in jobs],
+                         [('RiboSeq file 1', range(5, 10)),
+                          ('RNASeq file 1', None)])
+        kept = []
+        for sam_file, _, lengths in jobs:
+            with open(sam_file) as sam:
+                kept.append([record for chunk in alignments.filter_records(
+                    alignments.read_sam(sam), lengths=lengths)
+                    for record in chunk])
+        self.assertEqual(kept[0], [('tx2', 0, 'ACGTA')],
+                         'Drop Ribo-Seq reads of other lengths.')
+        self.assertEqual(len(kept[1]), 3,
+                         'Keep RNA-Seq reads of all lengths.')
+
+    def test_collect_columns(self):
+        """Test gathering reads into typed columns. """
+        with open(self.sam_file) as sam:
+            seqnames, levels, starts, widths = alignments.collect_columns(
+                alignments.read_sam(sam))
+        self.assertEqual(levels, ['tx1', 'tx2'], 'Return transcript names.')
+        self.assertEqual(list(seqnames), [1, 1, 2],
+                         'Return transcripts as 1-based factor codes.')
+        self.assertEqual(list(starts), [9, 9, 0], 'Return 0-indexed starts.')
+        self.assertEqual(list(widths), [4, 4, 5], 'Return read lengths.')
+
+    def test_write_collapsed(self):
+        """Test collapsing identical reads. """
+        output_file = os.path.join(self.tmp_dir, 'collapsed')
+        with open(self.sam_file) as sam, open(output_file, 'w') as output:
+            count = alignments.write_collapsed(
+                alignments.read_sam(sam), output)
+        self.assertEqual(count, 3, 'Return number of reads.')
+        with open(output_file) as f:
+            self.assertEqual(
+                f.read(), '"+"\t"tx1"\t9\t"ACGT"\t2\n'
+                          '"+"\t"tx2"\t0\t"ACGTA"\t1\n',
+                'Write distinct reads once with their count.')
+
+    def test_count_records(self):
+        """Test counting reads while they are gathered into columns. """
+        counts = {}
+        with open(self.sam_file) as sam:
+            columns = alignments.collect_columns(alignments.count_records(
+                alignments.read_sam(sam), counts))
+        self.assertEqual(list(columns[2]), [9, 9, 0],
+                         'Pass all reads on, not only distinct ones.')
+        self.assertEqual(counts, {('tx1', 9, 'ACGT'): 2,
+                                  ('tx2', 0, 'ACGTA'): 1},
+                         'Count distinct reads in the same pass.')
+
+    def test_write_counts(self):
+        """Test writing collapsed reads in chunks. """
+        output_file = os.path.join(self.tmp_dir, 'collapsed')
+        with open(self.sam_file) as sam, open(output_file, 'w') as output:
+            alignments.write_counts(alignments.collapse(
+                alignments.read_sam(sam)), output, chunk_records=1)
+        with open(output_file) as f:
+            self.assertEqual(
+                f.read(), '"+"\t"tx1"\t9\t"ACGT"\t2\n'
+                          '"+"\t"tx2"\t0\t"ACGTA"\t1\n',
+                'Write all distinct reads, whatever the chunk size.')
+
+
+class RWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, 'worker.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bind(self):
+        """Test the worker socket is private and never replaces files. """
+        server = rworker.bind(self.socket_path)
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600,
+                         'Only the owner can use the socket.')
+        server.listen(1)
+        self.assertRaises(rworker.RWorkerError, rworker.bind,
+                          self.socket_path)
+        server.close()
+        rworker.bind(self.socket_path).close()
+        os.remove(self.socket_path)
+        with open(self.socket_path, 'w') as f:
+            f.write('data')
+        self.assertRaises(rworker.RWorkerError, rworker.bind,
+                          self.socket_path)
+        self.assertTrue(os.path.isfile(self.socket_path),
+                        'Do not remove a file that is not a socket.')
+
+    def test_busy_worker(self):
+        """Test giving up on a worker busy with another client. """
+        server = rworker.bind(self.socket_path)
+        server.listen(1)
+        try:
+            with self.assertRaises(rworker.RWorkerError) as context:
+                rworker.RWorkerClient(self.socket_path, timeout=0.1)
+            self.assertIn('busy', str(context.exception))
+        finally:
+            server.close()
+
+    def test_handle(self):
+        """Test answering requests from a client. """
+        def evaluate(command):
+            if command == 'stop()':
+                raise RuntimeError('failed')
+            return ['ok', command.upper()]
+        R = {'.riboseqrReset': lambda path: None, '.riboseqrEval': evaluate,
+             '.riboseqrGet': lambda name: ['missing', '']}
+        connection, client = socket.socketpair()
+        client.sendall(''.join(json.dumps(request) + '\n' for request in (
+            {'reset': self.tmp_dir}, {'command': 'x'},
+            {'command': 'stop()'}, {'get': 'y'})).encode())
+        client.shutdown(socket.SHUT_WR)
+        self.assertTrue(rworker.handle(connection, R),
+                        'Keep running when the client disconnects.')
+        connection.close()
+        with client.makefile('r') as stream:
+            responses = [json.loads(line) for line in stream]
+        client.close()
+        self.assertEqual(responses, [['ok', ''], ['ok', 'X'],
+                                     ['error', 'failed'], ['missing', '']])
+
+    def test_client_values(self):
+        """Test that the client returns vectors as lists, not text. """
+        values = {'exists("readStore")': ['ok', 'logical', '0', 'FALSE'],
+                  'length(tC) > 0': ['ok', 'logical', '1', ''],
+                  'fS': ['ok', 'text', '', '  lengths frame0\n1 27 10']}
+        R = {'.riboseqrReset': lambda path: None,
+             '.riboseqrEval': values.get,
+             '.riboseqrGet': lambda name: ['ok', 'double', '01', '1.5', '']}
+        server = rworker.bind(self.socket_path)
+        server.listen(1)
+
+        def serve():
+            connection, _ = server.accept()
+            rworker.handle(connection, R)
+            connection.close()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        client = rworker.RWorkerClient(self.socket_path)
+        try:
+            self.assertEqual(client('exists("readStore")'), [False])
+            self.assertFalse(client('exists("readStore")')[0],
+                             'Return FALSE as False, not "[1] FALSE".')
+            self.assertEqual(client('length(tC) > 0'), [None],
+                             'Return NA as None.')
+            self.assertEqual(client('fS'), '  lengths frame0\n1 27 10',
+                             'Return other values as printed text.')
+            self.assertEqual(client['hitMean'], [1.5, None])
+        finally:
+            client.close()
+            thread.join()
+            server.close()
+
+    @unittest.skipUnless(riboseqr_available(), 'riboSeqR is not installed')
+    def test_worker_values(self):
+        """Test sending R values from the worker. """
+        import rpy2.robjects as robjects
+        R = robjects.r
+        R(rworker.WORKER_FUNCTIONS)
+        for command, value in (('exists("noSuchObject")', [False]),
+                               ('c(1L, NA)', [1, None]),
+                               ('c(0.1, 2)', [0.1, 2.0]),
+                               ('c("a", NA)', ['a', None])):
+            status = R['.riboseqrEval'](command)
+            self.assertEqual(status[0], 'ok')
+            self.assertEqual(rworker.decode_value(list(status)[1:]), value)
+        self.assertIn('1 2', rworker.decode_value(
+            list(R['.riboseqrEval']('matrix(1:4, 2)'))[1:]),
+            'Send matrices as printed text.')
+
+
+@unittest.skipIf(orfs.np is None, 'numpy is not installed')
+class OrfsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(FASTA_FILE) as f:
+            self.names, self.sequences = orfs.read_fasta(f)
+
+    def naive_find_cds(self, sequences):
+        """Codon by codon scan of each frame of each sequence."""
+        cds = []
+        for index, sequence in enumerate(sequences):
+            for frame in range(3):
+                start = None
+                for pos in range(frame, len(sequence) - 2, 3):
+                    codon = sequence[pos:pos + 3]
+                    if codon == 'ATG' and start is None:
+                        start = pos
+                    elif codon in ('TAG', 'TAA', 'TGA'):
+                        if start is not None:
+                            cds.append((index, start + 1, pos + 3, frame))
+                        start = None
+        return sorted(cds)
+
+    def test_find_cds(self):
+        """Test the vectorized CDS finder against a codon by codon scan. """
+        self.assertEqual(len(self.names), 50, 'Read all transcripts.')
+        cds = sorted(zip(*[column.tolist() for column in
+                           orfs.find_cds(self.sequences)]))
+        self.assertEqual(cds, self.naive_find_cds(self.sequences),
+                         'Find the same CDSs as a codon by codon scan.')
+
+        cds = sorted(zip(*[column.tolist() for column in
+                           orfs.find_cds_parallel(self.sequences, threads=2,
+                                                  group_size=10000)]))
+        self.assertEqual(cds, self.naive_find_cds(self.sequences),
+                         'Find the same CDSs in groups of transcripts.')
+
+    @unittest.skipUnless(riboseqr_available(), 'riboSeqR is not installed')
+    def test_find_cds_riboseqr(self):
+        """Test the vectorized CDS finder against riboSeqR findCDS. """
+        import rpy2.robjects as robjects
+        robjects.r('fastaCDS <- findCDS(fastaFile="{}", startCodon=c("ATG"), '
+                   'stopCodon=c("TAG", "TAA", "TGA"))'.format(FASTA_FILE))
+        found = robjects.r('as.data.frame(fastaCDS)')
+        expected = sorted(zip(
+            [str(name) for name in robjects.r('as.character')(found[0])],
+            [int(start) for start in found[1]],
+            [int(end) for end in found[2]]))
+        index, starts, ends, _ = orfs.find_cds(self.sequences)
+        cds = sorted(zip([self.names[i] for i in index], starts.tolist(),
+                         ends.tolist()))
+        self.assertEqual(cds, expected, 'Find the same CDSs as findCDS.')
+
+
+@unittest.skipIf(frames.np is None, 'numpy is not installed')
+class FramesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(FASTA_FILE) as f:
+            self.names, sequences = orfs.read_fasta(f)
+        index, starts, ends, _ = orfs.find_cds(sequences)
+        self.cds = (index, starts, ends)
+        rand = frames.np.random.RandomState(1)
+        size = 20000
+        self.reads = (rand.randint(0, len(self.names), size),
+                      rand.randint(1, 1500, size),
+                      rand.randint(24, 32, size))
+        self.lengths = list(range(25, 31))
+
+    def naive_count_frames(self, reads, cds, lengths):
+        """Check each read against each CDS."""
+        hits = {}
+        unique = set()
+        for seqname, start, width in zip(*[column.tolist()
+                                           for column in reads]):
+            if width not in lengths:
+                continue
+            for count, (cds_seqname, cds_start, cds_end) in enumerate(
+                    zip(*[column.tolist() for column in cds])):
+                if cds_seqname == seqname and cds_start <= start <= cds_end:
+                    key = (count, (start - cds_start) % 3,
+                           lengths.index(width))
+                    hits[key] = hits.get(key, 0) + 1
+                    unique.add(key + (start,))
+        unique_hits = {}
+        for key in unique:
+            unique_hits[key[:3]] = unique_hits.get(key[:3], 0) + 1
+        return hits, unique_hits
+
+    def test_count_frames(self):
+        """Test the vectorized frame counting against a read by read scan. """
+        hits, unique_hits = frames.count_frames(
+            self.reads, self.cds, self.lengths)
+        self.assertEqual(hits.shape, (len(self.cds[0]), 3, 6))
+        expected_hits, expected_unique = self.naive_count_frames(
+            self.reads, self.cds, self.lengths)
+        found = dict((tuple(key), int(hits[tuple(key)]))
+                     for key in frames.np.argwhere(hits))
+        self.assertEqual(found, expected_hits,
+                         'Count the same reads as a read by read scan.')
+        found = dict((tuple(key), int(unique_hits[tuple(key)]))
+                     for key in frames.np.argwhere(unique_hits))
+        self.assertEqual(found, expected_unique,
+                         'Count each distinct read once in unique hits.')
+
+    def test_count_frames_parallel(self):
+        """Test frame counting of several libraries in a process pool. """
+        expected = frames.count_frames(self.reads, self.cds, self.lengths)
+        results = frames.count_frames_parallel(
+            [self.reads, self.reads], self.cds, self.lengths, threads=2)
+        self.assertEqual(len(results), 2, 'One result per library.')
+        for hits, unique_hits in results:
+            self.assertTrue((hits == expected[0]).all())
+            self.assertTrue((unique_hits == expected[1]).all())
+
+    @unittest.skipUnless(riboseqr_available(), 'riboSeqR is not installed')
+    def test_count_frames_riboseqr(self):
+        """Test the vectorized frame counting against riboSeqR frameCounting
+        and readingFrame.
+
+        """
+        import rpy2.robjects as robjects
+        r = robjects.r
+        r('fastaCDS <- findCDS(fastaFile="{}", startCodon=c("ATG"), '
+          'stopCodon=c("TAG", "TAA", "TGA"))'.format(FASTA_FILE))
+        robjects.globalenv['seqnames'] = robjects.StrVector(
+            [self.names[i] for i in self.reads[0].tolist()])
+        robjects.globalenv['starts'] = robjects.IntVector(
+            self.reads[1].tolist())
+        robjects.globalenv['widths'] = robjects.IntVector(
+            self.reads[2].tolist())
+        r('reads <- GRanges(seqnames, IRanges(starts, width=widths), '
+          'strand="+")\n'
+          'riboDat <- new("riboData", riboGR=GRangesList(reads, '
+          'reads[1:5000]), rnaGR=GRangesList(), '
+          'replicates=factor(c("WT", "M")))\n'
+          'expected <- frameCounting(riboDat, fastaCDS, lengths=25:30)')
+
+        r(frames.FRAME_COUNT_COLUMNS)
+        columns = r['frameCountColumns']()
+        cds = [frames.np.asarray(column) for column in columns[0]]
+        libraries = [[frames.np.asarray(column) for column in library]
+                     for library in columns[1]]
+        results = frames.count_frames_parallel(libraries, cds, self.lengths)
+        for key, position in (('hits', 0), ('unqHits', 1)):
+            robjects.globalenv[key] = r['list'](*[robjects.IntVector(
+                result[position].ravel(order='F').tolist())
+                for result in results])
+        r(frames.RIBO_CODING.format('25:30'))
+
+        for slot in ('hits', 'unqHits'):
+            same = r('isTRUE(all.equal(fCs@{0}, expected@{0}))'.format(slot))
+            self.assertTrue(same[0],
+                            'Count the same {} as frameCounting.'.format(slot))
+        self.assertTrue(r('isTRUE(all.equal(readingFrame(fCs, lengths=25:30), '
+                          'readingFrame(expected, lengths=25:30)))')[0],
+                        'Give the same readingFrame table as frameCounting.')
+
+
+@unittest.skipIf(readstore.np is None, 'numpy is not installed')
+class ReadStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_store(self):
+        """Test writing and querying the read store. """
+        records = [[('tx2', 30, 'A' * 28), ('tx1', 10, 'A' * 27),
+                    ('tx2', 5, 'A' * 26), ('tx1', 3, 'A' * 25)]]
+        ribo = alignments.collect_columns(records)
+        rna = alignments.collect_columns([[('tx3', 7, 'A' * 30)]])
+        path = os.path.join(self.tmp_dir, 'reads')
+        readstore.write_read_store(
+            path, [('ribo1', 'riboseq', ribo), ('rna1', 'rnaseq', rna)],
+            replicates=['WT'])
+        self.assertTrue(readstore.is_read_store(path))
+
+        reads = readstore.ReadStore(path)
+        self.assertEqual(reads.seqnames, ['tx1', 'tx2', 'tx3'])
+        self.assertEqual(reads.replicates, ['WT'])
+        starts, widths = reads.reads(0, 'tx2')
+        self.assertEqual((starts.tolist(), widths.tolist()),
+                         ([5, 30], [26, 28]),
+                         'Return the reads of one transcript sorted by start.')
+        starts, widths = reads.reads(0, 'tx3')
+        self.assertEqual(len(starts), 0, 'No reads on transcript.')
+        starts, widths = reads.reads(0, 'missing')
+        self.assertEqual(len(starts), 0, 'No reads on unknown transcript.')
+        self.assertEqual(
+            [(name, starts.tolist()) for name, starts, _ in
+             reads.transcript('tx3', seq_type='rnaseq')], [('rna1', [7])],
+            'Return reads of the RNA-Seq libraries.')
+        (name, codes, starts, widths), = reads.select(['tx2', 'tx1'])
+        self.assertEqual((name, codes.tolist(), starts.tolist()),
+                         ('ribo1', [1, 1, 2, 2], [5, 30, 3, 10]),
+                         'Return reads of several transcripts as a factor.')
+
+
+@unittest.skipIf(export.np is None, 'numpy is not installed')
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_npz(self):
+        """Test exporting count tables as .npz files. """
+        file_name = os.path.join(self.tmp_dir, 'RiboCounts.npz')
+        export.write_npz(file_name, ['tx1', 'tx2'], ['ribo1', 'ribo2'],
+                         [[1, 2], [3, 4]])
+        index, names, columns = export.read_npz(file_name)
+        self.assertEqual((index.tolist(), names.tolist()),
+                         (['tx1', 'tx2'], ['ribo1', 'ribo2']))
+        self.assertEqual([column.tolist() for column in columns],
+                         [[1, 2], [3, 4]], 'Count matrix round trip.')
+        with export.np.load(file_name) as data:
+            self.assertEqual(data['values'].shape, (2, 2),
+                             'Store a count matrix as one 2-d array.')
+
+        export.write_npz(file_name, ['tx2'], ['seqnames', 'FDR'],
+                         [['tx2'], [0.5]])
+        index, names, columns = export.read_npz(file_name)
+        self.assertEqual([column.tolist() for column in columns],
+                         [['tx2'], [0.5]], 'Mixed column types round trip.')
+
+    def test_npz_na(self):
+        """Test exporting NA values from R. """
+        np = export.np
+        file_name = os.path.join(self.tmp_dir, 'RiboCounts.npz')
+        export.write_npz(file_name, ['tx1', 'tx2'], ['ribo1', 'ribo2'],
+                         [np.array([1, export.NA_INTEGER], dtype=np.int32),
+                          np.array([3, 4], dtype=np.int32)])
+        _, _, columns = export.read_npz(file_name)
+        self.assertEqual([column.tolist() for column in columns],
+                         [[1, None], [3, 4]],
+                         'Mask integer NA values in a count matrix.')
+
+        export.write_npz(file_name, ['tx1', 'tx2'], ['seqnames', 'FDR'],
+                         [['tx1', 'tx2'], [np.nan, 0.5]])
+        _, _, columns = export.read_npz(file_name)
+        self.assertEqual(columns[1].tolist(), [None, 0.5],
+                         'Mask numeric NA values in a data frame.')
+        self.assertFalse(np.ma.isMaskedArray(columns[0]),
+                         'Only mask columns with NA values.')
+
+    @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_na(self):
+        """Test exporting NA values from R to Parquet as nulls. """
+        np = export.np
+        file_name = os.path.join(self.tmp_dir, 'TopCounts.parquet')
+        export.write_parquet(
+            file_name, ['tx1', 'tx2'], ['count', 'FDR'],
+            [np.array([export.NA_INTEGER, 2], dtype=np.int32),
+             np.array([0.5, np.nan])])
+        table = export.pyarrow.parquet.read_table(file_name)
+        self.assertEqual(table.column('count').to_pylist(), [None, 2])
+        self.assertEqual(table.column('FDR').to_pylist(), [0.5, None])
+
+    def test_write_table(self):
+        """Test choosing the export format. """
+        self.assertRaises(ValueError, export.write_table,
+                          os.path.join(self.tmp_dir, 'counts.csv'), [], [],
+                          [], export_format='csv')
+
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_profile(self):
+        """Test recording the time of commands. """
+        profile = profiling.Profile(r_memory=False)
+        self.assertEqual(profile.run(lambda command: command.upper(),
+                                     'fS <- readingFrame(fCs)'),
+                         'FS <- READINGFRAME(FCS)', 'Return the output.')
+        with profile.measure('# frame counting'):
+            sum(range(1000))
+        self.assertEqual([record['command'] for record in profile.records],
+                         ['fS <- readingFrame(fCs)', '# frame counting'])
+        for record in profile.records:
+            self.assertTrue(record['wall_seconds'] >= 0)
+            self.assertTrue(record['cpu_seconds'] >= 0)
+            self.assertTrue(record['max_rss_mb'] > 0)
+            if 'peak_rss_mb' in record:
+                self.assertTrue(
+                    0 < record['peak_rss_mb'] <= record['max_rss_mb'],
+                    'The peak of a command is at most the maximum so far.')
+
+        with profile.measure('# allocate'):
+            data = b'x' * (64 * 1024 ** 2)
+        del data
+        with profile.measure('# small'):
+            pass
+        allocate, small = profile.records[-2:]
+        self.assertTrue(small['max_rss_mb'] >= allocate['max_rss_mb'],
+                        'Keep the maximum memory so far.')
+        if profiling._reset_peak_rss():
+            self.assertTrue(
+                small['peak_rss_mb'] < allocate['peak_rss_mb'],
+                'Record the peak memory of each command on its own.')
+        del profile.records[-2:]
+
+        html = profile.report(self.tmp_dir, 'periodicity')
+        self.assertIn('<code>fS &lt;- readingFrame(fCs)</code>', html)
+        self.assertIn('periodicity-profile.json', html)
+        with open(os.path.join(self.tmp_dir,
+                               'periodicity-profile.json')) as f:
+            saved = json.load(f)
+        self.assertEqual(len(saved['commands']), 2,
+                         'Save the records as JSON.')
+
+    def test_run_rscript(self):
+        """Test running R commands through a profile. """
+        commands = []
+
+        def R(command):
+            commands.append(command)
+            # gc() statistics, "max used" (Mb) of Ncells and Vcells last
+            return [0] * 10 + [1.5, 2.5] if command == 'gc()' else None
+
+        profile = profiling.Profile(R)
+        profile.run_rscript('fS <- readingFrame(fCs)')
+        profile.run_rscript('')
+        self.assertEqual(profile.script, 'fS <- readingFrame(fCs)\n',
+                         'Keep the R script.')
+        self.assertEqual(commands, ['fS <- readingFrame(fCs)'],
+                         'Do not run gc() unless R memory is measured.')
+        self.assertNotIn('r_max_used_mb', profile.records[0])
+
+        profile.r_memory = True
+        profile.run_rscript('ffCs <- filterHits(fCs)')
+        self.assertEqual(commands[1:], ['invisible(gc(reset=TRUE))',
+                                        'ffCs <- filterHits(fCs)', 'gc()'])
+        self.assertEqual(profile.records[-1]['r_max_used_mb'], 4.0)
+
+    def test_label(self):
+        """Test shortening commands for the report. """
+        self.assertEqual(profiling.label('  pD <- getLikelihoods(pD)\n'),
+                         'pD <- getLikelihoods(pD)')
+        self.assertEqual(profiling.label('f <- function() {\n    1\n}'),
+                         'f <- function() {...')
+        self.assertEqual(len(profiling.label('x' * 100)),
+                         profiling.LABEL_LENGTH)
+
+
+class TranscriptListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.transcript_file = os.path.join(self.tmp_dir, 'transcripts.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text):
+        with open(self.transcript_file, 'w') as f:
+            f.write(text)
+
+    def test_r_strings(self):
+        """Test passing transcript names to R as string literals. """
+        self.assertEqual(
+            transcript_list.r_strings(['tx1', 'a"b\\c']),
+            'c("tx1", "a\\"b\\\\c")', 'Escape quotes and backslashes.')
+
+    def test_read_transcripts(self):
+        """Test reading a list of transcripts to plot. """
+        self.write('# name length cap\ntx1\n\ntx2\t28\ntx3 26,27 50\n')
+        self.assertEqual(
+            transcript_list.read_transcripts(
+                self.transcript_file, transcript_length='27',
+                transcript_cap='200'),
+            [('tx1', '27', '200'), ('tx2', '28', '200'),
+             ('tx3', '26,27', '50')],
+            'Use the default length and cap for missing fields.')
+
+    def test_read_transcripts_invalid(self):
+        """Test rejecting invalid lines in a list of transcripts. """
+        for text in ('tx1 28x\n', 'tx1 28 cap\n', 'tx1 28 200 extra\n',
+                     '# no transcripts\n'):
+            self.write(text)
+            self.assertRaises(ValueError, transcript_list.read_transcripts,
+                              self.transcript_file)
+        self.assertRaises(ValueError, transcript_list.check_transcript,
+                          'tx\x001', '27')
+
+    def test_is_printable(self):
+        """Test checking transcript names as str.isprintable does. """
+        for name in ('CUFF.37930.1', 'tx 1', u'tx\u00e91', 'tx\x001',
+                     'tx\t1', u'tx\u00a01', u'tx\u20281', ''):
+            self.assertEqual(transcript_list.is_printable(name),
+                             name.isprintable(), repr(name))
+        self.assertTrue(transcript_list.is_printable(b'tx1'),
+                        'Check byte strings (Python 2 str) too.')
+
+    def test_batch_report(self):
+        """Test the report of plots of a list of transcripts. """
+        html = transcript_list.batch_report(
+            [('<tx1>', '27', '200'), ('tx2', '28', '')],
+            [(['/out/plot1.pdf', '/out/plot1_1.png'], ''), ([], 'error')])
+        self.assertIn('<tr><td>&lt;tx1&gt;</td><td>27</td><td>200</td>'
+                      '<td><a href="#plot1">View</a></td></tr>', html,
+                      'Escape transcript names.')
+        self.assertIn('<td>tx2</td><td>28</td><td></td><td>Not plotted</td>',
+                      html, 'List transcripts that could not be plotted.')
+        self.assertIn('<img border="1" src="plot1_1.png"', html)
+        self.assertIn('<a href="plot1.pdf">PDF version</a>', html)
+        self.assertNotIn('id="plot2"', html,
+                         'No section for transcripts not plotted.')
+
+
+class PipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.output_dir, 'steps.log')
+        self.branches = ('difftrans', 'ribosome_profile')
+        self.failing = set()
+        # options of the first steps, which are run for all others
+        self.config = {'prepare': {'ribo_files': 'ribo.sam'},
+                       'triplet': {'fasta_file': 'transcripts.fa'}}
+        patches = [mock.patch.object(pipeline, 'run_step', self.run_step),
+                   mock.patch.object(pipeline, 'start_session')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def run_step(self, name, options, output_dir):
+        """Stand-in for pipeline.run_step, logs each step to a file (steps
+        are also run in forked processes). Branches wait for each other, so
+        they only finish if they are run at the same time.
+
+        """
+        with open(self.log_file, 'a') as f:
+            f.write('{} {} {}\n'.format(name, os.getpid(),
+                                        options.get('threads')))
+        if name in self.branches:
+            open(os.path.join(output_dir, name + '.started'), 'w').close()
+            deadline = time.time() + 10
+            while not all(os.path.exists(os.path.join(
+                    output_dir, branch + '.started'))
+                    for branch in self.branches):
+                if time.time() > deadline:
+                    raise RuntimeError('Branches not run at the same time')
+                time.sleep(0.01)
+        if name in self.failing:
+            raise RuntimeError('Step {} failed'.format(name))
+
+    def steps(self):
+        """Return (name, pid, threads) of each step run."""
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file) as f:
+            return [(name, int(pid), threads) for name, pid, threads in
+                    (line.split() for line in f)]
+
+    def test_select_steps(self):
+        """Test running the steps a step depends on, in order. """
+        self.config['metagene'] = {'hit_mean': '10'}
+        pipeline.run_pipeline(self.config, self.output_dir, threads=4)
+        self.assertEqual(
+            self.steps(), [('prepare', os.getpid(), '4'),
+                           ('triplet', os.getpid(), '4'),
+                           ('metagene', os.getpid(), '4')],
+            'Run prepare, triplet and metagene in the session, in order.')
+        self.assertRaises(ValueError, pipeline.run_pipeline,
+                          {'plot': {}}, self.output_dir)
+
+    def test_rdata_load(self):
+        """Test starting a step from an existing R data file. """
+        self.branches = ()
+        pipeline.run_pipeline(
+            {'ribosome_profile': {'rdata_load': 'Metagene.rda'}},
+            self.output_dir)
+        self.assertEqual([name for name, _, _ in self.steps()],
+                         ['ribosome_profile'],
+                         'Do not run the steps it depends on.')
+
+    def test_missing_options(self):
+        """Test that steps missing options fail before any step is run. """
+        with self.assertRaises(ValueError) as context:
+            pipeline.run_pipeline({'metagene': {}}, self.output_dir)
+        self.assertIn('prepare', str(context.exception))
+        self.assertIn('ribo_files', str(context.exception))
+        self.assertEqual(self.steps(), [])
+        self.assertFalse(pipeline.start_session.called,
+                         'Check options before starting R.')
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                         'fork is not available')
+    def test_run_branches(self):
+        """Test running steps no other step depends on at the same time. """
+        self.config.update((name, {}) for name in self.branches)
+        pipeline.run_pipeline(self.config, self.output_dir, threads=4)
+        steps = self.steps()
+        self.assertEqual([name for name, _, _ in steps[:3]],
+                         ['prepare', 'triplet', 'metagene'])
+        branches = sorted(steps[3:])
+        self.assertEqual([name for name, _, _ in branches],
+                         list(self.branches))
+        pids = set(pid for _, pid, _ in branches)
+        self.assertEqual(len(pids), 2, 'Run each branch in a process.')
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(set(threads for _, _, threads in branches),
+                         set(['2']), 'Share threads between branches.')
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                         'fork is not available')
+    def test_failed_branch(self):
+        """Test that a failed branch fails the pipeline. """
+        self.failing.add('difftrans')
+        self.config.update((name, {}) for name in self.branches)
+        with self.assertRaises(RuntimeError) as context:
+            pipeline.run_pipeline(self.config, self.output_dir)
+        self.assertIn('difftrans', str(context.exception))
+        self.assertNotIn('ribosome_profile', str(context.exception))
+        self.assertIn('ribosome_profile',
+                      [name for name, _, _ in self.steps()],
+                      'Finish the other branch.')
+
+    def test_failed_step(self):
+        """Test that steps after a failed step are not run. """
+        self.failing.add('triplet')
+        self.config['metagene'] = {}
+        self.assertRaises(RuntimeError, pipeline.run_pipeline,
+                          self.config, self.output_dir)
+        self.assertEqual([name for name, _, _ in self.steps()],
+                         ['prepare', 'triplet'])